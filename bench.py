@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-module-docstring
+
+# Codec micro-benchmarks for ptp, ptp_transport and the driver CPU headers, covering every
+# message type, the Ethernet/UDP/IPv4/IPv6 headers and the per-protocol transport header builders.
+#
+#   ./bench.py -o before.json
+#   ./bench.py -o after.json -b before.json
+
+from optparse import OptionParser
+import json
+import platform
+import subprocess
+import time
+import timeit
+import tracemalloc
+import ptp
+import ptp_transport
+from ptp import PTP_MESG_TYPE
+
+try:
+    import tofino as driver
+except ImportError: # Thrift or generated bindings not available
+    driver = None
+
+CLOCK_IDENTITY = bytes.fromhex('0090fafffe001122')
+PEER_IDENTITY = bytes.fromhex('3cfdfefffe334455')
+ALL_PORTS = ptp.PortIdentity(b'\xff' * 8, 0xFFFF)
+TIMESTAMP = 1632744911123456789
+
+## Frames ##
+
+def header(msg, messageType, controlField, logMessageInterval=0):
+    msg.transportSpecific = 0
+    msg.messageType = messageType
+    msg.versionPTP = 2
+    msg.messageLength = ptp.Header.parser.size + msg.parser.size
+    msg.domainNumber = 0
+    msg.correctionField = 0x1234 << 16
+    msg.sourcePortIdentity = ptp.PortIdentity(CLOCK_IDENTITY, 1)
+    msg.sequenceId = 0x2a2a
+    msg.controlField = controlField
+    msg.logMessageInterval = logMessageInterval
+    return msg
+
+def messages():
+    msgs = {}
+
+    msg = header(ptp.Announce(), PTP_MESG_TYPE.ANNOUNCE, 0x05, 1)
+    msg.flagField.ptpTimescale = True
+    msg.flagField.currentUtcOffsetValid = True
+    msg.originTimestamp = ptp.TimeStamp(0)
+    msg.currentUtcOffset = 37
+    msg.grandmasterPriority1 = 128
+    msg.grandmasterClockQuality.clockClass = 6
+    msg.grandmasterClockQuality.clockAccuracy = 0x21
+    msg.grandmasterClockQuality.offsetScaledLogVariance = 0x4e5d
+    msg.grandmasterPriority2 = 128
+    msg.grandmasterIdentity = CLOCK_IDENTITY
+    msg.stepsRemoved = 0
+    msg.timeSource = ptp.PTP_TIME_SRC.GPS
+    msgs['Announce'] = msg
+
+    msg = header(ptp.Sync(), PTP_MESG_TYPE.SYNC, 0x00)
+    msg.flagField.twoStepFlag = True
+    msg.originTimestamp = ptp.TimeStamp(0)
+    msgs['Sync'] = msg
+
+    msg = header(ptp.Delay_Req(), PTP_MESG_TYPE.DELAY_REQ, 0x01, 0x7F)
+    msg.originTimestamp = ptp.TimeStamp(0)
+    msgs['Delay_Req'] = msg
+
+    msg = header(ptp.Follow_Up(), PTP_MESG_TYPE.FOLLOW_UP, 0x02)
+    msg.preciseOriginTimestamp = ptp.TimeStamp(TIMESTAMP)
+    msgs['Follow_Up'] = msg
+
+    msg = header(ptp.Delay_Resp(), PTP_MESG_TYPE.DELAY_RESP, 0x03)
+    msg.receiveTimestamp = ptp.TimeStamp(TIMESTAMP)
+    msg.requestingPortIdentity = ptp.PortIdentity(PEER_IDENTITY, 3)
+    msgs['Delay_Resp'] = msg
+
+    msg = header(ptp.Pdelay_Req(), PTP_MESG_TYPE.PDELAY_REQ, 0x05, 0x7F)
+    msg.originTimestamp = ptp.TimeStamp(0)
+    msgs['Pdelay_Req'] = msg
+
+    msg = header(ptp.Pdelay_Resp(), PTP_MESG_TYPE.PDELAY_RESP, 0x05, 0x7F)
+    msg.flagField.twoStepFlag = True
+    msg.requestReceiptTimestamp = ptp.TimeStamp(TIMESTAMP)
+    msg.requestingPortIdentity = ptp.PortIdentity(PEER_IDENTITY, 3)
+    msgs['Pdelay_Resp'] = msg
+
+    msg = header(ptp.Pdelay_Resp_Follow_Up(), PTP_MESG_TYPE.PDELAY_RESP_FOLLOW_UP, 0x05, 0x7F)
+    msg.responseOriginTimestamp = ptp.TimeStamp(TIMESTAMP)
+    msg.requestingPortIdentity = ptp.PortIdentity(PEER_IDENTITY, 3)
+    msgs['Pdelay_Resp_Follow_Up'] = msg
+
+    msg = header(ptp.Signaling(), PTP_MESG_TYPE.SIGNALING, 0x05, 0x7F)
+    msg.targetPortIdentity = ALL_PORTS
+    # Unicast Announce every 2^0 s for 60 s, 16.1.4.1
+    msg.add_tlv(ptp.TLV(ptp.TLV_TYPE.REQUEST_UNICAST_TRANSMISSION, bytes([PTP_MESG_TYPE.ANNOUNCE << 4, 0]) + (60).to_bytes(4, 'big')))
+    msg.add_tlv(ptp.Path_Trace_TLV((CLOCK_IDENTITY, PEER_IDENTITY)))
+    msgs['Signaling'] = msg
+
+    msg = header(ptp.Management(), PTP_MESG_TYPE.MANAGEMENT, 0x04, 0x7F)
+    msg.targetPortIdentity = ALL_PORTS
+    msg.startingBoundaryHops = 1
+    msg.boundaryHops = 1
+    msg.actionField = 0 # GET
+    msg.add_tlv(ptp.TLV(ptp.TLV_TYPE.MANAGEMENT, (0x2000).to_bytes(2, 'big'))) # DEFAULT_DATA_SET, 15.5.2
+    msgs['Management'] = msg
+
+    return msgs
+
+def ethernet():
+    eth = ptp_transport.Ethernet()
+    eth.dst = ptp_transport.ETH_DST_PTP_PRIMARY
+    eth.src = bytes.fromhex('0090fa001122')
+    eth.type = ptp_transport.ETH_P_1588
+    return eth
+
+def udp():
+    header = ptp_transport.UDP()
+    header.src = header.dst = ptp_transport.IANA_PORT_PTP_EVENT
+    header.len = ptp_transport.UDP.parser.size + ptp.Sync.size
+    header.chk = 0
+    return header
+
+def ipv4():
+    header = ptp_transport.IPv4()
+    header.len = ptp_transport.IPv4.parser.size + ptp_transport.UDP.parser.size + ptp.Sync.size
+    header.ttl = 1
+    header.proto = ptp_transport.IPPROTO_UDP
+    header.src = bytes([192, 0, 2, 1])
+    header.dst = bytes([224, 0, 1, 129])
+    return header
+
+def ipv6():
+    header = ptp_transport.IPv6()
+    header.payload_len = ptp_transport.UDP.parser.size + ptp.Sync.size + 2
+    header.next_header = ptp_transport.IPPROTO_UDP
+    header.hop_limit = 1
+    header.src = bytes.fromhex('20010db8000000000000000000000001')
+    header.dst = bytes.fromhex('ff0e0000000000000000000000000181')
+    return header
+
+def port_config(proto):
+    config = ptp_transport.Port_Config()
+    config.proto = proto
+    config.src_mac = bytes.fromhex('0090fa001122')
+    config.src_ipv4 = bytes([192, 0, 2, 1])
+    config.src_ipv6 = bytes.fromhex('20010db8000000000000000000000001')
+    return config
+
+## Benchmarks ##
+
+def cases():
+    """Returns {name: callable}, each callable performing one codec operation"""
+    benchmarks = {}
+
+    frame = bytearray(ptp_transport.MAX_FRAME_SIZE)
+    for name, msg in messages().items():
+        cls = type(msg)
+        buffer = msg.bytes()
+        benchmarks['%s.parse' % (name)] = lambda cls=cls, buffer=buffer: cls(buffer)
+        benchmarks['%s.bytes' % (name)] = msg.bytes
+        benchmarks['%s.write_into' % (name)] = lambda msg=msg: msg.write_into(frame, 22)
+        if msg.suffix:
+            benchmarks['%s.tlvs' % (name)] = lambda msg=msg: list(msg.tlvs())
+
+    buffer = messages()['Sync'].bytes()
+    benchmarks['HeaderView.messageType'] = lambda: ptp.HeaderView(buffer).messageType
+
+    message_filter = ptp.Message_Filter(0, PEER_IDENTITY)
+    benchmarks['Message_Filter.accept'] = lambda: message_filter.accept(buffer)
+    looped_back = ptp.Message_Filter(0, CLOCK_IDENTITY)
+    benchmarks['Message_Filter.reject'] = lambda: looped_back.accept(buffer)
+
+    eth = ethernet()
+    buffer = eth.bytes()
+    benchmarks['Ethernet.parse'] = lambda: ptp_transport.Ethernet(buffer)
+    benchmarks['Ethernet.bytes'] = eth.bytes
+    benchmarks['Ethernet.write_into'] = lambda: eth.write_into(frame, 8)
+
+    for name, header in (('UDP', udp()), ('IPv4', ipv4()), ('IPv6', ipv6())):
+        cls = type(header)
+        buffer = header.bytes()
+        benchmarks['%s.parse' % (name)] = lambda cls=cls, buffer=buffer: cls(buffer)
+        benchmarks['%s.bytes' % (name)] = header.bytes
+        benchmarks['%s.write_into' % (name)] = lambda header=header: header.write_into(frame, 22)
+
+    sync = messages()['Sync']
+    for name, proto in (('Ethernet', ptp_transport.PTP_PROTO.ETHERNET), ('IPv4', ptp_transport.PTP_PROTO.UDP_IPV4), ('IPv6', ptp_transport.PTP_PROTO.UDP_IPV6)):
+        config = port_config(proto)
+        benchmarks['Transport.build_header.%s' % (name)] = lambda config=config: ptp_transport.Transport.build_header(config, PTP_MESG_TYPE.SYNC)
+        if proto != ptp_transport.PTP_PROTO.ETHERNET:
+            # UDP length and checksum over a prebuilt header and message, as write_frame does per send
+            header = ptp_transport.Transport.build_header(config, PTP_MESG_TYPE.SYNC)
+            ip = (ptp_transport.IPv4 if proto == ptp_transport.PTP_PROTO.UDP_IPV4 else ptp_transport.IPv6)(header[ptp_transport.Ethernet.parser.size:])
+            udp_frame = bytearray(header + sync.bytes())
+            benchmarks['Transport.write_udp.%s' % (name)] = lambda ip=ip, udp_frame=udp_frame, start=len(header): ptp_transport.Transport.write_udp(udp_frame, start, len(udp_frame), ip)
+
+    if driver:
+        cpu_hdr = driver.CPU_Header()
+        cpu_hdr.device_port = 0x3c
+        cpu_hdr.timestamp = TIMESTAMP & 0xFFFFFFFFFFFF
+        buffer = cpu_hdr.bytes() + eth.bytes()
+        benchmarks['CPU_Header.parse'] = lambda: driver.CPU_Header(buffer)
+        benchmarks['CPU_Header.bytes'] = cpu_hdr.bytes
+        benchmarks['CPU_Header.write_into'] = lambda: cpu_hdr.write_into(frame)
+
+    return benchmarks
+
+def measure(func, number, repeat):
+    func() # warm up
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    best = min(timings) / number
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    return {
+        'ns_per_call': best * 1e9,
+        'calls_per_s': 1 / best,
+        'peak_alloc_bytes': peak
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    print()
+    print("%-36s %12s %12s %8s" % ("Benchmark", "Baseline ns", "Current ns", "Change"))
+    for name, result in results['benchmarks'].items():
+        if name in baseline['benchmarks']:
+            before = baseline['benchmarks'][name]['ns_per_call']
+            after = result['ns_per_call']
+            print("%-36s %12.1f %12.1f %+7.1f%%" % (name, before, after, 100 * (after - before) / before))
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-o", "--output", dest="output", help="write results as JSON")
+    parser.add_option("-b", "--baseline", dest="baseline", help="JSON results to compare against")
+    parser.add_option("-n", "--number", type="int", dest="number", default=20000)
+    parser.add_option("-r", "--repeat", type="int", dest="repeat", default=5)
+    parser.add_option("-k", "--filter", dest="filter", default='', help="only run benchmarks containing this string")
+    (options, _) = parser.parse_args()
+
+    if not driver:
+        print("[WARN] tofino driver unavailable, skipping CPU_Header benchmarks")
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'number': options.number,
+        'repeat': options.repeat,
+        'benchmarks': {}
+    }
+
+    print("%-36s %10s %12s %10s" % ("Benchmark", "ns/call", "calls/s", "peak B"))
+    for name, func in cases().items():
+        if options.filter not in name: continue
+        result = measure(func, options.number, options.repeat)
+        results['benchmarks'][name] = result
+        print("%-36s %10.1f %12.0f %10d" % (name, result['ns_per_call'], result['calls_per_s'], result['peak_alloc_bytes']))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
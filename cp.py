@@ -11,15 +11,20 @@
 
 from copy import copy
 from optparse import OptionParser
+import collections
 import random
 import time
 import asyncio
+import math
 import os
+import struct
 import ptp
-from ptp_transport import Transport
+from ptp_transport import Transport, TRANSPORT_PROTO, QUEUE_DROP, RX_QUEUE_DEPTH, frame_offsets, patch_frame
 from ptp_datasets import DefaultDS, CurrentDS, ParentDS, TimePropertiesDS, PortDS, ForeignMasterDS
 from ptp_datasets import BMC_Entry
 from ptp import PTP_STATE, PTP_DELAY_MECH, PTP_MESG_TYPE
+from ptp_filter import make_filter, Rate_Ratio_Estimator, FILTER_DEFAULT
+from ptp_servo import PI_Servo, SERVO_STATE, SERVO_KP, SERVO_KI, SERVO_STEP_THRESHOLD, SERVO_FIRST_STEP_THRESHOLD
 
 # TODO: Fix Logging
 # TODO: Enable logging of timestamp values through config
@@ -100,6 +105,71 @@ class Announce_Receipt_Timeout_Expires_Timer(Timer):
         await asyncio.sleep(announceReceiptTimeoutInterval)
         self.owner.announceReceiptTimeoutEvent()
 
+class Message_Template:
+    """Preassembled transport frame for a periodic message, only the changing fields are patched per send"""
+    # Offsets within the PTP message, 13.3.1 Table 18
+    SEQUENCE_ID = (30, struct.Struct('!H'))
+    CORRECTION_FIELD = (8, struct.Struct('!q'))
+    TIMESTAMP = (34, struct.Struct('!HLL')) # Same on-wire form as ptp.TimeStamp.wire()
+
+    def __init__(self, msg, frame):
+        self.messageType = msg.messageType
+        self.sequenceId = msg.sequenceId
+        self.frame = bytearray(frame)
+        self.msg_offset, self.checksum_offset = frame_offsets(self.frame)
+
+    def _patch(self, field, *values):
+        offset, parser = field
+        if self.checksum_offset is None:
+            parser.pack_into(self.frame, self.msg_offset + offset, *values)
+        else:
+            patch_frame(self.frame, self.msg_offset + offset, parser.pack(*values), self.checksum_offset)
+
+    def set_sequenceId(self, sequenceId):
+        self.sequenceId = sequenceId
+        self._patch(self.SEQUENCE_ID, sequenceId)
+
+    def set_correctionField(self, correctionField):
+        self._patch(self.CORRECTION_FIELD, correctionField)
+
+    def set_timestamp(self, nanoseconds):
+        self._patch(self.TIMESTAMP, *ptp.TimeStamp(nanoseconds).wire())
+
+SEQUENCE_WINDOW = 16 # Exchanges kept per message pair, a power of two
+SEQUENCE_TIMEOUT = 1.0 # Seconds an exchange waits for the rest of its messages
+
+class Sequence_Window:
+    """Ring of recent exchanges indexed by sequenceId, so late or reordered messages still pair
+
+    An exchange is held in slot sequenceId % size until a newer exchange reuses the slot or it
+    is looked up after more than timeout seconds.
+    """
+    def __init__(self, size=SEQUENCE_WINDOW, timeout=SEQUENCE_TIMEOUT):
+        self.mask = size - 1
+        self.timeout = timeout
+        self.slots = [None] * size # (sequenceId, added, item)
+        self.expired = 0
+
+    def add(self, sequenceId, item):
+        self.slots[sequenceId & self.mask] = (sequenceId, time.monotonic(), item)
+
+    def get(self, sequenceId):
+        slot = self.slots[sequenceId & self.mask]
+        if slot is None or slot[0] != sequenceId: return None
+        if time.monotonic() - slot[1] > self.timeout:
+            self.slots[sequenceId & self.mask] = None
+            self.expired += 1
+            return None
+        return slot[2]
+
+    def pop(self, sequenceId):
+        item = self.get(sequenceId)
+        if item is not None: self.slots[sequenceId & self.mask] = None
+        return item
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+
 class Sync_Data:
     def __init__(self, sync, sync_ingress_timestamp):
         self.sync = sync
@@ -107,20 +177,21 @@ class Sync_Data:
         self.follow_up = None
 
     def calcOffsetFromMaster(self, meanPathDelay):
+        """Returns offsetFromMaster in scaled nanoseconds (ns * 2^16), 11.2"""
         offsetFromMaster = None
 
         if meanPathDelay is not None:
             if not self.sync.flagField.twoStepFlag:
-                offsetFromMaster = self.syncEventIngressTimestamp - self.sync.originTimestamp.ns()
+                offsetFromMaster = (self.syncEventIngressTimestamp << 16) - self.sync.originTimestamp.scaled_ns()
                 offsetFromMaster -= meanPathDelay
-                offsetFromMaster -= self.sync.correctionField / 2**16
+                offsetFromMaster -= self.sync.correctionField
             else:
-                offsetFromMaster = self.syncEventIngressTimestamp - self.follow_up.preciseOriginTimestamp.ns()
+                offsetFromMaster = (self.syncEventIngressTimestamp << 16) - self.follow_up.preciseOriginTimestamp.scaled_ns()
                 offsetFromMaster -= meanPathDelay
-                offsetFromMaster -= self.sync.correctionField / 2**16
-                offsetFromMaster -= self.follow_up.correctionField / 2**16
+                offsetFromMaster -= self.sync.correctionField
+                offsetFromMaster -= self.follow_up.correctionField
 
-        print("[INFO] Offset From Master: %0.2f" % (offsetFromMaster))
+            print("[INFO] Offset From Master: %0.2f" % (offsetFromMaster / 2**16))
         return offsetFromMaster
 
 class Delay:
@@ -129,50 +200,67 @@ class Delay:
         self.t3 = delay_req_egress_timestamp
         self.resp = None
 
+    def set_t3(self, delay_req_egress_timestamp):
+        self.t3 = delay_req_egress_timestamp
+
     def calcMeanPathDelay(self, sync_data):
+        """Returns meanPathDelay in scaled nanoseconds (ns * 2^16), 11.3"""
         sync = sync_data.sync
         t2 = sync_data.syncEventIngressTimestamp
         follow_up = sync_data.follow_up
         meanPathDelay = None
 
-        if sync and (not sync.flagField.twoStepFlag or follow_up) and self.resp:
+        if sync and (not sync.flagField.twoStepFlag or follow_up) and self.resp and self.t3 is not None:
             if not sync.flagField.twoStepFlag:
-                meanPathDelay = t2 - self.t3
-                meanPathDelay += self.resp.receiveTimestamp.ns() - sync.originTimestamp.ns()
-                meanPathDelay -= sync.correctionField / 2**16
-                meanPathDelay -= self.resp.correctionField / 2**16
+                meanPathDelay = (t2 - self.t3) << 16
+                meanPathDelay += self.resp.receiveTimestamp.scaled_ns() - sync.originTimestamp.scaled_ns()
+                meanPathDelay -= sync.correctionField
+                meanPathDelay -= self.resp.correctionField
+                meanPathDelay //= 2
             else:
-                meanPathDelay = t2 - self.t3
-                meanPathDelay += self.resp.receiveTimestamp.ns() - follow_up.preciseOriginTimestamp.ns()
-                meanPathDelay -= sync.correctionField / 2**16
-                meanPathDelay -= follow_up.correctionField / 2**16
-                meanPathDelay -= self.resp.correctionField / 2**16
-                meanPathDelay /= 2
+                meanPathDelay = (t2 - self.t3) << 16
+                meanPathDelay += self.resp.receiveTimestamp.scaled_ns() - follow_up.preciseOriginTimestamp.scaled_ns()
+                meanPathDelay -= sync.correctionField
+                meanPathDelay -= follow_up.correctionField
+                meanPathDelay -= self.resp.correctionField
+                meanPathDelay //= 2
         else:
             print("[WARN] E2E mean path delay calculation not ready")
 
         return meanPathDelay
 
 class Pdelay:
-    def __init__(self, pdelay_req, pdelay_req_egress_timestamp):
-        self.req = pdelay_req
+    def __init__(self, sequenceId, pdelay_req_egress_timestamp):
+        self.sequenceId = sequenceId
         self.t1 = pdelay_req_egress_timestamp
         self.resp = None
         self.t4 = None
         self.resp_follow_up = None
 
-    def calcMeanPathDelay(self):
+    def ready(self):
+        return self.t1 is not None and self.resp is not None and \
+            (not self.resp.flagField.twoStepFlag or self.resp_follow_up is not None)
+
+    def peer_timestamps(self):
+        """Returns (t2, t3) in ns, None unless the response was two-step"""
+        if not self.ready() or not self.resp.flagField.twoStepFlag: return None
+        return (self.resp.requestReceiptTimestamp.ns(), self.resp_follow_up.responseOriginTimestamp.ns())
+
+    def calcMeanPathDelay(self, neighborRateRatio=1.0):
+        """Returns meanPathDelay in scaled nanoseconds (ns * 2^16), 11.4
+
+        The peer's turnaround time is converted to the local time base with neighborRateRatio.
+        """
         meanPathDelay = None
 
-        if self.resp and (not self.resp.flagField.twoStepFlag or self.resp_follow_up):
+        if self.ready():
             if self.resp.flagField.twoStepFlag:
-                meanPathDelay = self.t4 - self.t1
-                meanPathDelay -= self.resp_follow_up.responseOriginTimestamp.ns() - self.resp.requestReceiptTimestamp.ns()
-                meanPathDelay -= self.resp.correctionField / 2**16
-                meanPathDelay -= self.resp_follow_up.correctionField / 2**16
-                meanPathDelay /= 2
+                turnaround = (self.resp_follow_up.responseOriginTimestamp - self.resp.requestReceiptTimestamp) << 16
+                turnaround += self.resp.correctionField
+                turnaround += self.resp_follow_up.correctionField
+                meanPathDelay = (((self.t4 - self.t1) << 16) - round(turnaround / neighborRateRatio)) // 2
             else:
-                meanPathDelay = ((self.t4 - self.t1) - self.resp.correctionField) / 2
+                meanPathDelay = (((self.t4 - self.t1) << 16) - round(self.resp.correctionField / neighborRateRatio)) // 2
         else:
             print("[WARN] P2P mean path delay calculation not ready")
 
@@ -185,16 +273,27 @@ class Port:
         self.master_changed = False
         self.next_state = None
         self.sequenceId = {}
+        self.templates = {}
 
         ## Synchronization
-        self.sync_data = None
-        self.delay = None
-        self.pdelay = None
+        self.syncs = Sequence_Window() # Sync_Data awaiting their Follow_Up
+        self.follow_ups = Sequence_Window() # Follow_Ups that overtook their Sync
+        self.delays = Sequence_Window() # Delay_Req sent
+        self.pdelays = Sequence_Window() # Pdelay_Req sent
+        self.delay = None # Latest completed Delay_Req/Delay_Resp exchange
+        self.delay_filter = clock.delay_filter(portNumber)
+        self.rate_ratio = Rate_Ratio_Estimator()
+        self.rate_ratio_peer = None
 
         ## PTP Specified ##
         self.portDS = PortDS(profile, clock.defaultDS.clockIdentity, portNumber)
         self.e_rbest = None
-        self.foreignMasterList = set()
+        self.foreignMasterList = {} # foreignMasterPortIdentity -> ForeignMasterDS
+
+        ## BMC ##
+        self.bmc_dirty = True # A change that may affect e_rbest or the state decision
+        self.bmc_deadline = math.inf # When the next qualified foreign master lapses
+        self.e_rbest_key = None
 
         ## Timers ##
         self.qualificationTimeoutTimer = Qualification_Timeout_Expires_Timer(self)
@@ -211,36 +310,71 @@ class Port:
         self.sequenceId[message_type] = (sequenceId + 1) % 0x10000
         return sequenceId
 
+    def getTemplate(self, message_type, build):
+        template = self.templates.get(message_type)
+        if template is None:
+            msg = build()
+            frame = self.clock.transport.frame(msg, self.portDS.portIdentity.portNumber)
+            template = self.templates[message_type] = Message_Template(msg, frame)
+        return template
+
+    def invalidateTemplates(self):
+        """Must be called when a portDS, parentDS or timePropertiesDS member used by a template changes"""
+        self.templates.clear()
+
+    def clearTimestamps(self):
+        """Must be called when the local clock is stepped, drops every exchange holding earlier timestamps"""
+        self.syncs.clear()
+        self.follow_ups.clear()
+        self.delays.clear()
+        self.pdelays.clear()
+        self.delay = None
+        self.delay_filter.reset()
+        self.rate_ratio.reset()
+
+    def foreignMasterWindow(self):
+        return 4 * 2 ** self.portDS.logAnnounceInterval # 9.3.2.4.4, FOREIGN_MASTER_TIME_WINDOW
+
     def updateForeignMasterList(self, msg):
-        for fmDS in self.foreignMasterList:
-            if fmDS.foreignMasterPortIdentity == msg.sourcePortIdentity:
-                fmDS.update(msg, self.portDS)
-                break
+        """Adds the Announce to foreignMasterDS, marking the port for the next BMC if it matters"""
+        fmDS = self.foreignMasterList.get(msg.sourcePortIdentity)
+        if fmDS is None:
+            # A single Announce never qualifies a foreign master
+            self.foreignMasterList[msg.sourcePortIdentity] = ForeignMasterDS(msg, self.portDS)
         else:
-            self.foreignMasterList.add(ForeignMasterDS(msg, self.portDS))
+            threshold = time.monotonic() - self.foreignMasterWindow()
+            was_qualified = fmDS.qualified(threshold)
+            changed = fmDS.update(msg, self.portDS)
+            if fmDS.qualified(threshold) != was_qualified or (changed and was_qualified):
+                self.bmc_dirty = True
 
     def calc_e_rbest(self):
+        """Returns True if e_rbest or the port state it was last computed for changed"""
         # FIX: Remove master from foreignMasterList(?)
         # print("[BMC] (%d) Calculating E rbest" % (self.portDS.portIdentity.portNumber))
-        announceInterval = 2 ** self.portDS.logAnnounceInterval
-        ts_threshold = time.monotonic() - (4 * announceInterval)
-        qualified = [
-            fmDS.entry for fmDS in self.foreignMasterList
-            if len([ts for ts in fmDS.timestamps if ts > ts_threshold]) == 2
-            and fmDS.entry.steps_removed < 255
-        ]
-        if self.portDS.portState == ptp.PTP_STATE.SLAVE and self.e_rbest and self.e_rbest not in qualified:
-            qualified.append(self.e_rbest)
-
-        e_rbest = None if len(qualified) == 0 else qualified[0]
-        for i in range(1, len(qualified)):
-            e_rbest = e_rbest if e_rbest.compare(qualified[i]) < 0 else qualified[i]
-
-        if e_rbest: qualified.remove(e_rbest)
-        for fmDS in self.foreignMasterList:
-            if fmDS.entry in qualified: self.foreignMasterList.remove(fmDS)
+        window = self.foreignMasterWindow()
+        qualified = [fmDS for fmDS in self.foreignMasterList.values() if fmDS.qualified(time.monotonic() - window)]
+        entries = [fmDS.entry for fmDS in qualified]
+        if self.portDS.portState == ptp.PTP_STATE.SLAVE and self.e_rbest and self.e_rbest not in entries:
+            entries.append(self.e_rbest)
+
+        e_rbest = None if len(entries) == 0 else entries[0]
+        for i in range(1, len(entries)):
+            e_rbest = e_rbest if e_rbest.compare(entries[i]) < 0 else entries[i]
+
+        self.bmc_deadline = math.inf
+        for fmDS in qualified:
+            if fmDS.entry is e_rbest:
+                self.bmc_deadline = fmDS.timestamps[0] + window
+            else:
+                del self.foreignMasterList[fmDS.foreignMasterPortIdentity]
 
+        key = e_rbest.key if e_rbest else None
+        changed = self.bmc_dirty or key != self.e_rbest_key
         self.e_rbest = e_rbest
+        self.e_rbest_key = key
+        self.bmc_dirty = False
+        return changed
 
     def changeState(self, state=None):
         if state:
@@ -261,6 +395,7 @@ class Port:
             if self.next_state:
                 print("[STATE] (%d) %s -> %s" % (portNumber, self.portDS.portState.name, self.next_state.name))
                 self.portDS.portState = self.next_state
+                self.bmc_dirty = True
 
             # 9.2.6.11
             if self.next_state in (PTP_STATE.LISTENING, PTP_STATE.UNCALIBRATED, PTP_STATE.SLAVE, PTP_STATE.PASSIVE):
@@ -284,20 +419,27 @@ class Port:
 
         self.next_state = None
 
-    def synchronize(self):
+    def synchronize(self, sync_data):
         offsetFromMaster = None
 
         if self.portDS.delayMechanism == PTP_DELAY_MECH.E2E:
-            meanPathDelay = self.delay.calcMeanPathDelay(self.sync_data)
-            if meanPathDelay is not None:
-                offsetFromMaster = self.sync_data.calcOffsetFromMaster(meanPathDelay)
-                self.clock.currentDS.meanPathDelay = meanPathDelay
+            if self.delay is None:
+                print("[WARN] E2E mean path delay calculation not ready")
+            else:
+                meanPathDelay = self.delay.calcMeanPathDelay(sync_data)
+                if meanPathDelay is not None:
+                    meanPathDelay = self.delay_filter.update(meanPathDelay)
+                    offsetFromMaster = sync_data.calcOffsetFromMaster(meanPathDelay)
+                    self.clock.currentDS.meanPathDelay = meanPathDelay
         elif self.portDS.delayMechanism == PTP_DELAY_MECH.P2P:
             if self.portDS.peerMeanPathDelay:
-                offsetFromMaster = self.sync_data.calcOffsetFromMaster(self.portDS.peerMeanPathDelay)
+                offsetFromMaster = sync_data.calcOffsetFromMaster(self.portDS.peerMeanPathDelay)
 
         if offsetFromMaster is not None:
+            logSyncInterval = sync_data.sync.logMessageInterval
+            if logSyncInterval == 0x7F: logSyncInterval = self.portDS.logSyncInterval # Unicast, 13.3.2.11
             self.clock.currentDS.offsetFromMaster = offsetFromMaster
+            self.clock.discipline(offsetFromMaster, sync_data.syncEventIngressTimestamp, 2 ** logSyncInterval)
 
     ## Events ##
 
@@ -354,10 +496,9 @@ class Port:
         portNumber = self.portDS.portIdentity.portNumber
         print("[EVENT] (%d) ANNOUNCE_RECEIPT_TIMEOUT_EXPIRES" % (portNumber))
         valid_states = (PTP_STATE.LISTENING, PTP_STATE.UNCALIBRATED, PTP_STATE.SLAVE, PTP_STATE.PASSIVE)
-        peer_ports = {port for port in self.clock.portList.values() if port is not self}
 
         if self.portDS.portState in valid_states:
-            if PTP_STATE.SLAVE in [port.portDS.portState for port in peer_ports]:
+            if PTP_STATE.SLAVE in self.clock.peerPortStates(self):
                 self.clock.updateM3()
             else:
                 self.clock.updateM1M2()
@@ -372,90 +513,126 @@ class Port:
         egress_timestamp = self.clock.transport.send_message(msg, portNumber, get_timestamp)
         return egress_timestamp
 
-    def send_Announce(self):
-        if self.portDS.portState == PTP_STATE.MASTER:
-            msg = ptp.Announce()
+    def send_template(self, template, get_timestamp=False):
+        portNumber = self.portDS.portIdentity.portNumber
+        print("[SEND] (%d) %s" % (portNumber, template.messageType.name))
+        egress_timestamp = self.clock.transport.send_frame(template.frame, portNumber, get_timestamp, sequenceId=template.sequenceId)
+        return egress_timestamp
 
-            # Header fields
-            msg.messageType = ptp.PTP_MESG_TYPE.ANNOUNCE
-            msg.versionPTP = self.portDS.versionNumber
-            msg.messageLength = ptp.Header.parser.size + msg.parser.size
-            msg.domainNumber = self.clock.defaultDS.domainNumber
-            msg.flagField.profile1 = False
-            msg.flagField.profile2 = False
-            msg.flagField.leap61 = self.clock.timePropertiesDS.leap61
-            msg.flagField.leap59 = self.clock.timePropertiesDS.leap59
-            msg.flagField.currentUtcOffsetValid = self.clock.timePropertiesDS.currentUtcOffsetValid
-            msg.flagField.ptpTimescale = self.clock.timePropertiesDS.ptpTimescale
-            msg.flagField.timeTraceable = self.clock.timePropertiesDS.timeTraceable
-            msg.flagField.frequencyTraceable = self.clock.timePropertiesDS.frequencyTraceable
-            msg.correctionField = 0
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
-            msg.sequenceId = self.getSequenceId(PTP_MESG_TYPE.ANNOUNCE)
-            msg.controlField = 0x05
-            msg.logMessageInterval = self.portDS.logAnnounceInterval
-
-            # Announce fields
-            msg.originTimestamp.secondsField = 0 # UInt48
-            msg.originTimestamp.nanosecondsField = 0 # UInt32
-            msg.currentUtcOffset = self.clock.timePropertiesDS.currentUtcOffset # Int16
-            msg.grandmasterPriority1 = self.clock.parentDS.grandmasterPriority1 # UInt8
-            msg.grandmasterClockQuality = copy(self.clock.parentDS.grandmasterClockQuality)
-            msg.grandmasterPriority2 = self.clock.parentDS.grandmasterPriority1 # UInt8
-            msg.grandmasterIdentity = self.clock.parentDS.grandmasterIdentity # Octet[8]
-            msg.stepsRemoved = self.clock.currentDS.stepsRemoved # UInt16
-            msg.timeSource = self.clock.timePropertiesDS.timeSource # Enum8
+    def on_egress_timestamp(self, egress_timestamp, callback):
+        """Calls callback(timestamp) once the egress timestamp future resolves"""
+        portNumber = self.portDS.portIdentity.portNumber
 
-            self.send_message(msg)
+        def done(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                print("[WARN] (%d) Egress timestamp unavailable: %s" % (portNumber, future.exception()))
+            else:
+                callback(future.result())
 
-    def send_Sync(self):
-        if self.portDS.portState == PTP_STATE.MASTER:
-            msg = ptp.Sync()
+        egress_timestamp.add_done_callback(done)
 
-            # Header fields
-            msg.messageType = ptp.PTP_MESG_TYPE.SYNC
-            msg.versionPTP = self.portDS.versionNumber
-            msg.messageLength = ptp.Header.parser.size + msg.parser.size
-            msg.domainNumber = self.clock.defaultDS.domainNumber
-            msg.flagField.twoStepFlag = self.clock.defaultDS.twoStepFlag
-            msg.flagField.profile1 = False
-            msg.flagField.profile2 = False
-            msg.correctionField = 0
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
-            msg.sequenceId = self.getSequenceId(PTP_MESG_TYPE.SYNC)
-            msg.controlField = 0x00
-            msg.logMessageInterval = self.portDS.logSyncInterval
+    def send_Announce(self):
+        if self.portDS.portState == PTP_STATE.MASTER:
+            template = self.getTemplate(PTP_MESG_TYPE.ANNOUNCE, self.build_Announce)
+            template.set_sequenceId(self.getSequenceId(PTP_MESG_TYPE.ANNOUNCE))
+            self.send_template(template)
+
+    def build_Announce(self):
+        msg = ptp.Announce()
+
+        # Header fields
+        msg.messageType = ptp.PTP_MESG_TYPE.ANNOUNCE
+        msg.versionPTP = self.portDS.versionNumber
+        msg.messageLength = ptp.Header.parser.size + msg.parser.size
+        msg.domainNumber = self.clock.defaultDS.domainNumber
+        msg.flagField.profile1 = False
+        msg.flagField.profile2 = False
+        msg.flagField.leap61 = self.clock.timePropertiesDS.leap61
+        msg.flagField.leap59 = self.clock.timePropertiesDS.leap59
+        msg.flagField.currentUtcOffsetValid = self.clock.timePropertiesDS.currentUtcOffsetValid
+        msg.flagField.ptpTimescale = self.clock.timePropertiesDS.ptpTimescale
+        msg.flagField.timeTraceable = self.clock.timePropertiesDS.timeTraceable
+        msg.flagField.frequencyTraceable = self.clock.timePropertiesDS.frequencyTraceable
+        msg.correctionField = 0
+        msg.sourcePortIdentity = self.portDS.portIdentity
+        msg.sequenceId = 0 # Patched by send_Announce
+        msg.controlField = 0x05
+        msg.logMessageInterval = self.portDS.logAnnounceInterval
+
+        # Announce fields
+        msg.originTimestamp = ptp.TimeStamp(0)
+        msg.currentUtcOffset = self.clock.timePropertiesDS.currentUtcOffset # Int16
+        msg.grandmasterPriority1 = self.clock.parentDS.grandmasterPriority1 # UInt8
+        msg.grandmasterClockQuality = copy(self.clock.parentDS.grandmasterClockQuality)
+        msg.grandmasterPriority2 = self.clock.parentDS.grandmasterPriority1 # UInt8
+        msg.grandmasterIdentity = self.clock.parentDS.grandmasterIdentity # Octet[8]
+        msg.stepsRemoved = self.clock.currentDS.stepsRemoved # UInt16
+        msg.timeSource = self.clock.timePropertiesDS.timeSource # Enum8
+
+        return msg
 
-            # Sync Fields
-            msg.originTimestamp.secondsField = 0
-            msg.originTimestamp.nanosecondsField = 0
+    def send_Sync(self):
+        if self.portDS.portState == PTP_STATE.MASTER:
+            template = self.getTemplate(PTP_MESG_TYPE.SYNC, self.build_Sync)
+            sequenceId = self.getSequenceId(PTP_MESG_TYPE.SYNC)
+            template.set_sequenceId(sequenceId)
 
-            egress_timestamp = self.send_message(msg, True)
+            egress_timestamp = self.send_template(template, True)
 
             if self.clock.defaultDS.twoStepFlag:
-                self.send_Follow_Up(msg.sequenceId, egress_timestamp)
+                self.on_egress_timestamp(egress_timestamp, lambda sync_ets: self.send_Follow_Up(sequenceId, sync_ets))
+
+    def build_Sync(self):
+        msg = ptp.Sync()
+
+        # Header fields
+        msg.messageType = ptp.PTP_MESG_TYPE.SYNC
+        msg.versionPTP = self.portDS.versionNumber
+        msg.messageLength = ptp.Header.parser.size + msg.parser.size
+        msg.domainNumber = self.clock.defaultDS.domainNumber
+        msg.flagField.twoStepFlag = self.clock.defaultDS.twoStepFlag
+        msg.flagField.profile1 = False
+        msg.flagField.profile2 = False
+        msg.correctionField = 0
+        msg.sourcePortIdentity = self.portDS.portIdentity
+        msg.sequenceId = 0 # Patched by send_Sync
+        msg.controlField = 0x00
+        msg.logMessageInterval = self.portDS.logSyncInterval
+
+        # Sync Fields
+        msg.originTimestamp = ptp.TimeStamp(0)
+
+        return msg
 
     def send_Follow_Up(self, sequenceId, sync_ets):
         if self.portDS.portState == PTP_STATE.MASTER:
-            msg = ptp.Follow_Up()
-
-            # Header fields
-            msg.messageType = PTP_MESG_TYPE.FOLLOW_UP
-            msg.versionPTP = self.portDS.versionNumber
-            msg.messageLength = ptp.Header.parser.size + msg.parser.size
-            msg.domainNumber = self.clock.defaultDS.domainNumber
-            msg.flagField.profile1 = False
-            msg.flagField.profile2 = False
-            msg.correctionField = 0
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
-            msg.sequenceId = sequenceId
-            msg.controlField = 0x02
-            msg.logMessageInterval = self.portDS.logSyncInterval
-
-            # Follow_Up fields
-            msg.preciseOriginTimestamp = ptp.TimeStamp(sync_ets)
-
-            self.send_message(msg)
+            template = self.getTemplate(PTP_MESG_TYPE.FOLLOW_UP, self.build_Follow_Up)
+            template.set_sequenceId(sequenceId)
+            template.set_timestamp(sync_ets)
+            self.send_template(template)
+
+    def build_Follow_Up(self):
+        msg = ptp.Follow_Up()
+
+        # Header fields
+        msg.messageType = PTP_MESG_TYPE.FOLLOW_UP
+        msg.versionPTP = self.portDS.versionNumber
+        msg.messageLength = ptp.Header.parser.size + msg.parser.size
+        msg.domainNumber = self.clock.defaultDS.domainNumber
+        msg.flagField.profile1 = False
+        msg.flagField.profile2 = False
+        msg.correctionField = 0
+        msg.sourcePortIdentity = self.portDS.portIdentity
+        msg.sequenceId = 0 # Patched by send_Follow_Up
+        msg.controlField = 0x02
+        msg.logMessageInterval = self.portDS.logSyncInterval
+
+        # Follow_Up fields
+        msg.preciseOriginTimestamp = ptp.TimeStamp(0) # Patched by send_Follow_Up
+
+        return msg
 
     def send_Delay_Req(self):
         """9.5.11, 11.3"""
@@ -476,7 +653,7 @@ class Port:
                 msg.flagField.profile1 = False
                 msg.flagField.profile2 = False
                 msg.correctionField = 0
-                msg.sourcePortIdentity = copy(self.portDS.portIdentity)
+                msg.sourcePortIdentity = self.portDS.portIdentity
                 msg.sequenceId = self.getSequenceId(msg.messageType)
                 msg.controlField = 0x01 # 13.3.2.10, Table 23
                 msg.logMessageInterval = 0x7F # 13.3.2.11, Table 24
@@ -485,7 +662,9 @@ class Port:
                 msg.originTimestamp = ptp.TimeStamp(0)
 
                 delay_req_ets = self.send_message(msg, True)
-                self.delay = Delay(msg, delay_req_ets)
+                delay = Delay(msg, None) # t3 is filled in once the egress timestamp is read
+                self.delays.add(msg.sequenceId, delay)
+                self.on_egress_timestamp(delay_req_ets, delay.set_t3)
 
     def send_Delay_Resp(self, delay_req, delay_req_its):
         """9.5.12, 11.3"""
@@ -500,7 +679,7 @@ class Port:
             msg.flagField.profile1 = False
             msg.flagField.profile2 = False
             msg.correctionField = delay_req.correctionField
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
+            msg.sourcePortIdentity = self.portDS.portIdentity
             msg.sequenceId = delay_req.sequenceId # 11.3.2
             msg.controlField = 0x03 # 13.3.2.10, Table 23
             msg.logMessageInterval = self.portDS.logMinDelayReqInterval # 13.3.2.11, Table 24
@@ -518,27 +697,42 @@ class Port:
             print("[WARN] Delay Mechanism mis-match")
             self.pdelay_req_timer.stop()
         else:
-            msg = ptp.Pdelay_Req()
-
-            # Header fields
-            msg.messageType = ptp.PTP_MESG_TYPE.PDELAY_REQ
-            msg.versionPTP = self.portDS.versionNumber
-            msg.messageLength = ptp.Header.parser.size + msg.parser.size
-            msg.domainNumber = self.clock.defaultDS.domainNumber
-            msg.flagField.profile1 = False
-            msg.flagField.profile2 = False
-            msg.correctionField = 0
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
-            msg.sequenceId = self.getSequenceId(msg.messageType)
-            msg.controlField = 0x05 # 13.3.2.10, Table 23
-            msg.logMessageInterval = 0x7F # 13.3.2.11, Table 24
-
-            # Pdelay_Req fields
-            msg.originTimestamp = ptp.TimeStamp(0) # 11.4.3
+            template = self.getTemplate(PTP_MESG_TYPE.PDELAY_REQ, self.build_Pdelay_Req)
+            sequenceId = self.getSequenceId(PTP_MESG_TYPE.PDELAY_REQ)
+            template.set_sequenceId(sequenceId)
 
             # Timing
-            egress_timestamp = self.send_message(msg, True)
-            self.pdelay = Pdelay(msg, egress_timestamp)
+            egress_timestamp = self.send_template(template, True)
+            pdelay = Pdelay(sequenceId, None) # t1 is filled in once the egress timestamp is read
+            self.pdelays.add(sequenceId, pdelay)
+            self.on_egress_timestamp(egress_timestamp, lambda t1: self.pdelay_req_timestamped(pdelay, t1))
+
+    def pdelay_req_timestamped(self, pdelay, t1):
+        pdelay.t1 = t1
+        # The response may have arrived before the egress timestamp was read
+        if pdelay.ready():
+            self.updatePeerMeanPathDelay(pdelay)
+
+    def build_Pdelay_Req(self):
+        msg = ptp.Pdelay_Req()
+
+        # Header fields
+        msg.messageType = ptp.PTP_MESG_TYPE.PDELAY_REQ
+        msg.versionPTP = self.portDS.versionNumber
+        msg.messageLength = ptp.Header.parser.size + msg.parser.size
+        msg.domainNumber = self.clock.defaultDS.domainNumber
+        msg.flagField.profile1 = False
+        msg.flagField.profile2 = False
+        msg.correctionField = 0
+        msg.sourcePortIdentity = self.portDS.portIdentity
+        msg.sequenceId = 0 # Patched by send_Pdelay_Req
+        msg.controlField = 0x05 # 13.3.2.10, Table 23
+        msg.logMessageInterval = 0x7F # 13.3.2.11, Table 24
+
+        # Pdelay_Req fields
+        msg.originTimestamp = ptp.TimeStamp(0) # 11.4.3
+
+        return msg
 
     def send_Pdelay_Resp(self, pdelay_req, pdelay_req_its):
         """11.4.3"""
@@ -556,7 +750,7 @@ class Port:
             msg.flagField.profile1 = False
             msg.flagField.profile2 = False
             msg.correctionField = 0
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
+            msg.sourcePortIdentity = self.portDS.portIdentity
             msg.sequenceId = pdelay_req.sequenceId # 11.4.3
             msg.controlField = 0x05 # 13.3.2.10, Table 23
             msg.logMessageInterval = 0x7F # 13.3.2.11, Table 24
@@ -568,9 +762,9 @@ class Port:
             if self.clock.defaultDS.twoStepFlag:
                 msg.requestReceiptTimestamp = ptp.TimeStamp(pdelay_req_its)
                 pdelay_resp_ets = self.send_message(msg, True)
-                self.send_Pdelay_Resp_Follow_Up(pdelay_req, pdelay_resp_ets)
+                self.on_egress_timestamp(pdelay_resp_ets, lambda ets: self.send_Pdelay_Resp_Follow_Up(pdelay_req, ets))
             else:
-                msg.requestReceiptTimestamp = 0
+                msg.requestReceiptTimestamp = ptp.TimeStamp(0)
                 # TODO: send message, updating the correctionField with the residence time
                 raise NotImplementedError("One-step Pdelay_Resp sending not implemented.")
 
@@ -589,7 +783,7 @@ class Port:
             msg.flagField.profile1 = False
             msg.flagField.profile2 = False
             msg.correctionField = pdelay_req.correctionField
-            msg.sourcePortIdentity = copy(self.portDS.portIdentity)
+            msg.sourcePortIdentity = self.portDS.portIdentity
             msg.sequenceId = pdelay_req.sequenceId # 11.4.3
             msg.controlField = 0x05 # 13.3.2.10, Table 23
             msg.logMessageInterval = 0x7F # 13.3.2.11, Table 24
@@ -603,39 +797,39 @@ class Port:
     ## Receive Messages ##
 
     def process_message(self, buffer, ingress_timestamp):
-        hdr = ptp.Header(buffer)
-        portNumber = self.portDS.portIdentity.portNumber
-
-        if hdr.domainNumber != self.clock.defaultDS.domainNumber:
-            print("[INFO] Ignoring inter domain PTP message")
-        elif hdr.sourcePortIdentity.clockIdentity == self.clock.defaultDS.clockIdentity:
-            if hdr.sourcePortIdentity == self.portDS.portIdentity:
-                print("[WARN] (%d) Message received by sending port" % (portNumber))
-            else:
-                print("[WARN] (%d) Message received by sending clock" % (portNumber))
-                # FIX: put all but lowest numbered port in PASSIVE state
-        else:
-            if hdr.messageType == ptp.PTP_MESG_TYPE.ANNOUNCE:
-                self.recv_Announce(ptp.Announce(buffer))
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.SYNC:
-                self.recv_Sync(ptp.Sync(buffer), ingress_timestamp)
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.FOLLOW_UP:
-                self.recv_Follow_Up(ptp.Follow_Up(buffer))
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.DELAY_REQ:
-                self.recv_Delay_Req(ptp.Delay_Req(buffer), ingress_timestamp)
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.DELAY_RESP:
-                self.recv_Delay_Resp(ptp.Delay_Resp(buffer))
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.PDELAY_REQ:
-                self.recv_Pdelay_Req(ptp.Pdelay_Req(buffer), ingress_timestamp)
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.PDELAY_RESP:
-                self.recv_Pdelay_Resp(ptp.Pdelay_Resp(buffer), ingress_timestamp)
-            elif hdr.messageType == ptp.PTP_MESG_TYPE.PDELAY_RESP_FOLLOW_UP:
-                self.recv_Pdelay_Resp_Follow_Up(ptp.Pdelay_Resp_Follow_Up(buffer))
-            else:
-                raise NotImplementedError("Message Type Not Implemented: %d" % (hdr.messageType))
+        # Foreign domain, looped back and unknown messages are dropped by OrdinaryClock.message_filter.
+        # The same view is handed to the message constructors so the header is only decoded once.
+        hdr = ptp.HeaderView(buffer)
+        messageType = hdr.messageType
+
+        if messageType == ptp.PTP_MESG_TYPE.ANNOUNCE:
+            self.recv_Announce(ptp.Announce(hdr))
+        elif messageType == ptp.PTP_MESG_TYPE.SYNC:
+            self.recv_Sync(ptp.Sync(hdr), ingress_timestamp)
+        elif messageType == ptp.PTP_MESG_TYPE.FOLLOW_UP:
+            self.recv_Follow_Up(ptp.Follow_Up(hdr))
+        elif messageType == ptp.PTP_MESG_TYPE.DELAY_REQ:
+            self.recv_Delay_Req(ptp.Delay_Req(hdr), ingress_timestamp)
+        elif messageType == ptp.PTP_MESG_TYPE.DELAY_RESP:
+            self.recv_Delay_Resp(ptp.Delay_Resp(hdr))
+        elif messageType == ptp.PTP_MESG_TYPE.PDELAY_REQ:
+            self.recv_Pdelay_Req(ptp.Pdelay_Req(hdr), ingress_timestamp)
+        elif messageType == ptp.PTP_MESG_TYPE.PDELAY_RESP:
+            self.recv_Pdelay_Resp(ptp.Pdelay_Resp(hdr), ingress_timestamp)
+        elif messageType == ptp.PTP_MESG_TYPE.PDELAY_RESP_FOLLOW_UP:
+            self.recv_Pdelay_Resp_Follow_Up(ptp.Pdelay_Resp_Follow_Up(hdr))
+        elif messageType == ptp.PTP_MESG_TYPE.SIGNALING:
+            self.recv_Signaling(ptp.Signaling(hdr))
+        elif messageType == ptp.PTP_MESG_TYPE.MANAGEMENT:
+            self.recv_Management(ptp.Management(hdr))
 
     def recv_Announce(self, msg):
         portNumber = self.portDS.portIdentity.portNumber
+        for tlv in msg.tlvs(ptp.TLV_TYPE.PATH_TRACE):
+            if self.clock.defaultDS.clockIdentity in tlv.pathSequence:
+                print("[RECV] (%d) Announce Discarded (Path Trace Loop)" % (portNumber)) # 16.2.5
+                return
+
         self.announceReceiptTimeoutTimer.restart()
         if self.portDS.portState in (ptp.PTP_STATE.INITIALIZING, PTP_STATE.DISABLED, PTP_STATE.FAULTY):
             print("[RECV] (%d) Announce Ignored (%s)" % (portNumber, self.portDS.portState.name))
@@ -646,6 +840,15 @@ class Port:
             print("[RECV] (%d) Announce Received Foreign Master" % (portNumber))
             self.updateForeignMasterList(msg)
 
+    def recv_Signaling(self, msg):
+        portNumber = self.portDS.portIdentity.portNumber
+        tlvTypes = [tlv.tlvType for tlv in msg.tlvs()]
+        print("[RECV] (%d) Signaling Ignored (TLVs: %s)" % (portNumber, ', '.join('0x%04x' % (t) for t in tlvTypes)))
+
+    def recv_Management(self, msg):
+        portNumber = self.portDS.portIdentity.portNumber
+        print("[RECV] (%d) Management Ignored (Not Implemented)" % (portNumber))
+
     def recv_Sync(self, msg, sync_its):
         portNumber = self.portDS.portIdentity.portNumber
         if self.portDS.portState not in (PTP_STATE.SLAVE, PTP_STATE.UNCALIBRATED):
@@ -654,10 +857,17 @@ class Port:
             print("[RECV] (%d) Sync Ignored (Not Parent)" % (portNumber))
         else:
             print("[RECV] (%d) Sync Received" % (portNumber))
-            self.sync_data = Sync_Data(msg, sync_its)
+            sync_data = Sync_Data(msg, sync_its)
 
             if not msg.flagField.twoStepFlag:
-                self.synchronize()
+                self.synchronize(sync_data)
+            else:
+                follow_up = self.follow_ups.pop(msg.sequenceId)
+                if follow_up is not None and follow_up.sourcePortIdentity == msg.sourcePortIdentity:
+                    sync_data.follow_up = follow_up
+                    self.synchronize(sync_data)
+                else:
+                    self.syncs.add(msg.sequenceId, sync_data)
 
     def recv_Follow_Up(self, msg):
         portNumber = self.portDS.portIdentity.portNumber
@@ -666,15 +876,17 @@ class Port:
             print("[RECV] (%d) Ignoring Follow Up due to state" % (portNumber))
         elif self.portDS.portState not in (PTP_STATE.SLAVE, PTP_STATE.UNCALIBRATED):
             print("[RECV] (%d) Ignoring Follow Up due to state" % (portNumber))
-        elif self.sync_data.sync is None or \
-            msg.sourcePortIdentity != self.sync_data.sync.sourcePortIdentity or \
-            msg.sequenceId != self.sync_data.sync.sequenceId:
-            print("[RECV] (%d) Ignoring Unexpected Follow_Up" % (portNumber))
         elif msg.sourcePortIdentity != self.clock.parentDS.parentPortIdentity:
             print("[RECV] (%d) Ignoring Follow_Up from unknown master" % (portNumber))
         else:
-            self.sync_data.follow_up = msg
-            self.synchronize()
+            sync_data = self.syncs.pop(msg.sequenceId)
+            if sync_data is None:
+                self.follow_ups.add(msg.sequenceId, msg) # Wait for the Sync
+            elif msg.sourcePortIdentity != sync_data.sync.sourcePortIdentity:
+                print("[RECV] (%d) Ignoring Unexpected Follow_Up" % (portNumber))
+            else:
+                sync_data.follow_up = msg
+                self.synchronize(sync_data)
 
     def recv_Delay_Req(self, msg, delay_req_its):
         portNumber = self.portDS.portIdentity.portNumber
@@ -689,13 +901,15 @@ class Port:
         print("[RECV] (%d) Delay_Resp" % (portNumber))
         if self.portDS.portState not in (PTP_STATE.SLAVE, PTP_STATE.UNCALIBRATED):
             print("[RECV] (%d) Ignoring Delay_Resp due to state" % (portNumber))
-        elif msg.requestingPortIdentity != self.delay.req.sourcePortIdentity \
-            or msg.sequenceId != self.delay.req.sequenceId:
+        elif msg.requestingPortIdentity != self.portDS.portIdentity or self.delays.get(msg.sequenceId) is None:
             print("[RECV] (%d) Ignoring Unexpected Delay_Resp" % (portNumber))
         elif msg.sourcePortIdentity != self.clock.parentDS.parentPortIdentity:
             print("[RECV] (%d) Ignoring Delay_Resp from non-Master" % (portNumber))
         else:
-            self.delay.resp = msg
+            delay = self.delays.pop(msg.sequenceId)
+            delay.resp = msg
+            if self.delay is None or ((delay.req.sequenceId - self.delay.req.sequenceId) & 0xFFFF) < 0x8000:
+                self.delay = delay # Keep the newest, a late response may complete an older request
             # self.delay.calcMeanPathDelay() # Moved to first step of offset calculation
             self.portDS.logMinDelayReqInterval = msg.logMessageInterval
 
@@ -703,29 +917,67 @@ class Port:
         print("[RECV] (%d) %s" % (self.portDS.portIdentity.portNumber, msg.messageType.name))
         self.send_Pdelay_Resp(msg, pdelay_req_its)
 
-    def recv_Pdelay_Resp(self, msg, pdelay_resp_its):
-        print("[RECV] (%d) %s" % (self.portDS.portIdentity.portNumber, msg.messageType.name))
-        self.pdelay.resp = msg
-        self.pdelay.t4 = pdelay_resp_its
+    def updatePeerMeanPathDelay(self, pdelay):
+        """Updates neighborRateRatio from a completed exchange, then the filtered peerMeanPathDelay"""
+        peer_timestamps = pdelay.peer_timestamps()
+        if peer_timestamps:
+            if pdelay.resp.sourcePortIdentity != self.rate_ratio_peer:
+                self.rate_ratio.reset()
+                self.rate_ratio_peer = pdelay.resp.sourcePortIdentity
+            neighborRateRatio = self.rate_ratio.update(pdelay.t1, *peer_timestamps, pdelay.t4)
+            if neighborRateRatio is not None:
+                self.portDS.neighborRateRatio = neighborRateRatio
+
+        meanPathDelay = pdelay.calcMeanPathDelay(self.portDS.neighborRateRatio)
+        if meanPathDelay is not None:
+            self.portDS.peerMeanPathDelay = self.delay_filter.update(meanPathDelay)
 
-        if not msg.flagField.twoStepFlag:
-            self.portDS.peerMeanPathDelay = self.pdelay.calcMeanPathDelay()
+    def recv_Pdelay_Resp(self, msg, pdelay_resp_its):
+        portNumber = self.portDS.portIdentity.portNumber
+        print("[RECV] (%d) %s" % (portNumber, msg.messageType.name))
+        pdelay = self.pdelays.get(msg.sequenceId)
+        if msg.requestingPortIdentity != self.portDS.portIdentity or pdelay is None or pdelay.resp is not None:
+            print("[RECV] (%d) Ignoring Unexpected Pdelay_Resp" % (portNumber))
+            return
+        pdelay.resp = msg
+        pdelay.t4 = pdelay_resp_its
+
+        # The Follow_Up may have overtaken the response
+        if pdelay.ready():
+            self.updatePeerMeanPathDelay(pdelay)
 
     def recv_Pdelay_Resp_Follow_Up(self, msg):
-        print("[RECV] (%d) %s" % (self.portDS.portIdentity.portNumber, msg.messageType.name))
-        self.pdelay.resp_follow_up = msg
-        self.portDS.peerMeanPathDelay = self.pdelay.calcMeanPathDelay()
+        portNumber = self.portDS.portIdentity.portNumber
+        print("[RECV] (%d) %s" % (portNumber, msg.messageType.name))
+        pdelay = self.pdelays.get(msg.sequenceId)
+        if msg.requestingPortIdentity != self.portDS.portIdentity or pdelay is None or pdelay.resp_follow_up is not None:
+            print("[RECV] (%d) Ignoring Unexpected Pdelay_Resp_Follow_Up" % (portNumber))
+            return
+        pdelay.resp_follow_up = msg
+        if pdelay.ready():
+            self.updatePeerMeanPathDelay(pdelay)
 
 class OrdinaryClock:
-    def __init__(self, profile, clockIdentity, interface, driver_name, driver_config):
+    def __init__(self, profile, clockIdentity, interface, driver_name, driver_config, rx_queue_depth=RX_QUEUE_DEPTH, rx_queue_drop=QUEUE_DROP.HEAD, rx=True, servo=None, delay_filters=None):
         print("[INFO] Clock ID: %s" % (clockIdentity.hex()))
         print("[EVENT] (*) POWERUP")
         print("[STATE] (*) INITIALIZING")
-        self.transport = Transport(interface, driver_name, driver_config)
+        self.transport = Transport(interface, driver_name, driver_config, rx, clock_seed=clockIdentity)
+        self.transport.enable_queues(rx_queue_depth, rx_queue_drop)
+        self.transport.clock.on_step = self.clockStepped
+        self.workers = []
         self.defaultDS = DefaultDS(profile, clockIdentity, self.transport.number_of_ports)
         self.currentDS = CurrentDS()
         self.parentDS = ParentDS(self.defaultDS)
         self.timePropertiesDS = TimePropertiesDS()
+        self.servo = servo or PI_Servo()
+        self.delay_filters = delay_filters or {} # portNumber -> filter spec, 0 for all ports
+        self.message_filter = ptp.Message_Filter(self.defaultDS.domainNumber, self.defaultDS.clockIdentity)
+        self.reported_drops = {}
+        self.reported_queue_drops = {}
+        self.message_errors = collections.Counter() # 'MESSAGE_TYPE: Exception' -> messages
+        self.reported_errors = {}
+        self.bmc_key = None # (D0, e_best) comparison keys at the last state decision
         self.portList = {}
         for i in range(self.transport.number_of_ports):
             self.portList[i+1] = Port(profile, self, i + 1)
@@ -768,12 +1020,16 @@ class OrdinaryClock:
 
     ## Data Set Updates ##
 
+    def invalidateTemplates(self):
+        for port in self.portList.values():
+            port.invalidateTemplates()
+
     def updateM1M2(self):
+        self.invalidateTemplates()
         self.currentDS.stepsRemoved = 0
         self.currentDS.offsetFromMaster = 0
         self.currentDS.meanPathDelay = 0
-        self.parentDS.parentPortIdentity.clockIdentity = self.defaultDS.clockIdentity
-        self.parentDS.parentPortIdentity.portNumber = 0
+        self.parentDS.parentPortIdentity = ptp.PortIdentity(self.defaultDS.clockIdentity, 0)
         self.parentDS.grandmasterIdentity = self.defaultDS.clockIdentity
         self.parentDS.grandmasterClockQuality = self.defaultDS.clockQuality
         self.parentDS.grandmasterPriority1 = self.defaultDS.priority1
@@ -795,10 +1051,30 @@ class OrdinaryClock:
         # pylint: disable=no-self-use
         pass
 
+    def templateFields(self):
+        """The data set members the port templates are built from, see Port.invalidateTemplates"""
+        quality = self.parentDS.grandmasterClockQuality
+        return (
+            self.currentDS.stepsRemoved,
+            self.parentDS.grandmasterIdentity,
+            self.parentDS.grandmasterPriority1,
+            self.parentDS.grandmasterPriority2,
+            (quality.clockClass, quality.clockAccuracy, quality.offsetScaledLogVariance),
+            self.timePropertiesDS.currentUtcOffset,
+            self.timePropertiesDS.currentUtcOffsetValid,
+            self.timePropertiesDS.leap59,
+            self.timePropertiesDS.leap61,
+            self.timePropertiesDS.timeTraceable,
+            self.timePropertiesDS.frequencyTraceable,
+            self.timePropertiesDS.ptpTimescale,
+            self.timePropertiesDS.timeSource
+        )
+
     def updateS1(self, msg):
         master_changed = self.parentDS.parentPortIdentity != msg.sourcePortIdentity
+        template_fields = self.templateFields()
         self.currentDS.stepsRemoved = msg.stepsRemoved + 1
-        self.parentDS.parentPortIdentity = copy(msg.sourcePortIdentity)
+        self.parentDS.parentPortIdentity = msg.sourcePortIdentity
         self.parentDS.grandmasterIdentity = msg.grandmasterIdentity
         self.parentDS.grandmasterClockQuality = copy(msg.grandmasterClockQuality)
         self.parentDS.grandmasterPriority1 = msg.grandmasterPriority1
@@ -811,37 +1087,104 @@ class OrdinaryClock:
         self.timePropertiesDS.frequencyTraceable = msg.flagField.frequencyTraceable
         self.timePropertiesDS.ptpTimescale = msg.flagField.ptpTimescale
         self.timePropertiesDS.timeSource = msg.timeSource
+        if master_changed or self.templateFields() != template_fields:
+            self.invalidateTemplates()
         return master_changed
 
     ## Events ##
 
     def stateDecisionEvent(self):
-        """STATE_DECISION_EVENT 9.2.6.8"""
+        """STATE_DECISION_EVENT 9.2.6.8
+
+        Only ports marked by a foreign master or state change, or with a foreign master due to
+        lapse, recompute e_rbest. Only those ports are re-decided unless e_best or D0 changed,
+        and nothing is done if no port changed.
+        """
         print("[EVENT] (*) STATE_DECISION_EVENT")
+        self.reportDrops()
         # FIX: Abort if any port is in INITIALIZING state
-        for port in self.portList.values():
-            port.calc_e_rbest()
+        now = time.monotonic()
+        changed = [
+            port for port in self.portList.values()
+            if (port.bmc_dirty or now >= port.bmc_deadline) and port.calc_e_rbest()
+        ]
         e_best = self.get_e_best()
 
-        for port in self.portList.values():
+        bmc_key = (BMC_Entry(self.defaultDS).key, e_best.key if e_best else None)
+        if bmc_key != self.bmc_key:
+            self.bmc_key = bmc_key
+            changed = self.portList.values()
+        elif not changed:
+            return
+
+        for port in changed:
             port.state_decision_code = self.state_decision_algorithm(e_best, port)
+        codes = {portNumber: port.state_decision_code for (portNumber, port) in self.portList.items()}
+        self.applyStateDecisions(codes, e_best.msg if e_best else None)
 
-        for port in self.portList.values():
-            if port.state_decision_code in ("M1", "M2"):
+    def applyStateDecisions(self, codes, e_best_msg):
+        """Applies the data set updates for each port's decision code (9.3.5), then the recommended states of local ports"""
+        for portNumber, code in sorted(codes.items()):
+            if code in ("M1", "M2"):
                 self.updateM1M2()
-            elif port.state_decision_code == "M3":
+            elif code == "M3":
                 self.updateM3()
-            elif port.state_decision_code in ("P1", "P2"):
+            elif code in ("P1", "P2"):
                 self.updateP1P2()
-            elif port.state_decision_code == "S1":
-                port.master_changed = self.updateS1(e_best.msg)
-
-        for port in self.portList.values():
+            elif code == "S1":
+                master_changed = self.updateS1(e_best_msg)
+                if master_changed: self.servo.reset()
+                if portNumber in self.portList:
+                    self.portList[portNumber].master_changed = master_changed
+                    if master_changed: self.portList[portNumber].delay_filter.reset()
+
+        for portNumber, port in self.portList.items():
+            port.state_decision_code = codes.get(portNumber)
             port.recommendedStateEvent()
 
         for port in self.portList.values():
             port.changeState()
 
+    def discipline(self, offsetFromMaster, timestamp, syncInterval=1.0):
+        """Feeds offsetFromMaster (scaled ns) measured at timestamp (ns) to the servo and applies its output"""
+        offset = offsetFromMaster / 2**16
+        self.servo.set_interval(syncInterval)
+        frequency, state = self.servo.sample(offset, timestamp)
+        if state == SERVO_STATE.JUMP:
+            print("[SERVO] Stepping clock by %d ns" % (-round(offset)))
+            self.transport.clock.step(-round(offset)) # clockStepped follows once it is applied
+        if state != SERVO_STATE.UNLOCKED:
+            self.transport.clock.adjust_frequency(frequency)
+        print("[SERVO] %s, Offset: %0.2f ns, Frequency: %+0.1f ppb" % (state.name, offset, frequency))
+
+    def clockStepped(self):
+        """Called by the clock once a step has been applied, drops every timestamp taken before it"""
+        for port in self.portList.values():
+            port.clearTimestamps()
+        dropped = self.transport.drop_events()
+        print("[SERVO] Clock stepped, dropped %d queued event messages" % (dropped))
+
+    def delay_filter(self, portNumber):
+        return make_filter(self.delay_filters.get(portNumber, self.delay_filters.get(0, FILTER_DEFAULT)))
+
+    def peerPortStates(self, port):
+        return [peer.portDS.portState for peer in self.portList.values() if peer is not port]
+
+    def reportDrops(self):
+        dropped = dict(self.message_filter.dropped)
+        if dropped != self.reported_drops:
+            print("[INFO] (*) Dropped Messages: %s" % (', '.join('%s=%d' % (r, n) for (r, n) in sorted(dropped.items()))))
+            self.reported_drops = dropped
+        for port_number, queue in self.transport.rx_queues.items():
+            if self.reported_queue_drops.get(port_number, [0, 0]) != queue.dropped:
+                print("[INFO] (%d) Receive Queue: %s" % (port_number, queue))
+                self.reported_queue_drops[port_number] = list(queue.dropped)
+        errors = dict(self.message_errors)
+        if errors != self.reported_errors:
+            print("[INFO] (*) Message Errors: %s" % (', '.join('%s=%d' % (e, n) for (e, n) in sorted(errors.items()))))
+            self.reported_errors = errors
+        self.transport.report()
+
     def masterSelectedEvent(self, port):
         pass
 
@@ -849,9 +1192,26 @@ class OrdinaryClock:
         for port in self.portList.values():
             port.changeState(ptp.PTP_STATE.LISTENING)
 
+        self.workers = [asyncio.create_task(self.serve(port)) for port in self.portList.values()]
+        await asyncio.gather(self.transport.demux(self.message_filter.accept), *self.workers)
+
+    async def serve(self, port):
+        """Processes the messages queued for one port, event messages first
+
+        A message that fails to process is logged and counted, the port carries on with the next.
+        """
+        portNumber = port.portDS.portIdentity.portNumber
         while True:
-            buffer, msg_offset, port_number, ingress_timestamp = await self.transport.recv_message()
-            self.portList[port_number].process_message(buffer[msg_offset:], ingress_timestamp)
+            buffer, msg_offset, _, ingress_timestamp = await self.transport.recv_port(portNumber)
+            try:
+                port.process_message(memoryview(buffer)[msg_offset:], ingress_timestamp)
+            except Exception as e: # pylint: disable=broad-except
+                error = "%s: %s" % (PTP_MESG_TYPE(buffer[msg_offset] & 0x0F).name, type(e).__name__)
+                self.message_errors[error] += 1
+                print("[ERROR] (%d) Failed to process %s (%s)" % (portNumber, error, e))
+            finally:
+                self.transport.release(buffer) # Messages are decoded out of the buffer
+            await asyncio.sleep(0) # Take turns with the other ports
 
 ### Main ###
 
@@ -864,11 +1224,41 @@ async def main():
     parser.add_option("-i", "--interface", dest="interface", default='veth1')
     parser.add_option("-d", "--driver", dest="driver", default='dummy')
     parser.add_option("-c", "--driver-config", dest="driver_config")
+    parser.add_option("--event-queue", type="int", dest="event_queue", default=RX_QUEUE_DEPTH[0], help="event messages queued per port")
+    parser.add_option("--general-queue", type="int", dest="general_queue", default=RX_QUEUE_DEPTH[1], help="general messages queued per port")
+    parser.add_option("--queue-drop", type="choice", choices=["head", "tail"], dest="queue_drop", default="head", help="drop the oldest (head) or arriving (tail) message when a queue is full")
+    parser.add_option("--kp", type="float", dest="kp", default=SERVO_KP, help="servo proportional constant at a 1 s sync interval")
+    parser.add_option("--ki", type="float", dest="ki", default=SERVO_KI, help="servo integral constant at a 1 s sync interval")
+    parser.add_option("--step-threshold", type="float", dest="step_threshold", default=SERVO_STEP_THRESHOLD, help="ns of offset that unlocks the servo, 0 to never step once locked")
+    parser.add_option("--first-step-threshold", type="float", dest="first_step_threshold", default=SERVO_FIRST_STEP_THRESHOLD, help="ns of offset above which the clock is stepped when the servo locks")
+
+    parser.add_option("--transport", type="choice", choices=["ethernet", "udp4", "udp6"], dest="transport", default="ethernet", help="ethernet (Annex F), udp4 (Annex D) or udp6 (Annex E)")
+    parser.add_option("--src-mac", dest="src_mac", help="source MAC address of sent frames")
+    parser.add_option("--src-ipv4", dest="src_ipv4", help="source IPv4 address with --transport udp4")
+    parser.add_option("--src-ipv6", dest="src_ipv6", help="source IPv6 address with --transport udp6")
+    parser.add_option("--delay-filter", action="append", dest="delay_filters", default=[], metavar="[PORT=]KIND[:WINDOW]", help="path delay filter, none, min, median or pNN, for all ports or PORT")
 
     (options, _) = parser.parse_args()
+    delay_filters = {}
+    for spec in options.delay_filters:
+        port, _, spec = spec.rpartition('=')
+        try:
+            make_filter(spec)
+            delay_filters[int(port or 0)] = spec
+        except ValueError as e:
+            parser.error("--delay-filter: %s" % (e))
     pid = os.getpid()
     print("[INFO] PID: %d" % (pid))
-    clock = OrdinaryClock(ptp.PTP_PROFILE_P2P, randomClockIdentity, options.interface, options.driver, options.driver_config)
+    rx_queue_depth = (options.event_queue, options.general_queue)
+    rx_queue_drop = QUEUE_DROP[options.queue_drop.upper()]
+    servo = PI_Servo(options.kp, options.ki, options.step_threshold, options.first_step_threshold)
+    clock = OrdinaryClock(ptp.PTP_PROFILE_P2P, randomClockIdentity, options.interface, options.driver, options.driver_config, rx_queue_depth, rx_queue_drop, servo=servo, delay_filters=delay_filters)
+    try:
+        clock.transport.configure_ports(TRANSPORT_PROTO[options.transport], options.src_mac, options.src_ipv4, options.src_ipv6, clock.defaultDS.twoStepFlag)
+    except ValueError as e:
+        parser.error("--transport %s: %s" % (options.transport, e))
+    clock.invalidateTemplates()
     await clock.listen()
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main())
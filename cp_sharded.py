@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-module-docstring
+# pylint: disable=line-too-long
+# pylint: disable=too-many-arguments
+
+# Ordinary Clock with its ports sharded across worker processes. The parent process receives
+# every frame, forwards each one to the worker owning its port and runs the state decision
+# event over the e_rbest summaries the workers publish in shared memory. Workers send directly.
+# The parent's clock is the only one disciplined, workers forward the servo's adjustments to it
+# and are told in turn when it has been stepped.
+#
+#   ./cp_sharded.py -d tofino -c ports.txt -w 4
+
+from multiprocessing import shared_memory
+from optparse import OptionParser
+import asyncio
+import collections
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import ptp
+from ptp_transport import Transport, QUEUE_DROP, RX_QUEUE_DEPTH
+from ptp_datasets import DefaultDS, PortDS, BMC_Entry
+from cp import OrdinaryClock
+
+FRAME_HEADER = struct.Struct('=HQ') # port_number, ingress timestamp
+NOTICE_PORT = 0 # A FRAME_HEADER port_number carrying a CLOCK_NOTICE rather than a frame
+MAX_MSG_SIZE = 8192
+RX_BATCH_SIZE = 64
+DECISION_CODES = (None, "M1", "M2", "M3", "P1", "P2", "S1")
+
+CMD_CALC = b'C' # Publish e_rbest summaries
+CMD_READY = b'R'
+CMD_DECIDE = b'D' # Apply the published state decisions
+
+CLOCK_REQUEST = struct.Struct('=cd') # CLOCK_STEP ns or CLOCK_FREQUENCY ppb
+CLOCK_NOTICE = struct.Struct('=cqqd') # CLOCK_STEP or CLOCK_FREQUENCY, then the state of a clock that is not shared, see dummy.Clock.state
+CLOCK_STEP = b'S'
+CLOCK_FREQUENCY = b'F'
+
+def count_ports(driver_config):
+    """Number of ports the drivers map from driver_config, see Socket.map_ports"""
+    if not driver_config: return 1
+    with open(driver_config) as f:
+        return len(f.readlines())
+
+class Shard_State:
+    """Port summaries and state decisions shared by the coordinator and the workers
+
+    Each port has a slot holding its state and the Announce message behind its e_rbest, the
+    decision block holds the Announce behind e_best and one decision code per port.
+    """
+    slot = struct.Struct('=BB%ds' % (ptp.Announce.size)) # portState, has e_rbest, Announce
+    decision = struct.Struct('=B%ds' % (ptp.Announce.size)) # has e_best, Announce
+
+    def __init__(self, number_of_ports):
+        self.number_of_ports = number_of_ports
+        self.decisions_offset = (number_of_ports + 1) * self.slot.size
+        self.codes_offset = self.decisions_offset + self.decision.size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.codes_offset + number_of_ports + 1)
+        for port_number in range(1, number_of_ports + 1):
+            self.write_summary(port_number, ptp.PTP_STATE.INITIALIZING, None)
+
+    @staticmethod
+    def announce_bytes(msg):
+        return msg.bytes()[:ptp.Announce.size] if msg else b''
+
+    def write_summary(self, port_number, portState, e_rbest):
+        offset = port_number * self.slot.size
+        self.slot.pack_into(self.shm.buf, offset, portState, e_rbest is not None, self.announce_bytes(e_rbest and e_rbest.msg))
+
+    def read_summary(self, port_number):
+        """Returns (portState, Announce or None)"""
+        portState, valid, announce = self.slot.unpack_from(self.shm.buf, port_number * self.slot.size)
+        return (ptp.PTP_STATE(portState), ptp.Announce(announce) if valid else None)
+
+    def read_state(self, port_number):
+        return ptp.PTP_STATE(self.shm.buf[port_number * self.slot.size])
+
+    def write_decisions(self, codes, e_best_msg):
+        self.decision.pack_into(self.shm.buf, self.decisions_offset, e_best_msg is not None, self.announce_bytes(e_best_msg))
+        for port_number in range(1, self.number_of_ports + 1):
+            self.shm.buf[self.codes_offset + port_number] = DECISION_CODES.index(codes.get(port_number))
+
+    def read_decisions(self):
+        """Returns ({port_number: code}, e_best Announce or None)"""
+        valid, announce = self.decision.unpack_from(self.shm.buf, self.decisions_offset)
+        codes = {i: DECISION_CODES[self.shm.buf[self.codes_offset + i]] for i in range(1, self.number_of_ports + 1)}
+        return (codes, ptp.Announce(announce) if valid else None)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+## Worker ##
+
+class Shard_Receiver:
+    """Receives the frames forwarded by the dispatcher, in the form returned by a driver's recv_batch
+
+    Clock notices travel in order with the frames. One ends the batch, and is handed to
+    on_notice when the next batch is requested, once the frames received before it are queued.
+    """
+    def __init__(self, skt, on_notice):
+        self.skt = skt
+        self.skt.setblocking(False)
+        self.on_notice = on_notice
+        self.notice = None # Received at the end of the last batch
+        self.rx_free = [bytearray(MAX_MSG_SIZE) for _ in range(RX_BATCH_SIZE)] # Receive buffer pool
+
+    def rx_buffer(self):
+        return self.rx_free.pop() if self.rx_free else bytearray(MAX_MSG_SIZE)
+
+    def release(self, frame):
+        """Returns the buffer behind a frame from recv_batch to the pool, at most once per frame"""
+        self.rx_free.append(frame.obj)
+
+    async def recv_batch(self):
+        loop = asyncio.get_event_loop()
+        if self.notice:
+            notice, self.notice = self.notice, None
+            self.on_notice(*notice)
+        frames = []
+        buffer = self.rx_buffer()
+        nbytes = await loop.sock_recv_into(self.skt, buffer)
+        for i in range(RX_BATCH_SIZE):
+            if i > 0:
+                buffer = self.rx_buffer()
+                try:
+                    nbytes = self.skt.recv_into(buffer)
+                except BlockingIOError:
+                    self.rx_free.append(buffer)
+                    break
+            msg = memoryview(buffer)[:nbytes]
+            port_number, timestamp = FRAME_HEADER.unpack_from(msg)
+            if port_number == NOTICE_PORT:
+                kind, base, origin, frequency = CLOCK_NOTICE.unpack_from(msg, FRAME_HEADER.size)
+                self.rx_free.append(buffer)
+                self.notice = (kind, (base, origin, frequency))
+                break
+            frames.append((port_number, timestamp, msg[FRAME_HEADER.size:]))
+        return frames
+
+class Clock_Link:
+    """Stands in for the driver's clock in a worker, adjustments are sent to the parent to apply
+
+    The parent notices every worker once a step is applied, on_step is called then. A clock that
+    is not shared between processes is mirrored, every notice carries the parent's clock state
+    so the worker's egress timestamps stay in the parent's time base.
+    """
+    def __init__(self, skt, clock):
+        self.skt = skt
+        self.skt.setblocking(False)
+        self.clock = clock
+        self.on_step = None
+
+    def step(self, offset):
+        self.skt.send(CLOCK_REQUEST.pack(CLOCK_STEP, offset))
+
+    def adjust_frequency(self, ppb):
+        self.skt.send(CLOCK_REQUEST.pack(CLOCK_FREQUENCY, ppb))
+
+    def notice(self, kind, state):
+        """Applies a CLOCK_NOTICE from the parent"""
+        if not self.clock.shared:
+            self.clock.restore(state)
+        if kind == CLOCK_STEP and self.on_step:
+            self.on_step()
+
+class Shard_Clock(OrdinaryClock):
+    """The ports of an Ordinary Clock owned by one worker process
+
+    Data sets are replicated in every worker, each one applies the same decisions in the same
+    order. Only the owned ports process messages and change state.
+    """
+    def __init__(self, profile, clockIdentity, interface, driver_name, driver_config, ports, state, frames, control, clock_link, rx_queue_depth=RX_QUEUE_DEPTH, rx_queue_drop=QUEUE_DROP.HEAD):
+        self.state = state
+        self.control = control
+        self.control.setblocking(False)
+        OrdinaryClock.__init__(self, profile, clockIdentity, interface, driver_name, driver_config, rx_queue_depth, rx_queue_drop, rx=False)
+        self.state_decision_event_timer.stop() # Driven by the coordinator
+        self.portList = {portNumber: port for (portNumber, port) in self.portList.items() if portNumber in ports}
+        self.transport.clock = Clock_Link(clock_link, self.transport.clock)
+        self.transport.clock.on_step = self.clockStepped
+        self.transport.rx_source = Shard_Receiver(frames, self.transport.clock.notice)
+
+    def publish(self):
+        for portNumber, port in self.portList.items():
+            self.state.write_summary(portNumber, port.portDS.portState, port.e_rbest)
+
+    def peerPortStates(self, port):
+        return [
+            self.portList[i].portDS.portState if i in self.portList else self.state.read_state(i)
+            for i in range(1, self.state.number_of_ports + 1) if i != port.portDS.portIdentity.portNumber
+        ]
+
+    async def coordinate(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            command = await loop.sock_recv(self.control, 1)
+            if not command:
+                print("[ERROR] (*) Coordinator exited")
+                raise SystemExit(1)
+            if command == CMD_CALC:
+                self.reportDrops()
+                for port in self.portList.values():
+                    port.calc_e_rbest()
+                self.publish()
+                await loop.sock_sendall(self.control, CMD_READY)
+            elif command == CMD_DECIDE:
+                self.applyStateDecisions(*self.state.read_decisions())
+                self.publish()
+
+    async def listen(self):
+        await asyncio.gather(self.coordinate(), OrdinaryClock.listen(self))
+
+def run_worker(options, clockIdentity, ports, state, frames, control, clock_link):
+    """Worker process entry point, state and the sockets are inherited through fork"""
+    print("[INFO] Worker PID: %d, Ports: %s" % (os.getpid(), ', '.join(str(i) for i in ports)))
+    async def worker():
+        clock = Shard_Clock(ptp.PTP_PROFILE_P2P, clockIdentity, options.interface, options.driver, options.driver_config, ports, state, frames, control, clock_link, *queue_options(options))
+        await clock.listen()
+    asyncio.run(worker())
+
+## Dispatcher and Coordinator ##
+
+class Dispatcher:
+    """Forwards each received frame to the worker owning its port, dropping it if the worker is behind"""
+    def __init__(self, transport, shards):
+        self.transport = transport
+        self.shards = shards # port_number -> worker socket
+        self.dropped = collections.Counter() # port_number -> frames dropped
+        self.reported_drops = {}
+
+    async def run(self):
+        while True:
+            for port_number, timestamp, frame in await self.transport.skt.recv_batch():
+                try:
+                    self.shards[port_number].sendmsg([FRAME_HEADER.pack(port_number, timestamp), frame])
+                except BlockingIOError:
+                    self.dropped[port_number] += 1
+                self.transport.skt.release(frame)
+
+    def reportDrops(self):
+        dropped = dict(self.dropped)
+        if dropped != self.reported_drops:
+            print("[INFO] (*) Dispatcher Drops: %s" % (', '.join('%d=%d' % (p, n) for (p, n) in sorted(dropped.items()))))
+            self.reported_drops = dropped
+        self.transport.report()
+
+class Clock_Owner:
+    """Applies the adjustments requested by the workers to the parent's clock
+
+    The parent's driver clock timestamps every ingress frame, so it is the one disciplined. Once
+    a step is applied every worker is noticed on its frames socket, behind the frames stamped
+    before the step. A clock that is not shared between processes also has its state sent after
+    a frequency adjustment.
+    """
+    def __init__(self, clock, links, frames):
+        self.clock = clock
+        self.links = links
+        self.frames = frames # Worker frames sockets
+        self.notices = asyncio.Queue()
+        self.clock.on_step = lambda: self.notices.put_nowait(CLOCK_STEP)
+
+    async def serve(self, link):
+        loop = asyncio.get_event_loop()
+        while True:
+            request = await loop.sock_recv(link, CLOCK_REQUEST.size)
+            if not request:
+                raise RuntimeError("Worker exited")
+            kind, value = CLOCK_REQUEST.unpack(request)
+            if kind == CLOCK_STEP:
+                self.clock.step(round(value)) # on_step follows once it is applied
+            else:
+                self.clock.adjust_frequency(value)
+                if not self.clock.shared:
+                    self.notices.put_nowait(CLOCK_FREQUENCY)
+
+    async def notify(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            kind = await self.notices.get()
+            state = (0, 0, 0.0) if self.clock.shared else self.clock.state()
+            notice = FRAME_HEADER.pack(NOTICE_PORT, 0) + CLOCK_NOTICE.pack(kind, *state)
+            for skt in self.frames:
+                await loop.sock_sendall(skt, notice)
+
+    async def run(self):
+        await asyncio.gather(self.notify(), *(self.serve(link) for link in self.links))
+
+class Port_Summary:
+    """A port as seen by the coordinator: its data set and e_rbest"""
+    __slots__ = ('portDS', 'e_rbest')
+
+    def __init__(self, profile, clockIdentity, portNumber):
+        self.portDS = PortDS(profile, clockIdentity, portNumber)
+        self.e_rbest = None
+
+class Coordinator:
+    """Runs STATE_DECISION_EVENT (9.2.6.8) across the workers"""
+    get_e_best = OrdinaryClock.get_e_best
+    state_decision_algorithm = OrdinaryClock.state_decision_algorithm
+
+    def __init__(self, profile, clockIdentity, number_of_ports, state, controls, dispatcher):
+        self.defaultDS = DefaultDS(profile, clockIdentity, number_of_ports)
+        self.portList = {i: Port_Summary(profile, clockIdentity, i) for i in range(1, number_of_ports + 1)}
+        self.announceInterval = 2 ** profile['portDS.logAnnounceInterval']
+        self.state = state
+        self.controls = controls
+        self.dispatcher = dispatcher
+
+    async def stateDecisionEvent(self):
+        loop = asyncio.get_event_loop()
+        print("[EVENT] (*) STATE_DECISION_EVENT")
+        self.dispatcher.reportDrops()
+        for control in self.controls:
+            await loop.sock_sendall(control, CMD_CALC)
+        for control in self.controls:
+            if await loop.sock_recv(control, 1) != CMD_READY:
+                raise RuntimeError("Worker exited")
+
+        for portNumber, port in self.portList.items():
+            port.portDS.portState, announce = self.state.read_summary(portNumber)
+            port.e_rbest = BMC_Entry(announce, port.portDS) if announce else None
+        e_best = self.get_e_best()
+        codes = {portNumber: self.state_decision_algorithm(e_best, port) for (portNumber, port) in self.portList.items()}
+        self.state.write_decisions(codes, e_best.msg if e_best else None)
+
+        for control in self.controls:
+            await loop.sock_sendall(control, CMD_DECIDE)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.announceInterval)
+            await self.stateDecisionEvent()
+
+def queue_options(options):
+    return ((options.event_queue, options.general_queue), QUEUE_DROP[options.queue_drop.upper()])
+
+def main():
+    clockIdentity = random.randrange(2**64).to_bytes(8, 'big') # FIX: get from interface
+    parser = OptionParser()
+    parser.add_option("-i", "--interface", dest="interface", default='veth1')
+    parser.add_option("-d", "--driver", dest="driver", default='dummy')
+    parser.add_option("-c", "--driver-config", dest="driver_config")
+    parser.add_option("-w", "--workers", type="int", dest="workers", default=os.cpu_count(), help="worker processes, each owning a share of the ports")
+    parser.add_option("--event-queue", type="int", dest="event_queue", default=RX_QUEUE_DEPTH[0], help="event messages queued per port")
+    parser.add_option("--general-queue", type="int", dest="general_queue", default=RX_QUEUE_DEPTH[1], help="general messages queued per port")
+    parser.add_option("--queue-drop", type="choice", choices=["head", "tail"], dest="queue_drop", default="head", help="drop the oldest (head) or arriving (tail) message when a queue is full")
+    (options, _) = parser.parse_args()
+
+    print("[INFO] PID: %d" % (os.getpid()))
+    print("[INFO] Clock ID: %s" % (clockIdentity.hex()))
+    number_of_ports = count_ports(options.driver_config)
+    workers = max(1, min(options.workers, number_of_ports))
+    state = Shard_State(number_of_ports)
+
+    # Workers are forked before the parent opens its driver, which may start threads
+    context = multiprocessing.get_context('fork')
+    shards = {}
+    controls = []
+    clock_links = []
+    processes = []
+    for w in range(workers):
+        ports = list(range(w + 1, number_of_ports + 1, workers))
+        frames_tx, frames_rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        clock_link, worker_clock_link = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        process = context.Process(target=run_worker, args=(options, clockIdentity, ports, state, frames_rx, worker_control, worker_clock_link), daemon=True)
+        process.start()
+        frames_rx.close()
+        worker_control.close()
+        worker_clock_link.close()
+        frames_tx.setblocking(False)
+        control.setblocking(False)
+        clock_link.setblocking(False)
+        shards.update({port_number: frames_tx for port_number in ports})
+        controls.append(control)
+        clock_links.append(clock_link)
+        processes.append(process)
+
+    async def parent():
+        transport = Transport(options.interface, options.driver, options.driver_config, clock_seed=clockIdentity)
+        dispatcher = Dispatcher(transport, shards)
+        coordinator = Coordinator(ptp.PTP_PROFILE_P2P, clockIdentity, number_of_ports, state, controls, dispatcher)
+        clock_owner = Clock_Owner(transport.clock, clock_links, list(dict.fromkeys(shards.values())))
+        await asyncio.gather(dispatcher.run(), coordinator.run(), clock_owner.run())
+
+    try:
+        asyncio.run(parent())
+    finally:
+        state.close()
+        for process in processes:
+            process.terminate()
+
+if __name__ == '__main__':
+    main()
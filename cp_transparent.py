@@ -11,11 +11,12 @@
 
 from copy import copy
 from optparse import OptionParser
+import collections
 import random
 import asyncio
 import os
 import ptp
-from ptp_transport import Transport
+from ptp_transport import Transport, TRANSPORT_PROTO
 from ptp_datasets import TimePropertiesDS, PortDS, ForeignMasterDS
 from ptp_datasets import TransparentClockDefaultDS, TransparentClockPortDS
 from ptp import PTP_DELAY_MECH, PTP_MESG_TYPE
@@ -48,7 +49,7 @@ class TransparentPort:
         return egress_timestamp
 
     def process_message(self, buffer, msg_offset, rx_port, ingress_timestamp):
-        hdr = ptp.Header(buffer[msg_offset:])
+        hdr = ptp.HeaderView(memoryview(buffer)[msg_offset:])
 
         # if hdr.messageType == ptp.PTP_MESG_TYPE.SYNC:
         #     self.correct_Sync(buffer, msg_offset, rx_port, ingress_timestamp)
@@ -161,7 +162,10 @@ class TransparentClock:
 
     def __init__(self, profile, clockIdentity, options):
         print("[INFO] Clock ID: %s" % (clockIdentity.hex()))
-        self.transport = Transport(options.interface, options.driver, options.driver_config)
+        self.transport = Transport(options.interface, options.driver, options.driver_config, clock_seed=clockIdentity)
+        self.transport.enable_queues()
+        self.workers = []
+        self.message_errors = collections.Counter() # Exception -> messages
         self.twoStepFlag = True # TODO: get from options
         # TODO: get numberPorts
         self.defaultDS = TransparentClockDefaultDS(profile, clockIdentity, self.transport.number_of_ports)
@@ -170,12 +174,26 @@ class TransparentClock:
             self.portList[i+1] = TransparentPort(profile, self, i + 1)
 
     async def listen (self):
+        self.workers = [asyncio.create_task(self.serve(port_number)) for port_number in self.portList]
+        await asyncio.gather(self.transport.demux(), *self.workers)
+
+    async def serve(self, rx_port):
+        """Forwards the messages queued on rx_port to every other port, event messages first
+
+        A message that fails to forward is logged and counted, the port carries on with the next.
+        """
         while True:
-            # TODO: Update ptp_transport to provide msg_offset
-            (buffer, msg_offset, port_number, ingress_timestamp) = await self.transport.recv_message()
-            for port in self.portList.values():
-                if port_number != port.portDS.portIdentity.portNumber:
-                    port.process_message(buffer, msg_offset, port_number, ingress_timestamp)
+            (buffer, msg_offset, port_number, ingress_timestamp) = await self.transport.recv_port(rx_port)
+            try:
+                for port in self.portList.values():
+                    if port_number != port.portDS.portIdentity.portNumber:
+                        port.process_message(buffer, msg_offset, port_number, ingress_timestamp)
+            except Exception as e: # pylint: disable=broad-except
+                self.message_errors[type(e).__name__] += 1
+                print("[ERROR] (%d) Failed to forward message: %s (%s), %d errors" % (rx_port, type(e).__name__, e, sum(self.message_errors.values())))
+            finally:
+                self.transport.release(buffer)
+            await asyncio.sleep(0) # Take turns with the other ports
 
 ### Main ###
 
@@ -188,11 +206,19 @@ async def main():
     parser.add_option("-i", "--interface", dest="interface", default='veth1')
     parser.add_option("-d", "--driver", dest="driver", default='dummy')
     parser.add_option("-c", "--driver-config", dest="driver_config")
+    parser.add_option("--transport", type="choice", choices=["ethernet", "udp4", "udp6"], dest="transport", default="ethernet", help="ethernet (Annex F), udp4 (Annex D) or udp6 (Annex E)")
+    parser.add_option("--src-mac", dest="src_mac", help="source MAC address of sent frames")
+    parser.add_option("--src-ipv4", dest="src_ipv4", help="source IPv4 address with --transport udp4")
+    parser.add_option("--src-ipv6", dest="src_ipv6", help="source IPv6 address with --transport udp6")
 
     (options, _) = parser.parse_args()
     pid = os.getpid()
     print("[INFO] PID: %d" % (pid))
     clock = TransparentClock(ptp.PTP_PROFILE_P2P, randomClockIdentity, options)
+    try:
+        clock.transport.configure_ports(TRANSPORT_PROTO[options.transport], options.src_mac, options.src_ipv4, options.src_ipv6, clock.twoStepFlag)
+    except ValueError as e:
+        parser.error("--transport %s: %s" % (options.transport, e))
     await clock.listen()
 
 asyncio.run(main())
@@ -5,14 +5,23 @@
 # pylint: disable=missing-module-docstring
 
 import socket
+import struct
+import collections
 import time
 import asyncio
+import random
 
 MAX_MSG_SIZE = 8192
 ETH_P_ALL = 3
 CPU_HDR_SIZE = 8
+RX_BATCH_SIZE = 64
+DEVICE_PORTS = 512 # device_port is 9 bits
+SIM_MAX_OFFSET = 1000000 # ns, initial error of the simulated clock, before drift since boot
+SIM_MAX_DRIFT = 50000 # ppb, frequency error of the simulated oscillator
 
 class CPU_Header:
+    parser = struct.Struct('!H6s')
+
     def __init__(self, buffer=b''):
         self.device_port = None
         self.timestamp = None
@@ -22,49 +31,151 @@ class CPU_Header:
         self.device_port = int.from_bytes(buffer[:2], 'big')
         self.timestamp = int.from_bytes(buffer[2:8], 'big')
 
+    def write_into(self, buffer, offset=0):
+        self.parser.pack_into(buffer, offset, self.device_port, self.timestamp.to_bytes(6, 'big'))
+        return offset + CPU_HDR_SIZE
+
     def bytes(self):
-        bytes = b''
-        bytes += self.device_port.to_bytes(2, 'big')
-        bytes += self.timestamp.to_bytes(6, 'big')
-        return bytes
+        buffer = bytearray(CPU_HDR_SIZE)
+        self.write_into(buffer)
+        return bytes(buffer)
+
+class Clock:
+    """Simulated clock, the host's monotonic time with an initial offset and oscillator drift
+
+    The offset and drift are drawn from seed and counted from the host's boot, so clocks built
+    from the same seed read the same in every process. Steps and frequency adjustments apply to
+    the simulated time, so a servo can be run against it without hardware.
+    """
+    shared = False # Adjustments are local to the process, see state()
+
+    def __init__(self, seed=None):
+        rng = random.Random(seed)
+        self.drift = rng.uniform(-SIM_MAX_DRIFT, SIM_MAX_DRIFT) # ppb
+        self.frequency = 0.0 # ppb, adjustment applied on top of the drift
+        self.origin = 0 # Host time the simulated time is counted from
+        self.base = rng.randrange(-SIM_MAX_OFFSET, SIM_MAX_OFFSET) # Simulated time at origin
+        self.on_step = None # Called once a step has been applied
+
+    def now(self, host=None):
+        if host is None: host = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        elapsed = host - self.origin
+        return self.base + elapsed + round(elapsed * (self.drift + self.frequency) * 1e-9)
+
+    def step(self, offset):
+        """Moves the clock by offset ns"""
+        self.base += offset
+        if self.on_step: self.on_step()
+
+    def adjust_frequency(self, ppb):
+        host = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        self.base = self.now(host)
+        self.origin = host
+        self.frequency = ppb
+
+    def state(self):
+        """Returns (base, origin, frequency), restoring it elsewhere reproduces every adjustment"""
+        return (self.base, self.origin, self.frequency)
+
+    def restore(self, state):
+        self.base, self.origin, self.frequency = state
 
 class Socket:
-    def __init__(self, skt_name, port_list):
+    udp_timestamps = True # Timestamps are taken in software, whatever the frame carries
+
+    def __init__(self, skt_name, port_list, rx=True, clock_seed=None):
         self.ports = {1:1}
-        self.skt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
-        self.skt.bind((skt_name, ETH_P_ALL))
+        protocol = ETH_P_ALL if rx else 0 # A socket bound to protocol 0 is only used for sending
+        self.skt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(protocol))
+        self.skt.bind((skt_name, protocol))
         self.skt.setblocking(False)
+        self.clock = Clock(clock_seed)
         self.number_of_ports = 1
+        self.cpu_headers = {} # (port_number, get_timestamp) -> CPU header bytes
+        self.rx_free = [bytearray(MAX_MSG_SIZE) for _ in range(RX_BATCH_SIZE)] # Receive buffer pool
+        self.port_index = [None] * DEVICE_PORTS # device_port -> port_number
+        self.unmapped = collections.Counter() # device_port -> frames dropped
         self.map_ports(port_list)
 
     def map_ports(self, filename):
         if filename:
             f = open(filename)
             lines = f.readlines()
-            for i in range(len(lines)):
-                self.ports[i + 1] = int(lines[i])
             f.close()
+            for i in range(len(lines)):
+                device_port = int(lines[i]) if lines[i].strip().isdigit() else -1
+                if device_port >= DEVICE_PORTS or device_port < 0:
+                    raise ValueError("%s:%d: '%s' is not a device port (0-%d)" % (filename, i + 1, lines[i].strip(), DEVICE_PORTS - 1))
+                self.ports[i + 1] = device_port
             self.number_of_ports = len(lines)
+        self.cpu_headers = {}
+        self.port_index = [None] * DEVICE_PORTS
+        for port_number, device_port in self.ports.items():
+            self.port_index[device_port] = port_number
 
-    def send(self, msg, port_number, get_timestamp=False):
-        timestamp = None
-        cpu_hdr = CPU_Header()
-        cpu_hdr.device_port = self.ports[port_number]
-        cpu_hdr.timestamp = get_timestamp # Request Egress Timestamp
+    def report(self):
+        pass # Timestamps are taken locally, there is nothing to report
 
-        self.skt.send(cpu_hdr.bytes() + msg)
-        if get_timestamp:
-            timestamp = time.clock_gettime_ns(time.CLOCK_REALTIME)
+    def drop_unmapped(self, device_port):
+        if not self.unmapped[device_port]:
+            print("[WARN] Dropping frames from unmapped device port %d" % (device_port))
+        self.unmapped[device_port] += 1
+
+    def cpu_header(self, port_number, get_timestamp):
+        key = (port_number, bool(get_timestamp))
+        header = self.cpu_headers.get(key)
+        if header is None:
+            cpu_hdr = CPU_Header()
+            cpu_hdr.device_port = self.ports[port_number]
+            cpu_hdr.timestamp = bool(get_timestamp) # Request Egress Timestamp
+            header = self.cpu_headers[key] = cpu_hdr.bytes()
+        return header
+
+    def send(self, buffers, port_number, get_timestamp=False, sequenceId=None): # pylint: disable=unused-argument
+        """Sends the frame made up of buffers, behind the port's cached CPU header, without copying it
 
+        With get_timestamp set, returns an already resolved future holding the egress timestamp.
+        """
+        timestamp = None
+        self.skt.sendmsg([self.cpu_header(port_number, get_timestamp)] + buffers)
+        if get_timestamp:
+            timestamp = asyncio.get_event_loop().create_future()
+            timestamp.set_result(self.clock.now())
         return timestamp
 
-    async def recv(self):
+    def rx_buffer(self):
+        return self.rx_free.pop() if self.rx_free else bytearray(MAX_MSG_SIZE)
+
+    def release(self, frame):
+        """Returns the buffer behind a frame from recv_batch to the pool, at most once per frame"""
+        self.rx_free.append(frame.obj)
+
+    async def recv_batch(self):
+        """Waits for a frame then drains those already queued, up to RX_BATCH_SIZE per wakeup
+
+        Returns a list of (port_number, timestamp, frame), frames are memoryviews into buffers
+        taken from a pool. Hand each frame back with release() once it has been parsed, a frame
+        that is not released is left to the garbage collector and its buffer reallocated.
+        """
         loop = asyncio.get_event_loop()
-        msg = await loop.sock_recv(self.skt, MAX_MSG_SIZE)
-        timestamp = time.clock_gettime_ns(time.CLOCK_REALTIME)
-        cpu_hdr = CPU_Header(msg)
-        port_list = [port for (port, d_p) in self.ports.items() if d_p == cpu_hdr.device_port]
-        if len(port_list) == 1:
-            return (port_list[0], timestamp, msg[CPU_HDR_SIZE:])
-        else:
-            return await self.recv()
+        frames = []
+        buffer = self.rx_buffer()
+        nbytes = await loop.sock_recv_into(self.skt, buffer)
+        for i in range(RX_BATCH_SIZE):
+            if i > 0:
+                buffer = self.rx_buffer()
+                try:
+                    nbytes = self.skt.recv_into(buffer)
+                except BlockingIOError:
+                    self.rx_free.append(buffer)
+                    break
+            timestamp = self.clock.now()
+            msg = memoryview(buffer)[:nbytes]
+            cpu_hdr = CPU_Header(msg)
+            port_number = self.port_index[cpu_hdr.device_port] if cpu_hdr.device_port < DEVICE_PORTS else None
+            if port_number is None:
+                self.drop_unmapped(cpu_hdr.device_port)
+                self.rx_free.append(buffer)
+                continue
+            frames.append((port_number, timestamp, msg[CPU_HDR_SIZE:]))
+        return frames
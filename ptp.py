@@ -4,8 +4,9 @@
 # pylint: disable=missing-function-docstring
 # pylint: disable=missing-class-docstring
 
-from dataclasses import dataclass
 from enum import IntEnum
+import collections
+import re
 import struct
 
 class PTP_TIME_SRC(IntEnum):
@@ -35,6 +36,18 @@ class PTP_DELAY_MECH(IntEnum):
     P2P = 2
     DISABLED = 0xFE
 
+# 14.1.1, Table 34
+class TLV_TYPE(IntEnum):
+    MANAGEMENT = 0x0001
+    MANAGEMENT_ERROR_STATUS = 0x0002
+    ORGANIZATION_EXTENSION = 0x0003
+    REQUEST_UNICAST_TRANSMISSION = 0x0004
+    GRANT_UNICAST_TRANSMISSION = 0x0005
+    CANCEL_UNICAST_TRANSMISSION = 0x0006
+    ACKNOWLEDGE_CANCEL_UNICAST_TRANSMISSION = 0x0007
+    PATH_TRACE = 0x0008
+    ALTERNATE_TIME_OFFSET_INDICATOR = 0x0009
+
 class PTP_MESG_TYPE(IntEnum):
     SYNC = 0
     DELAY_REQ = 1
@@ -82,89 +95,275 @@ PTP_PROFILE_P2P = {
 ### PTP Data Types
 
 class TimeStamp:
+    """Immutable Timestamp, 5.3.3"""
+    __slots__ = ('secondsField', 'nanosecondsField')
+
     def __init__(self, nanoseconds=0):
-        self.secondsField = nanoseconds // 1000000000 # UInt48
-        self.nanosecondsField = nanoseconds % 1000000000 # UInt32
+        secondsField, nanosecondsField = divmod(nanoseconds, 1000000000)
+        object.__setattr__(self, 'secondsField', secondsField) # UInt48
+        object.__setattr__(self, 'nanosecondsField', nanosecondsField) # UInt32
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TimeStamp is immutable")
+
+    @classmethod
+    def from_wire(cls, seconds_hi, seconds_lo, nanoseconds):
+        """Builds a TimeStamp from the UInt16, UInt32, UInt32 ('!HLL') on-wire form"""
+        ts = cls.__new__(cls)
+        object.__setattr__(ts, 'secondsField', (seconds_hi << 32) | seconds_lo)
+        object.__setattr__(ts, 'nanosecondsField', nanoseconds)
+        return ts
+
+    def wire(self):
+        return (self.secondsField >> 32, self.secondsField & 0xFFFFFFFF, self.nanosecondsField)
 
     def ns(self):
         return self.secondsField * 1000000000 + self.nanosecondsField
 
-@dataclass(order=True)
+    def scaled_ns(self):
+        """Nanoseconds multiplied by 2^16, the units of correctionField and TimeInterval"""
+        return self.ns() << 16
+
+    def __add__(self, nanoseconds):
+        return TimeStamp(self.ns() + nanoseconds)
+
+    def __sub__(self, other):
+        if isinstance(other, TimeStamp):
+            return self.ns() - other.ns()
+        return TimeStamp(self.ns() - other)
+
+    def __eq__(self, other):
+        return isinstance(other, TimeStamp) and self.ns() == other.ns()
+
+    def __hash__(self):
+        return hash(self.ns())
+
+    def __repr__(self):
+        return "TimeStamp(%d.%09d)" % (self.secondsField, self.nanosecondsField)
+
 class PortIdentity:
-    clockIdentity: bytes = None # Octet[8]
-    portNumber: int = None # UInt16
+    """Immutable PortIdentity, 5.3.5, held as its 10 octet on-wire form"""
+    __slots__ = ('raw',)
+
+    def __init__(self, clockIdentity=None, portNumber=None):
+        clockIdentity = clockIdentity if clockIdentity is not None else bytes(8) # Octet[8]
+        portNumber = portNumber if portNumber is not None else 0 # UInt16
+        object.__setattr__(self, 'raw', bytes(clockIdentity) + portNumber.to_bytes(2, 'big'))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PortIdentity is immutable")
+
+    @classmethod
+    def from_bytes(cls, raw):
+        portIdentity = cls.__new__(cls)
+        object.__setattr__(portIdentity, 'raw', bytes(raw))
+        return portIdentity
+
+    @property
+    def clockIdentity(self):
+        return self.raw[:8]
+
+    @property
+    def portNumber(self):
+        return int.from_bytes(self.raw[8:], 'big')
+
+    # Octet-wise comparison of the on-wire form orders by clockIdentity then portNumber
+    def __eq__(self, other):
+        return isinstance(other, PortIdentity) and self.raw == other.raw
+
+    def __lt__(self, other):
+        return self.raw < other.raw
+
+    def __le__(self, other):
+        return self.raw <= other.raw
+
+    def __gt__(self, other):
+        return self.raw > other.raw
+
+    def __ge__(self, other):
+        return self.raw >= other.raw
+
+    def __hash__(self):
+        return hash(self.raw)
+
+    def __copy__(self):
+        return self
+
+    def __repr__(self):
+        return "PortIdentity(clockIdentity=%r, portNumber=%d)" % (self.clockIdentity, self.portNumber)
 
 class PortAddress:
+    __slots__ = ('networkProtocol', 'addressLength', 'addressField')
+
     def __init__(self):
         self.networkProtocol = None
         self.addressLength = None
         self.addressField = None
 
 class ClockQuality:
+    __slots__ = ('clockClass', 'clockAccuracy', 'offsetScaledLogVariance')
+
     def __init__(self):
         self.clockClass = None # UInt8
         self.clockAccuracy = None # Enum8
         self.offsetScaledLogVariance = None #UInt16
 
 class TLV:
-    def __init__(self):
-        self.tlvType = None
-        self.lengthField = None
-        self.valueField = None
+    """Generic TLV, 14.1, valueField is kept undecoded"""
+    parser = struct.Struct('!HH')
+    __slots__ = ('tlvType', 'lengthField', 'valueField')
+
+    def __init__(self, tlvType=None, valueField=b''):
+        self.tlvType = tlvType # Enum16
+        self.lengthField = len(valueField) # UInt16
+        self.valueField = valueField # Octet[lengthField]
+
+    @classmethod
+    def decode(cls, tlvType, value):
+        return TLV(tlvType, bytes(value))
+
+    def value(self):
+        return self.valueField
+
+    def write_into(self, buffer, offset=0):
+        value = self.value()
+        self.parser.pack_into(buffer, offset, self.tlvType, len(value))
+        offset += self.parser.size
+        buffer[offset:offset + len(value)] = value
+        return offset + len(value)
+
+    def bytes(self):
+        buffer = bytearray(self.parser.size + len(self.value()))
+        self.write_into(buffer)
+        return bytes(buffer)
+
+class Path_Trace_TLV(TLV):
+    """PATH_TRACE TLV, 16.2.5"""
+    __slots__ = ('pathSequence',)
+
+    def __init__(self, pathSequence=()):
+        TLV.__init__(self, TLV_TYPE.PATH_TRACE)
+        self.pathSequence = tuple(pathSequence) # ClockIdentity[N]
+        self.lengthField = 8 * len(self.pathSequence)
+
+    @classmethod
+    def decode(cls, tlvType, value):
+        return Path_Trace_TLV(bytes(value[i:i + 8]) for i in range(0, len(value) - 7, 8))
+
+    def value(self):
+        return b''.join(self.pathSequence)
+
+class Organization_Extension_TLV(TLV):
+    """ORGANIZATION_EXTENSION TLV, 14.3"""
+    __slots__ = ('organizationId', 'organizationSubType', 'dataField')
+
+    def __init__(self, organizationId=b'\x00' * 3, organizationSubType=b'\x00' * 3, dataField=b''):
+        TLV.__init__(self, TLV_TYPE.ORGANIZATION_EXTENSION)
+        self.organizationId = organizationId # Octet[3]
+        self.organizationSubType = organizationSubType # Enumeration24
+        self.dataField = dataField # Octet[N]
+        self.lengthField = 6 + len(dataField)
+
+    @classmethod
+    def decode(cls, tlvType, value):
+        return Organization_Extension_TLV(bytes(value[0:3]), bytes(value[3:6]), bytes(value[6:]))
+
+    def value(self):
+        return self.organizationId + self.organizationSubType + self.dataField
+
+# Decoders for TLV types that consumers commonly request, others are returned as a generic TLV
+TLV_DECODERS = {
+    TLV_TYPE.PATH_TRACE: Path_Trace_TLV.decode,
+    TLV_TYPE.ORGANIZATION_EXTENSION: Organization_Extension_TLV.decode
+}
+
+def iter_tlvs(buffer, tlvTypes=None):
+    """Lazily walks the TLVs of a message suffix, only TLVs in tlvTypes (or all if None) are decoded"""
+    view = memoryview(buffer)
+    offset = 0
+    while offset + TLV.parser.size <= len(view):
+        tlvType, lengthField = TLV.parser.unpack_from(view, offset)
+        start = offset + TLV.parser.size
+        offset = start + lengthField
+        if offset > len(view):
+            break # Truncated TLV
+        if tlvTypes is None or tlvType in tlvTypes:
+            yield TLV_DECODERS.get(tlvType, TLV.decode)(tlvType, view[start:offset])
 
 class PTPText:
+    __slots__ = ('lengthField', 'textField')
+
     def __init__(self):
         self.lengthField = None
         self.textField = None
 
 ### PTP Messages
 
+def _flag(mask):
+    def getter(self):
+        return bool(self.value & mask)
+
+    def setter(self, state):
+        self.value = (self.value | mask) if state else (self.value & ~mask)
+
+    return property(getter, setter)
+
 class FlagField:
-    def __init__(self):
-        self.alternateMasterFlag = False
-        self.twoStepFlag = False
-        self.unicastFlag = False
-        self.profile1 = False
-        self.profile2 = False
-        self.leap61 = False
-        self.leap59 = False
-        self.currentUtcOffsetValid = False
-        self.ptpTimescale = False
-        self.timeTraceable = False
-        self.frequencyTraceable = False
+    """Octet[2] flagField held as a single big-endian UInt16, Table 20"""
+    __slots__ = ('value',)
+
+    def __init__(self, value=0):
+        self.value = value
+
+    # Octet 0
+    alternateMasterFlag = _flag(0x0100)
+    twoStepFlag = _flag(0x0200)
+    unicastFlag = _flag(0x0400)
+    profile1 = _flag(0x2000)
+    profile2 = _flag(0x4000)
+    # Octet 1
+    leap61 = _flag(0x0001)
+    leap59 = _flag(0x0002)
+    currentUtcOffsetValid = _flag(0x0004)
+    ptpTimescale = _flag(0x0008)
+    timeTraceable = _flag(0x0010)
+    frequencyTraceable = _flag(0x0020)
 
     def parse(self, buffer):
-        flagField = [[(buffer[i] >> j) & 0x01 for j in range(8)] for i in range(len(buffer))]
-        self.alternateMasterFlag = flagField[0][0]
-        self.twoStepFlag = flagField[0][1]
-        self.unicastFlag = flagField[0][2]
-        self.profile1 = flagField[0][5]
-        self.profile2 = flagField[0][6]
-        self.leap61 = flagField[1][0]
-        self.leap59 = flagField[1][1]
-        self.currentUtcOffsetValid = flagField[1][2]
-        self.ptpTimescale = flagField[1][3]
-        self.timeTraceable = flagField[1][4]
-        self.frequencyTraceable = flagField[1][5]
+        self.value = buffer if isinstance(buffer, int) else int.from_bytes(buffer[:2], 'big')
 
     def bytes(self):
-        flagField = [[False]*8, [False]*8]
-        flagField[0][0] = self.alternateMasterFlag
-        flagField[0][1] = self.twoStepFlag
-        flagField[0][2] = self.unicastFlag
-        flagField[0][5] = self.profile1
-        flagField[0][6] = self.profile2
-        flagField[1][0] = self.leap61
-        flagField[1][1] = self.leap59
-        flagField[1][2] = self.currentUtcOffsetValid
-        flagField[1][3] = self.ptpTimescale
-        flagField[1][4] = self.timeTraceable
-        flagField[1][5] = self.frequencyTraceable
-        l = [sum([(2**j) * flagField[i][j] for j in range(8)]) for i in range(len(flagField))]
-        return struct.pack('2B', *l)
+        return self.value.to_bytes(2, 'big')
 
 class Header:
-    parser = struct.Struct('!2BHBx2sq4x8sHHBb')
+    parser = struct.Struct('!2BHBxHq4x10sHBb')
+    size = parser.size
+    field_names = (
+        'messageType',
+        'versionPTP',
+        'messageLength',
+        'domainNumber',
+        'flagField',
+        'correctionField',
+        'sourcePortIdentity',
+        'sequenceId',
+        'controlField',
+        'logMessageInterval',
+    )
+    __slots__ = (
+        'transportSpecific',
+        'messageType',
+        'versionPTP',
+        'messageLength',
+        'domainNumber',
+        'flagField',
+        'correctionField',
+        'sourcePortIdentity',
+        'sequenceId',
+        'controlField',
+        'logMessageInterval',
+        'suffix'
+    )
 
     def __init__(self, buffer=b''):
         self.transportSpecific = None # Nibble
@@ -180,41 +379,151 @@ class Header:
         self.sequenceId = None # UInt16
         self.controlField = None # UInt8
         self.logMessageInterval = None # Int8
+        self.suffix = b'' # TLVs following the message body, 13.4
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        t = Header.parser.unpack(buffer[:Header.parser.size])
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        t = view.fields()
         self.transportSpecific = t[0] >> 4
         self.messageType = PTP_MESG_TYPE(t[0] & 0x0F)
         self.versionPTP = t[1] & 0x0F
         self.messageLength = t[2]
         self.domainNumber = t[3]
-        self.flagField.parse(t[4])
+        self.flagField.value = t[4]
         self.correctionField = t[5]
-        self.sourcePortIdentity.clockIdentity = t[6]
-        self.sourcePortIdentity.portNumber = t[7]
-        self.sequenceId = t[8]
-        self.controlField = t[9]
-        self.logMessageInterval = t[10]
-
-    def bytes(self):
+        self.sourcePortIdentity = PortIdentity.from_bytes(t[6])
+        self.sequenceId = t[7]
+        self.controlField = t[8]
+        self.logMessageInterval = t[9]
+        end = min(self.messageLength, len(view.buffer))
+        # Copied so that messages can be kept after the receive buffer is reused
+        self.suffix = bytes(view.buffer[self.size:end]) if end > self.size else b''
+
+    def write_into(self, buffer, offset=0):
+        """Serialises the message into buffer at offset, returns the offset following the message
+
+        messageLength is written as the length of the body and suffix actually serialised.
+        """
         t = (
             (self.transportSpecific << 4) | self.messageType,
             self.versionPTP,
-            self.messageLength,
+            self.length(),
             self.domainNumber,
-            self.flagField.bytes(),
+            self.flagField.value,
             self.correctionField,
-            self.sourcePortIdentity.clockIdentity,
-            self.sourcePortIdentity.portNumber,
+            self.sourcePortIdentity.raw,
             self.sequenceId,
             self.controlField,
             self.logMessageInterval
         )
-        return Header.parser.pack(*t)
+        Header.parser.pack_into(buffer, offset, *t)
+        return offset + Header.parser.size
+
+    def write_suffix(self, buffer, offset):
+        buffer[offset:offset + len(self.suffix)] = self.suffix
+        return offset + len(self.suffix)
+
+    def length(self):
+        return self.size + len(self.suffix)
+
+    def bytes(self):
+        buffer = bytearray(self.length())
+        self.write_into(buffer)
+        return bytes(buffer)
+
+    def tlvs(self, *tlvTypes):
+        """Iterates over the TLVs in the suffix, decoding only those of the given types (all if none given)"""
+        return iter_tlvs(self.suffix, tlvTypes or None)
+
+    def add_tlv(self, tlv):
+        self.suffix += tlv.bytes()
+        self.messageLength = self.length()
+
+class HeaderView:
+    """Zero-copy view of a PTP header, fields are decoded on first access"""
+    __slots__ = ('buffer', '_fields')
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self._fields = None
+
+    def fields(self):
+        if self._fields is None:
+            self._fields = Header.parser.unpack_from(self.buffer)
+        return self._fields
+
+    @property
+    def transportSpecific(self):
+        return self.buffer[0] >> 4
+
+    @property
+    def messageType(self):
+        return PTP_MESG_TYPE(self.buffer[0] & 0x0F)
+
+    @property
+    def versionPTP(self):
+        return self.buffer[1] & 0x0F
+
+    @property
+    def messageLength(self):
+        return self.fields()[2]
+
+    @property
+    def domainNumber(self):
+        return self.buffer[4]
+
+    @property
+    def flagField(self):
+        return FlagField(self.fields()[4])
+
+    @property
+    def correctionField(self):
+        return self.fields()[5]
+
+    @property
+    def sourcePortIdentity(self):
+        return PortIdentity.from_bytes(self.fields()[6])
+
+    @property
+    def sequenceId(self):
+        return self.fields()[7]
+
+    @property
+    def controlField(self):
+        return self.fields()[8]
+
+    @property
+    def logMessageInterval(self):
+        return self.fields()[9]
 
 class Announce(Header):
-    parser = struct.Struct('!6sLhx3BHB8sHB')
+    parser = struct.Struct('!HLLhx3BHB8sHB')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'originTimestamp.secondsField.hi',
+        'originTimestamp.secondsField.lo',
+        'originTimestamp.nanosecondsField',
+        'currentUtcOffset',
+        'grandmasterPriority1',
+        'grandmasterClockQuality.clockClass',
+        'grandmasterClockQuality.clockAccuracy',
+        'grandmasterClockQuality.offsetScaledLogVariance',
+        'grandmasterPriority2',
+        'grandmasterIdentity',
+        'stepsRemoved',
+        'timeSource',
+    )
+    __slots__ = (
+        'originTimestamp',
+        'currentUtcOffset',
+        'grandmasterPriority1',
+        'grandmasterClockQuality',
+        'grandmasterPriority2',
+        'grandmasterIdentity',
+        'stepsRemoved',
+        'timeSource'
+    )
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -234,25 +543,24 @@ class Announce(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.originTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])
-        self.originTimestamp.nanosecondsField = t[1]
-        self.currentUtcOffset = t[2]
-        self.grandmasterPriority1 = t[3]
-        self.grandmasterClockQuality.clockClass = t[4]
-        self.grandmasterClockQuality.clockAccuracy = t[5]
-        self.grandmasterClockQuality.offsetScaledLogVariance = t[6]
-        self.grandmasterPriority2 = t[7]
-        self.grandmasterIdentity = t[8]
-        self.stepsRemoved = t[9]
-        self.timeSource = t[10]
-
-    def bytes(self):
-        header_bytes = Header.bytes(self)
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.originTimestamp = TimeStamp.from_wire(*t[0:3])
+        self.currentUtcOffset = t[3]
+        self.grandmasterPriority1 = t[4]
+        self.grandmasterClockQuality.clockClass = t[5]
+        self.grandmasterClockQuality.clockAccuracy = t[6]
+        self.grandmasterClockQuality.offsetScaledLogVariance = t[7]
+        self.grandmasterPriority2 = t[8]
+        self.grandmasterIdentity = t[9]
+        self.stepsRemoved = t[10]
+        self.timeSource = t[11]
+
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
         t = (
-            struct.pack('!Q', self.originTimestamp.secondsField)[2:8],
-            self.originTimestamp.nanosecondsField,
+            *self.originTimestamp.wire(),
             self.currentUtcOffset,
             self.grandmasterPriority1,
             self.grandmasterClockQuality.clockClass,
@@ -263,10 +571,18 @@ class Announce(Header):
             self.stepsRemoved,
             self.timeSource
         )
-        return header_bytes + self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
 class Sync(Header):
-    parser = struct.Struct('!6sL')
+    parser = struct.Struct('!HLL')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'originTimestamp.secondsField.hi',
+        'originTimestamp.secondsField.lo',
+        'originTimestamp.nanosecondsField',
+    )
+    __slots__ = ('originTimestamp',)
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -276,23 +592,28 @@ class Sync(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.originTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])[0]
-        self.originTimestamp.nanosecondsField = t[1]
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.originTimestamp = TimeStamp.from_wire(*t[0:3])
 
-    def bytes(self):
-        header_bytes = Header.bytes(self)
-        t = (
-            struct.pack('!Q', self.originTimestamp.secondsField)[2:8],
-            self.originTimestamp.nanosecondsField
-        )
-        return header_bytes + self.parser.pack(*t)
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
+        t = self.originTimestamp.wire()
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
 Delay_Req = Sync
 
 class Follow_Up(Header):
-    parser = struct.Struct('!6sL')
+    parser = struct.Struct('!HLL')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'preciseOriginTimestamp.secondsField.hi',
+        'preciseOriginTimestamp.secondsField.lo',
+        'preciseOriginTimestamp.nanosecondsField',
+    )
+    __slots__ = ('preciseOriginTimestamp',)
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -302,21 +623,27 @@ class Follow_Up(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.preciseOriginTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])[0]
-        self.preciseOriginTimestamp.nanosecondsField = t[1]
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.preciseOriginTimestamp = TimeStamp.from_wire(*t[0:3])
 
-    def bytes(self):
-        header_bytes = Header.bytes(self)
-        t = (
-            struct.pack('!Q', self.preciseOriginTimestamp.secondsField)[2:8],
-            self.preciseOriginTimestamp.nanosecondsField
-        )
-        return header_bytes + self.parser.pack(*t)
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
+        t = self.preciseOriginTimestamp.wire()
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
 class Delay_Resp(Header):
-    parser = struct.Struct('!6sL8sH')
+    parser = struct.Struct('!HLL10s')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'receiveTimestamp.secondsField.hi',
+        'receiveTimestamp.secondsField.lo',
+        'receiveTimestamp.nanosecondsField',
+        'requestingPortIdentity',
+    )
+    __slots__ = ('receiveTimestamp', 'requestingPortIdentity')
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -329,25 +656,30 @@ class Delay_Resp(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.receiveTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])[0]
-        self.receiveTimestamp.nanosecondsField = t[1]
-        self.requestingPortIdentity.clockIdentity = t[2]
-        self.requestingPortIdentity.portNumber = t[3]
-
-    def bytes(self):
-        header_bytes = Header.bytes(self)
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.receiveTimestamp = TimeStamp.from_wire(*t[0:3])
+        self.requestingPortIdentity = PortIdentity.from_bytes(t[3])
+
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
         t = (
-            struct.pack('!Q', self.receiveTimestamp.secondsField)[2:8],
-            self.receiveTimestamp.nanosecondsField,
-            self.requestingPortIdentity.clockIdentity,
-            self.requestingPortIdentity.portNumber
+            *self.receiveTimestamp.wire(),
+            self.requestingPortIdentity.raw
         )
-        return header_bytes + self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
 class Pdelay_Req(Header):
-    parser = struct.Struct('!6sL10x')
+    parser = struct.Struct('!HLL10x')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'originTimestamp.secondsField.hi',
+        'originTimestamp.secondsField.lo',
+        'originTimestamp.nanosecondsField',
+    )
+    __slots__ = ('originTimestamp',)
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -357,21 +689,27 @@ class Pdelay_Req(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.originTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])[0]
-        self.originTimestamp.nanosecondsField = t[1]
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.originTimestamp = TimeStamp.from_wire(*t[0:3])
 
-    def bytes(self):
-        header_bytes = Header.bytes(self)
-        t = (
-            struct.pack('!Q', self.originTimestamp.secondsField)[2:8],
-            self.originTimestamp.nanosecondsField
-        )
-        return header_bytes + self.parser.pack(*t)
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
+        t = self.originTimestamp.wire()
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
 class Pdelay_Resp(Header):
-    parser = struct.Struct('!6sL8sH')
+    parser = struct.Struct('!HLL10s')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'requestReceiptTimestamp.secondsField.hi',
+        'requestReceiptTimestamp.secondsField.lo',
+        'requestReceiptTimestamp.nanosecondsField',
+        'requestingPortIdentity',
+    )
+    __slots__ = ('requestReceiptTimestamp', 'requestingPortIdentity')
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -384,25 +722,31 @@ class Pdelay_Resp(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.requestReceiptTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])[0]
-        self.requestReceiptTimestamp.nanosecondsField = t[1]
-        self.requestingPortIdentity.clockIdentity = t[2]
-        self.requestingPortIdentity.portNumber = t[3]
-
-    def bytes(self):
-        header_bytes = Header.bytes(self)
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.requestReceiptTimestamp = TimeStamp.from_wire(*t[0:3])
+        self.requestingPortIdentity = PortIdentity.from_bytes(t[3])
+
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
         t = (
-            struct.pack('!Q', self.requestReceiptTimestamp.secondsField)[2:8],
-            self.requestReceiptTimestamp.nanosecondsField,
-            self.requestingPortIdentity.clockIdentity,
-            self.requestingPortIdentity.portNumber
+            *self.requestReceiptTimestamp.wire(),
+            self.requestingPortIdentity.raw
         )
-        return header_bytes + self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
 class Pdelay_Resp_Follow_Up(Header):
-    parser = struct.Struct('!6sL8sH')
+    parser = struct.Struct('!HLL10s')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'responseOriginTimestamp.secondsField.hi',
+        'responseOriginTimestamp.secondsField.lo',
+        'responseOriginTimestamp.nanosecondsField',
+        'requestingPortIdentity',
+    )
+    __slots__ = ('responseOriginTimestamp', 'requestingPortIdentity')
 
     def __init__(self, buffer=b''):
         Header.__init__(self)
@@ -415,19 +759,195 @@ class Pdelay_Resp_Follow_Up(Header):
         if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        Header.parse(self, buffer[:Header.parser.size])
-        t = self.parser.unpack(buffer[Header.parser.size:][:self.parser.size])
-        self.responseOriginTimestamp.secondsField = struct.unpack('!Q', b'\x00\x00' + t[0])[0]
-        self.responseOriginTimestamp.nanosecondsField = t[1]
-        self.requestingPortIdentity.clockIdentity = t[2]
-        self.requestingPortIdentity.portNumber = t[3]
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.responseOriginTimestamp = TimeStamp.from_wire(*t[0:3])
+        self.requestingPortIdentity = PortIdentity.from_bytes(t[3])
+
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
+        t = (
+            *self.responseOriginTimestamp.wire(),
+            self.requestingPortIdentity.raw
+        )
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
 
-    def bytes(self):
-        header_bytes = Header.bytes(self)
+class Signaling(Header):
+    parser = struct.Struct('!10s')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'targetPortIdentity',
+    )
+    __slots__ = ('targetPortIdentity',)
+
+    def __init__(self, buffer=b''):
+        Header.__init__(self)
+        self.targetPortIdentity = PortIdentity()
+        if buffer: self.parse(buffer)
+
+    def parse(self, buffer):
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.targetPortIdentity = PortIdentity.from_bytes(t[0])
+
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
+        t = (self.targetPortIdentity.raw,)
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
+
+class Management(Header):
+    parser = struct.Struct('!10s3Bx')
+    size = Header.parser.size + parser.size
+    field_names = (
+        'targetPortIdentity',
+        'startingBoundaryHops',
+        'boundaryHops',
+        'actionField',
+    )
+    __slots__ = ('targetPortIdentity', 'startingBoundaryHops', 'boundaryHops', 'actionField')
+
+    def __init__(self, buffer=b''):
+        Header.__init__(self)
+        self.targetPortIdentity = PortIdentity()
+        self.startingBoundaryHops = None # UInt8
+        self.boundaryHops = None # UInt8
+        self.actionField = None # Enumeration4
+        if buffer: self.parse(buffer)
+
+    def parse(self, buffer):
+        view = buffer if isinstance(buffer, HeaderView) else HeaderView(buffer)
+        Header.parse(self, view)
+        t = self.parser.unpack_from(view.buffer, Header.parser.size)
+        self.targetPortIdentity = PortIdentity.from_bytes(t[0])
+        self.startingBoundaryHops = t[1]
+        self.boundaryHops = t[2]
+        self.actionField = t[3] & 0x0F
+
+    def write_into(self, buffer, offset=0):
+        offset = Header.write_into(self, buffer, offset)
         t = (
-            struct.pack('!Q', self.responseOriginTimestamp.secondsField)[2:8],
-            self.responseOriginTimestamp.nanosecondsField,
-            self.requestingPortIdentity.clockIdentity,
-            self.requestingPortIdentity.portNumber
+            self.targetPortIdentity.raw,
+            self.startingBoundaryHops,
+            self.boundaryHops,
+            self.actionField
         )
-        return header_bytes + self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return self.write_suffix(buffer, offset + self.parser.size)
+
+MESSAGE_CLASSES = {
+    PTP_MESG_TYPE.SYNC: Sync,
+    PTP_MESG_TYPE.DELAY_REQ: Delay_Req,
+    PTP_MESG_TYPE.PDELAY_REQ: Pdelay_Req,
+    PTP_MESG_TYPE.PDELAY_RESP: Pdelay_Resp,
+    PTP_MESG_TYPE.FOLLOW_UP: Follow_Up,
+    PTP_MESG_TYPE.DELAY_RESP: Delay_Resp,
+    PTP_MESG_TYPE.PDELAY_RESP_FOLLOW_UP: Pdelay_Resp_Follow_Up,
+    PTP_MESG_TYPE.ANNOUNCE: Announce,
+    PTP_MESG_TYPE.SIGNALING: Signaling,
+    PTP_MESG_TYPE.MANAGEMENT: Management
+}
+
+### Raw Message Filtering
+
+class Message_Filter:
+    """Rejects PTP messages from their raw octets before any message object is built"""
+    # Offsets within the common header, 13.3.1 Table 18
+    DOMAIN_NUMBER = 4
+    CLOCK_IDENTITY = slice(20, 28)
+
+    def __init__(self, domainNumber, clockIdentity, messageTypes=tuple(MESSAGE_CLASSES)):
+        self.domainNumber = domainNumber
+        self.clockIdentity = clockIdentity
+        self.messageTypes = [messageType in messageTypes for messageType in range(16)]
+        self.accepted = 0
+        self.dropped = collections.Counter() # Per drop reason
+
+    def accept(self, buffer):
+        if len(buffer) < Header.parser.size:
+            reason = 'short'
+        elif not self.messageTypes[buffer[0] & 0x0F]:
+            reason = 'message_type'
+        elif buffer[self.DOMAIN_NUMBER] != self.domainNumber:
+            reason = 'domain'
+        elif buffer[self.CLOCK_IDENTITY] == self.clockIdentity:
+            reason = 'own_clock'
+        else:
+            self.accepted += 1
+            return True
+        self.dropped[reason] += 1
+        return False
+
+### Batch Decoding
+
+_NUMPY_FORMATS = {'B': 'u1', 'b': 'i1', 'H': 'u2', 'h': 'i2', 'L': 'u4', 'q': 'i8'}
+_batch_dtypes = {}
+
+def _struct_fields(parser, names, offset=0):
+    """Yields (name, wire format, native format, offset) for each named item of a struct layout"""
+    names = iter(names)
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', parser.format):
+        count = int(count) if count else 1
+        if code == 'x':
+            offset += count
+        elif code == 's':
+            name = next(names)
+            yield (name, 'V%d' % count, 'V%d' % count, offset)
+            offset += count
+        else:
+            for _ in range(count):
+                name = next(names)
+                wire = native = _NUMPY_FORMATS[code]
+                # UInt48 fields are split in two on the wire and recombined from the '.lo' part
+                if name.endswith('.hi'): native = None
+                if name.endswith('.lo'): native = 'u8'
+                yield (name, '>' + wire, native, offset)
+                offset += struct.calcsize('!' + code)
+
+def _batch_dtype(cls):
+    if cls not in _batch_dtypes:
+        import numpy as np
+        fields = list(_struct_fields(Header.parser, Header.field_names))
+        fields += list(_struct_fields(cls.parser, cls.field_names, Header.parser.size))
+        wire = np.dtype({
+            'names': [f[0] for f in fields],
+            'formats': [f[1] for f in fields],
+            'offsets': [f[3] for f in fields],
+            'itemsize': Header.parser.size + cls.parser.size
+        })
+        native = np.dtype([(f[0][:-3] if f[0].endswith('.lo') else f[0], f[2]) for f in fields if f[2]])
+        _batch_dtypes[cls] = (wire, native)
+    return _batch_dtypes[cls]
+
+def decode_batch(buffers, messageType=None):
+    """Decodes PTP messages of a single type into a NumPy structured array, one record per message
+
+    Field names follow the message attributes, e.g. 'sequenceId' or 'originTimestamp.secondsField'.
+    Requires numpy.
+    """
+    import numpy as np
+    buffers = [memoryview(buffer) for buffer in buffers]
+    if messageType is None:
+        if not buffers: raise ValueError("Unable to infer message type from an empty batch")
+        messageType = buffers[0][0] & 0x0F
+    cls = MESSAGE_CLASSES[PTP_MESG_TYPE(messageType)]
+    wire, native = _batch_dtype(cls)
+
+    if any(len(buffer) < wire.itemsize for buffer in buffers):
+        raise ValueError("Buffer too short for %s" % (cls.__name__))
+    raw = np.frombuffer(b''.join(buffer[:wire.itemsize] for buffer in buffers), dtype=wire)
+    if np.any(raw['messageType'] & 0x0F != messageType):
+        raise ValueError("Batch contains messages other than %s" % (cls.__name__))
+
+    out = np.empty(len(raw), dtype=native)
+    for name in native.names:
+        if name + '.lo' in wire.names:
+            out[name] = (raw[name + '.hi'].astype('u8') << 32) | raw[name + '.lo']
+        else:
+            out[name] = raw[name]
+    out['messageType'] &= 0x0F
+    out['versionPTP'] &= 0x0F
+    return out
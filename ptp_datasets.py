@@ -41,15 +41,13 @@ class CurrentDS:
     def __init__(self):
         # All members are Dynamic
         self.stepsRemoved = 0
-        self.offsetFromMaster = 0 # Implementation-specific (ns * 2^16) # NOTE: using ns float instead
-        self.meanPathDelay = 0 # Implementation-specific (ns * 2^16) # NOTE: using ns float instead
+        self.offsetFromMaster = 0 # Implementation-specific (ns * 2^16)
+        self.meanPathDelay = 0 # Implementation-specific (ns * 2^16)
 
 class ParentDS:
     def __init__(self, defaultDS):
         # All members are Dynamic
-        self.parentPortIdentity = PortIdentity()
-        self.parentPortIdentity.clockIdentity = defaultDS.clockIdentity
-        self.parentPortIdentity.portNumber = 0
+        self.parentPortIdentity = PortIdentity(defaultDS.clockIdentity, 0)
         self.parentStats = False # Computation optional
         self.observedParentOffsetScaledLogVariance = 0xFFFF # Computation optional
         self.observedParentClockPhaseChangeRate = 0x7FFFFFFF # Computation optional
@@ -71,15 +69,29 @@ class TimePropertiesDS:
         self.timeSource = PTP_TIME_SRC.INTERNAL_OSCILLATOR
 
 class PortDS:
+    __slots__ = (
+        'portIdentity',
+        'portState',
+        'logMinDelayReqInterval',
+        'peerMeanPathDelay',
+        'neighborRateRatio',
+        'logAnnounceInterval',
+        'announceReceiptTimeout',
+        'logSyncInterval',
+        'delayMechanism',
+        'logMinPdelayReqInterval',
+        'versionNumber',
+        'foreignMasterDS'
+    )
+
     def __init__(self, profile, clockIdentity, portNumber):
         # Static Members
-        self.portIdentity = PortIdentity()
-        self.portIdentity.clockIdentity = clockIdentity
-        self.portIdentity.portNumber = portNumber
+        self.portIdentity = PortIdentity(clockIdentity, portNumber)
         # Dynamic Members
         self.portState = PTP_STATE.INITIALIZING
         self.logMinDelayReqInterval = profile['portDS.logMinDelayReqInterval']
-        self.peerMeanPathDelay = 0
+        self.peerMeanPathDelay = 0 # ns * 2^16
+        self.neighborRateRatio = 1.0 # Peer's clock rate relative to the local clock
         # Configurable Members
         self.logAnnounceInterval = profile['portDS.logAnnounceInterval']
         self.announceReceiptTimeout = profile['portDS.announceReceiptTimeout']
@@ -104,9 +116,7 @@ class TransparentClockDefaultDS:
 class TransparentClockPortDS:
     def __init__(self, profile, clockIdentity, portNumber):
         # Satic Members
-        self.portIdentity = PortIdentity()
-        self.portIdentity.clockIdentity = clockIdentity
-        self.portIdentity.portNumber = portNumber
+        self.portIdentity = PortIdentity(clockIdentity, portNumber)
         # Dynamic Members
         self.logMinPdelayReqInterval = profile['portDS.logMinPdelayReqInterval']
         self.faultyFlag = False
@@ -115,20 +125,45 @@ class TransparentClockPortDS:
 ## BMC Data Set
 
 class ForeignMasterDS:
+    __slots__ = ('foreignMasterPortIdentity', 'foreignMasterAnnounceMessages', 'timestamps', 'entry')
+
     def __init__(self, msg, portDS):
-        self.foreignMasterPortIdentity = copy(msg.sourcePortIdentity)
+        self.foreignMasterPortIdentity = msg.sourcePortIdentity
         self.foreignMasterAnnounceMessages = 0
         self.timestamps = collections.deque([], 2)
         self.entry = BMC_Entry()
         self.update(msg, portDS)
 
     def update(self, msg, portDS):
+        """Returns True if the Announce changed the entry's comparison key"""
+        key = self.entry.key
         self.foreignMasterAnnounceMessages += 1
         self.entry.parse_Announce(msg, portDS)
         self.timestamps.append(time.monotonic())
+        return self.entry.key != key
+
+    def qualified(self, threshold):
+        """Qualification of foreign masters, 9.3.2.5: two Announces since threshold"""
+        return len(self.timestamps) == 2 and self.timestamps[0] > threshold and self.entry.steps_removed < 255
 
 class BMC_Entry:
     """Contains data and methods needed for best master clock algorithm, 9.3"""
+    __slots__ = (
+        'gm_identity',
+        'gm_priority_1',
+        'gm_priority_2',
+        'gm_class',
+        'gm_accuracy',
+        'gm_variance',
+        'steps_removed',
+        'sender_id',
+        'receiver_id',
+        'receiver_port',
+        'msg',
+        'part1',
+        'key'
+    )
+
     def __init__(self, *args):
         self.gm_identity = None
         self.gm_priority_1 = None
@@ -141,6 +176,8 @@ class BMC_Entry:
         self.receiver_id = None
         self.receiver_port = None
         self.msg = None
+        self.part1 = None
+        self.key = None # Everything the data set comparison looks at, to detect changes
         if len(args) == 1 and isinstance(args[0], DefaultDS):
             self.parse_DefaultDS(*args)
         elif len(args) == 2 and isinstance(args[0], Announce) and isinstance(args[1], PortDS):
@@ -157,9 +194,10 @@ class BMC_Entry:
         self.gm_accuracy = defaultDS.clockQuality.clockAccuracy
         self.gm_variance = defaultDS.clockQuality.offsetScaledLogVariance
         self.steps_removed = 0
-        self.sender_id = PortIdentity(defaultDS.clockIdentity)
-        self.receiver_id = PortIdentity(defaultDS.clockIdentity)
+        self.sender_id = PortIdentity(defaultDS.clockIdentity, 0)
+        self.receiver_id = PortIdentity(defaultDS.clockIdentity, 0)
         self.receiver_port = 0
+        self.cache_key()
 
     def parse_Announce(self, msg, portDS):
         """Use Announce message as information source for data set comparison algorithm, Table 12"""
@@ -171,20 +209,25 @@ class BMC_Entry:
         self.gm_accuracy = msg.grandmasterClockQuality.clockAccuracy
         self.gm_variance = msg.grandmasterClockQuality.offsetScaledLogVariance
         self.steps_removed = msg.stepsRemoved
-        self.sender_id = copy(msg.sourcePortIdentity)
-        self.receiver_id = copy(portDS.portIdentity)
+        self.sender_id = msg.sourcePortIdentity
+        self.receiver_id = portDS.portIdentity
         self.receiver_port = portDS.portIdentity.portNumber
+        self.cache_key()
 
-    def part1_data(self):
-        """Provides data for part 1 of data set comparison algorithm, Fig 27"""
-        return [
+    def cache_key(self):
+        self.part1 = (
             self.gm_priority_1,
             self.gm_class,
             self.gm_accuracy,
             self.gm_variance,
             self.gm_priority_2,
             self.gm_identity
-        ]
+        )
+        self.key = self.part1 + (self.steps_removed, self.sender_id, self.receiver_id, self.receiver_port)
+
+    def part1_data(self):
+        """Provides data for part 1 of data set comparison algorithm, Fig 27"""
+        return self.part1
 
     def compare(a, b):
         """Data set comparison algorithm from 9.3.4"""
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-module-docstring
+
+import bisect
+import collections
+
+FILTER_WINDOW = 10 # Samples
+FILTER_DEFAULT = 'median'
+FILTER_PERCENTILES = {'min': 0.0, 'median': 0.5}
+RATE_RATIO_WINDOW = 16 # Pdelay exchanges
+RATE_RATIO_MAX_DEVIATION = 0.0002 # Oscillators within 100 ppm of nominal
+
+class Window_Filter:
+    """Percentile of the last window samples
+
+    Samples are kept in arrival order in a ring, and sorted alongside it so the percentile is
+    a lookup. Insertion and eviction are a bisect plus a memmove, for the window sizes used on
+    path delays this is cheaper than keeping heaps balanced.
+    """
+    def __init__(self, window=FILTER_WINDOW, percentile=0.5):
+        self.window = window
+        self.percentile = percentile
+        self.samples = collections.deque()
+        self.sorted = []
+
+    def reset(self):
+        self.samples.clear()
+        self.sorted.clear()
+
+    def update(self, sample):
+        """Adds sample, evicting the oldest if the window is full, and returns the filtered value"""
+        self.samples.append(sample)
+        bisect.insort(self.sorted, sample)
+        if len(self.samples) > self.window:
+            del self.sorted[bisect.bisect_left(self.sorted, self.samples.popleft())]
+        return self.value()
+
+    def value(self):
+        if not self.sorted: return None
+        return self.sorted[int(self.percentile * (len(self.sorted) - 1) + 0.5)]
+
+    def __str__(self):
+        return "p%d over %d samples" % (round(100 * self.percentile), self.window)
+
+def make_filter(spec=FILTER_DEFAULT):
+    """Builds a filter from 'KIND[:WINDOW]'
+
+    KIND is none, min, median or pNN for the NNth percentile, a low percentile keeps the lucky
+    packets that spent the least time queued.
+    """
+    kind, _, window = spec.partition(':')
+    window = int(window) if window else FILTER_WINDOW
+    if kind == 'none':
+        return Window_Filter(1)
+    if kind in FILTER_PERCENTILES:
+        percentile = FILTER_PERCENTILES[kind]
+    elif kind.startswith('p') and kind[1:].isdigit() and int(kind[1:]) <= 100:
+        percentile = int(kind[1:]) / 100
+    else:
+        raise ValueError("Unknown filter '%s'" % (spec))
+    if window < 1:
+        raise ValueError("Filter window must be at least 1 sample")
+    return Window_Filter(window, percentile)
+
+class Rate_Ratio_Estimator:
+    """Least squares estimate of neighborRateRatio over the last window Pdelay exchanges
+
+    Each exchange is kept as (t1, t2, t3, t4) in ns, the ratio is the slope of the peer's t3
+    against the local t4. Sums are kept as integers relative to the first t3/t4 seen, so they
+    stay exact and each update is O(1).
+    """
+    def __init__(self, window=RATE_RATIO_WINDOW, max_deviation=RATE_RATIO_MAX_DEVIATION):
+        self.window = window
+        self.max_deviation = max_deviation
+        self.history = collections.deque()
+        self.reset()
+
+    def reset(self):
+        self.history.clear()
+        self.origin = None # (t4, t3)
+        self.sums = [0, 0, 0, 0] # x, y, xy, xx
+
+    def _add(self, x, y, sign):
+        self.sums[0] += sign * x
+        self.sums[1] += sign * y
+        self.sums[2] += sign * x * y
+        self.sums[3] += sign * x * x
+
+    def update(self, t1, t2, t3, t4):
+        """Adds an exchange and returns the new estimate, None until it can be trusted"""
+        if self.origin is None: self.origin = (t4, t3)
+        self.history.append((t1, t2, t3, t4))
+        self._add(t4 - self.origin[0], t3 - self.origin[1], 1)
+        if len(self.history) > self.window:
+            _, _, old_t3, old_t4 = self.history.popleft()
+            self._add(old_t4 - self.origin[0], old_t3 - self.origin[1], -1)
+        return self.ratio()
+
+    def ratio(self):
+        n = len(self.history)
+        sx, sy, sxy, sxx = self.sums
+        denominator = n * sxx - sx * sx
+        if n < 2 or denominator <= 0: return None
+        ratio = (n * sxy - sx * sy) / denominator
+        if abs(ratio - 1) > self.max_deviation: return None
+        return ratio
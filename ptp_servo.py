@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-module-docstring
+# pylint: disable=too-many-instance-attributes
+
+from enum import IntEnum
+
+SERVO_KP = 0.7 # Gains at a 1 s sync interval, scaled as interval^exponent like linuxptp's pi servo
+SERVO_KI = 0.3
+SERVO_KP_EXPONENT = -0.3
+SERVO_KI_EXPONENT = 0.4
+SERVO_KP_NORM_MAX = 0.7 # Upper bounds on kp * interval and ki * interval, keeping the loop stable
+SERVO_KI_NORM_MAX = 0.3
+SERVO_STEP_THRESHOLD = 0 # ns, 0 never steps once locked
+SERVO_FIRST_STEP_THRESHOLD = 20000 # ns
+SERVO_MAX_FREQUENCY = 500000 # ppb
+
+class SERVO_STATE(IntEnum):
+    UNLOCKED = 0 # Collecting samples, leave the clock alone
+    JUMP = 1 # Step the clock by -offset, then apply the frequency
+    LOCKED = 2 # Apply the frequency
+
+class PI_Servo:
+    """Proportional-integral clock servo
+
+    The first two samples estimate the frequency drift, after which the clock is stepped if it
+    is further off than first_step_threshold. Later samples adjust the frequency, a sample past
+    step_threshold unlocks the servo and the estimate restarts. The gains are kp and ki scaled
+    to the sync interval, so the loop bandwidth does not change with logSyncInterval.
+    """
+    def __init__(self, kp=SERVO_KP, ki=SERVO_KI, step_threshold=SERVO_STEP_THRESHOLD, first_step_threshold=SERVO_FIRST_STEP_THRESHOLD, max_frequency=SERVO_MAX_FREQUENCY):
+        self.kp_scale = kp
+        self.ki_scale = ki
+        self.interval = None
+        self.set_interval(1.0)
+        self.step_threshold = step_threshold
+        self.first_step_threshold = first_step_threshold
+        self.max_frequency = max_frequency
+        self.drift = 0.0 # ppb, integral term and initial drift estimate
+        self.count = 0
+        self.last_offset = None
+        self.last_timestamp = None
+
+    def clamp(self, ppb):
+        return max(-self.max_frequency, min(self.max_frequency, ppb))
+
+    def reset(self):
+        self.count = 0
+
+    def set_interval(self, interval):
+        """Rescales the gains for samples arriving every interval seconds"""
+        if interval == self.interval: return
+        self.interval = interval
+        self.kp = min(self.kp_scale * interval ** SERVO_KP_EXPONENT, SERVO_KP_NORM_MAX / interval)
+        self.ki = min(self.ki_scale * interval ** SERVO_KI_EXPONENT, SERVO_KI_NORM_MAX / interval)
+
+    def sample(self, offset, timestamp):
+        """Takes the offset from master and the local time it was measured at, both in ns
+
+        Returns (frequency, state), frequency is the adjustment in ppb to apply to the clock.
+        """
+        if self.count == 0:
+            self.last_offset = offset
+            self.last_timestamp = timestamp
+            self.count = 1
+            return (self.drift, SERVO_STATE.UNLOCKED)
+
+        if self.count == 1:
+            if timestamp <= self.last_timestamp:
+                self.reset()
+                return (self.drift, SERVO_STATE.UNLOCKED)
+            # A clock running fast by n ppb gains n ns on the master every second
+            self.drift = self.clamp(self.drift - (offset - self.last_offset) * 1e9 / (timestamp - self.last_timestamp))
+            self.count = 2
+            if self.first_step_threshold and abs(offset) > self.first_step_threshold:
+                return (self.drift, SERVO_STATE.JUMP)
+            return (self.drift, SERVO_STATE.LOCKED)
+
+        if self.step_threshold and abs(offset) > self.step_threshold:
+            self.reset()
+            return (self.drift, SERVO_STATE.UNLOCKED)
+
+        ki_term = self.ki * offset
+        frequency = self.clamp(self.drift - self.kp * offset - ki_term)
+        self.drift = self.clamp(self.drift - ki_term)
+        return (frequency, SERVO_STATE.LOCKED)
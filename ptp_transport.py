@@ -5,16 +5,20 @@
 # pylint: disable=missing-class-docstring
 # pylint: disable=missing-function-docstring
 
-# TODO: Implement IPv4/6 UDP transports
-
+import asyncio
+import collections
+import socket
 import struct
+import sys
 from enum import IntEnum
+from ptp import PTP_MESG_TYPE
 # import tofino
 # import system
 
 ETH_P_1588 = 0x88F7
 ETH_P_IP = 0x0800
 ETH_P_IPV6 = 0x86DD
+IPPROTO_UDP = 17
 
 IANA_PORT_PTP_EVENT = 319
 IANA_PORT_PTP_GENERAL = 320
@@ -22,25 +26,66 @@ IANA_PORT_PTP_GENERAL = 320
 IPV4_PTP_PRIMARY = "224.0.1.129"
 IPV4_PTP_PDELAY = "224.0.0.107"
 
-IPV6_PTP_PRIMARY = "FF0X:0:0:0:0:0:0:181" # TODO: configure IPv6 multicast scope (X)
+IPV6_PTP_PRIMARY = "FF0%X:0:0:0:0:0:0:181" # Scope (X) from Port_Config.ipv6_scope
 IPV6_PTP_PDELAY = "FF02:0:0:0:0:0:0:6B"
 
 ETH_DST_PTP_PRIMARY = 0x011b19000000.to_bytes(6, 'big')
 ETH_DST_PTP_PDELAY = 0x0180c200000e.to_bytes(6, 'big')
 
+MAX_FRAME_SIZE = 1536
+
+RX_QUEUE_DEPTH = (64, 256) # Frames held per port in the (event, general) lanes
+
+PDELAY_MESSAGES = frozenset((PTP_MESG_TYPE.PDELAY_REQ, PTP_MESG_TYPE.PDELAY_RESP, PTP_MESG_TYPE.PDELAY_RESP_FOLLOW_UP))
+
 class PTP_PROTO(IntEnum):
     UDP_IPV4 = 1
     UDP_IPV6 = 2
     ETHERNET = 3
 
+TRANSPORT_PROTO = {'ethernet': PTP_PROTO.ETHERNET, 'udp4': PTP_PROTO.UDP_IPV4, 'udp6': PTP_PROTO.UDP_IPV6} # --transport choices
+
+class QUEUE_DROP(IntEnum):
+    TAIL = 1 # Drop the arriving frame
+    HEAD = 2 # Drop the oldest queued frame
+
 class Port_Config:
     def __init__(self):
-        # TODO: Retrieve correct values from (?)
+        # Set for all ports by Transport.configure_ports
         self.proto = PTP_PROTO.ETHERNET
         self.src_mac = 0x000000000000.to_bytes(6, 'big')
         self.src_ipv4 = b'\x00' * 4
         self.src_ipv6 = b'\x00' * 16
         self.src_port = 0
+        self.ipv6_scope = 0xE # Global, E.3
+        self.ttl = 1 # IPv4 TTL and IPv6 hop limit, D.3 and E.3
+
+## Checksums ##
+
+def ones_sum(data):
+    """Returns the folded 16-bit one's complement sum of data, RFC 1071"""
+    if len(data) & 1: data = bytes(data) + b'\x00'
+    # The sum is byte order independent, so sum native words and swap once, RFC 1071 2(B)
+    total = sum(memoryview(data).cast('B').cast('H'))
+    while total > 0xFFFF:
+        total = (total & 0xFFFF) + (total >> 16)
+    if sys.byteorder == 'little':
+        total = ((total & 0xFF) << 8) | (total >> 8)
+    return total
+
+def checksum(data, initial=0):
+    """Returns the internet checksum of data, initial is the ones_sum of any pseudo-header"""
+    total = ones_sum(data) + initial
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+def checksum_adjust(checksum_value, old, new):
+    """Returns checksum_value updated for a 16-bit aligned field changing from old to new, RFC 1624 eqn. 3"""
+    total = (~checksum_value & 0xFFFF) + (~ones_sum(old) & 0xFFFF) + ones_sum(new)
+    while total > 0xFFFF:
+        total = (total & 0xFFFF) + (total >> 16)
+    total = ~total & 0xFFFF
+    return total or 0xFFFF # RFC 768, zero is transmitted as all ones
 
 class Ethernet:
     parser = struct.Struct('!6s6sH')
@@ -57,34 +102,47 @@ class Ethernet:
         self.src = t[1]
         self.type = t[2]
 
-    def bytes(self):
+    def write_into(self, buffer, offset=0):
         t = (self.dst, self.src, self.type)
-        return self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return offset + self.parser.size
+
+    def bytes(self):
+        buffer = bytearray(self.parser.size)
+        self.write_into(buffer)
+        return bytes(buffer)
 
 class UDP:
     parser = struct.Struct('!4H')
 
-    def __init__(self):
+    def __init__(self, buffer=b''):
         self.src = None
         self.dst = None
         self.len = None
         self.chk = 0
+        if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        t = self.parser.unpack(buffer)
+        t = self.parser.unpack_from(buffer)
         self.src = t[0]
         self.dst = t[1]
         self.len = t[2]
         self.chk = t[3]
 
-    def bytes(self):
+    def write_into(self, buffer, offset=0):
         t = (self.src, self.dst, self.len, self.chk)
-        return self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return offset + self.parser.size
+
+    def bytes(self):
+        buffer = bytearray(self.parser.size)
+        self.write_into(buffer)
+        return bytes(buffer)
 
 class IPv4:
     parser = struct.Struct('!2B3H2BH4s4s')
 
-    def __init__(self):
+    def __init__(self, buffer=b''):
         self.version = 4
         self.ihl = 5
         self.tos = 0
@@ -97,17 +155,54 @@ class IPv4:
         self.checksum = None
         self.src = None
         self.dst = None
+        if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        pass
+        t = self.parser.unpack_from(buffer)
+        self.version = t[0] >> 4
+        self.ihl = t[0] & 0x0F
+        self.tos = t[1]
+        self.len = t[2]
+        self.id = t[3]
+        self.flags = t[4] >> 13
+        self.fragment_offset = t[4] & 0x1FFF
+        self.ttl = t[5]
+        self.proto = t[6]
+        self.checksum = t[7]
+        self.src = t[8]
+        self.dst = t[9]
+
+    def write_into(self, buffer, offset=0):
+        """Writes the header with a freshly computed checksum, options are not supported"""
+        t = (
+            (self.version << 4) | self.ihl,
+            self.tos,
+            self.len,
+            self.id,
+            (self.flags << 13) | self.fragment_offset,
+            self.ttl,
+            self.proto,
+            0,
+            self.src,
+            self.dst
+        )
+        self.parser.pack_into(buffer, offset, *t)
+        self.checksum = checksum(memoryview(buffer)[offset:offset + self.parser.size])
+        struct.pack_into('!H', buffer, offset + 10, self.checksum)
+        return offset + self.parser.size
+
+    def pseudo_header_sum(self, length):
+        return ones_sum(self.src + self.dst + struct.pack('!2H', self.proto, length))
 
     def bytes(self):
-        pass
+        buffer = bytearray(self.parser.size)
+        self.write_into(buffer)
+        return bytes(buffer)
 
 class IPv6:
     parser = struct.Struct('!LHBB16s16s')
 
-    def __init__(self):
+    def __init__(self, buffer=b''):
         self.version = 6
         self.traffic_class = 0
         self.flow_label = 0
@@ -116,9 +211,10 @@ class IPv6:
         self.hop_limit = None
         self.src = None
         self.dst = None
+        if buffer: self.parse(buffer)
 
     def parse(self, buffer):
-        t = self.parser.unpack(buffer)
+        t = self.parser.unpack_from(buffer)
         self.version = (t[0] >> 28) & 0x0F
         self.traffic_class = (t[0] >> 20) & 0xFF
         self.flow_label = t[0] & 0x000FFFFF
@@ -128,25 +224,144 @@ class IPv6:
         self.src = t[4]
         self.dst = t[5]
 
-    def bytes(self):
+    def write_into(self, buffer, offset=0):
         t = (
-            (self.version << 28) & (self.traffic_class << 20) & self.flow_label,
+            (self.version << 28) | (self.traffic_class << 20) | self.flow_label,
             self.payload_len,
             self.next_header,
             self.hop_limit,
             self.src,
             self.dst
         )
-        return self.parser.pack(*t)
+        self.parser.pack_into(buffer, offset, *t)
+        return offset + self.parser.size
+
+    def pseudo_header_sum(self, length):
+        return ones_sum(self.src + self.dst + struct.pack('!L3xB', length, self.next_header))
+
+    def bytes(self):
+        buffer = bytearray(self.parser.size)
+        self.write_into(buffer)
+        return bytes(buffer)
+
+def multicast_mac(address):
+    """Returns the Ethernet group address for an IPv4 or IPv6 multicast address in packed form"""
+    if len(address) == 4:
+        return b'\x01\x00\x5e' + bytes([address[1] & 0x7F]) + address[2:]
+    return b'\x33\x33' + address[12:]
+
+def frame_offsets(frame):
+    """Returns (msg_offset, checksum_offset) of the PTP message in an Ethernet frame, or (None, None)
+
+    checksum_offset locates the UDP checksum for Annex D/E frames and is None for Annex F frames.
+    IPv4 options are skipped, IPv6 extension headers are not supported.
+    """
+    size = len(frame)
+    if size < Ethernet.parser.size:
+        return (None, None)
+
+    ethertype = (frame[12] << 8) | frame[13]
+    ip = Ethernet.parser.size
+    if ethertype == ETH_P_1588:
+        return (ip, None)
+    elif ethertype == ETH_P_IP:
+        if size < ip + IPv4.parser.size or frame[ip + 9] != IPPROTO_UDP:
+            return (None, None)
+        udp = ip + (frame[ip] & 0x0F) * 4
+    elif ethertype == ETH_P_IPV6:
+        if size < ip + IPv6.parser.size or frame[ip + 6] != IPPROTO_UDP:
+            return (None, None)
+        udp = ip + IPv6.parser.size
+    else:
+        return (None, None)
+
+    if size < udp + UDP.parser.size or ((frame[udp + 2] << 8) | frame[udp + 3]) not in (IANA_PORT_PTP_EVENT, IANA_PORT_PTP_GENERAL):
+        return (None, None)
+    return (udp + UDP.parser.size, udp + 6)
+
+def patch_frame(frame, offset, data, checksum_offset=None):
+    """Overwrites frame[offset:offset + len(data)], keeping the UDP checksum at checksum_offset valid
+
+    The field must sit at an even distance from the UDP header, as every PTP header and timestamp field does.
+    """
+    end = offset + len(data)
+    if checksum_offset is not None:
+        old = int.from_bytes(frame[checksum_offset:checksum_offset + 2], 'big')
+        if old: # Zero means no checksum over IPv4, D.2
+            new = checksum_adjust(old, frame[offset:end], data)
+            frame[checksum_offset:checksum_offset + 2] = new.to_bytes(2, 'big')
+    frame[offset:end] = data
+
+class Port_Queue:
+    """Bounded receive queue for one port, event messages have their own lane served ahead of general ones"""
+    EVENT = 0
+    GENERAL = 1
+
+    def __init__(self, depth=RX_QUEUE_DEPTH, policy=QUEUE_DROP.HEAD, release=None):
+        self.lanes = (collections.deque(), collections.deque())
+        self.depth = depth
+        self.policy = policy
+        self.release = release # Called with the buffer of each dropped item
+        self.waiter = None
+        self.enqueued = [0, 0]
+        self.dropped = [0, 0]
+        self.high_water = [0, 0]
+
+    def put(self, item, lane):
+        queue = self.lanes[lane]
+        if len(queue) >= self.depth[lane]:
+            self.dropped[lane] += 1
+            if self.policy == QUEUE_DROP.TAIL:
+                if self.release: self.release(item[0])
+                return
+            dropped = queue.popleft()
+            if self.release: self.release(dropped[0])
+        queue.append(item)
+        self.enqueued[lane] += 1
+        self.high_water[lane] = max(self.high_water[lane], len(queue))
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def flush(self, lane):
+        """Releases every item queued in lane, returns how many"""
+        queue = self.lanes[lane]
+        flushed = len(queue)
+        while queue:
+            item = queue.popleft()
+            if self.release: self.release(item[0])
+        return flushed
+
+    async def get(self):
+        while not (self.lanes[self.EVENT] or self.lanes[self.GENERAL]):
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+        return (self.lanes[self.EVENT] or self.lanes[self.GENERAL]).popleft()
+
+    def __str__(self):
+        return ', '.join("%s depth=%d max=%d enqueued=%d dropped=%d" % (
+            name, len(self.lanes[lane]), self.high_water[lane], self.enqueued[lane], self.dropped[lane]
+        ) for (name, lane) in (('event', self.EVENT), ('general', self.GENERAL)))
 
 class Transport:
-    def __init__(self, skt_name, driver_name, port_list):
+    def __init__(self, skt_name, driver_name, port_list, rx=True, clock_seed=None):
         driver = self.load_driver(driver_name)
-        self.skt = driver.Socket(skt_name, port_list)
+        self.skt = driver.Socket(skt_name, port_list, rx, clock_seed)
+        self.rx_source = self.skt # Anything with the driver's recv_batch
+        self.clock = self.skt.clock # Local clock disciplined by the servo
         self.port_config = {}
         self.number_of_ports = self.skt.number_of_ports
+        self.frames = {} # Preallocated per-port message buffers, reused by send_message
+        self.headers = {} # port_number -> {messageType: transport header}, from build_headers
+        self.rx_pending = collections.deque()
+        self.rx_queues = {} # port_number -> Port_Queue, see enable_queues
         for i in range(1, self.number_of_ports + 1):
             self.port_config[i] = Port_Config()
+            self.frames[i] = bytearray(MAX_FRAME_SIZE)
+            self.build_headers(i)
+
+    def report(self):
+        """Prints the driver's counters, egress timestamping and the like"""
+        self.skt.report()
 
     def load_driver(self, driver_name):
         if driver_name == 'tofino':
@@ -157,37 +372,212 @@ class Transport:
             print("[ERROR] Unable to locate driver: %s" % (driver_name))
         return driver
 
-    def send_message(self, msg, port_number, get_timestamp=False):
-        timestamp = None
-
-        hdr = Ethernet()
-        hdr.src = self.port_config[port_number].src_mac
-
-        if self.port_config[port_number].proto == PTP_PROTO.ETHERNET:
-            msg.transportSpecific = 0
-            hdr.dst = ETH_DST_PTP_PRIMARY # TODO: select destination based on message type
-            hdr.type = ETH_P_1588
+    def configure_ports(self, proto, src_mac=None, src_ipv4=None, src_ipv6=None, two_step=True):
+        """Sets the transport protocol and source addresses (as text) of every port and rebuilds their headers
+
+        Raises ValueError for a malformed address, or for UDP when the driver cannot timestamp UDP event messages.
+        """
+        if proto != PTP_PROTO.ETHERNET and two_step and not self.skt.udp_timestamps:
+            raise ValueError("the data plane does not timestamp %s event messages, only Ethernet (ETH_P_1588) is supported" % (proto.name))
+        try:
+            mac = bytes.fromhex(src_mac.replace(':', '')) if src_mac else None
+            ipv4 = socket.inet_pton(socket.AF_INET, src_ipv4) if src_ipv4 else None
+            ipv6 = socket.inet_pton(socket.AF_INET6, src_ipv6) if src_ipv6 else None
+        except OSError as e:
+            raise ValueError("invalid source address: %s" % (e)) from e
+        if mac is not None and len(mac) != 6:
+            raise ValueError("invalid source MAC address: %s" % (src_mac))
+        for port_number, config in self.port_config.items():
+            config.proto = proto
+            config.src_mac = config.src_mac if mac is None else mac
+            config.src_ipv4 = config.src_ipv4 if ipv4 is None else ipv4
+            config.src_ipv6 = config.src_ipv6 if ipv6 is None else ipv6
+            self.build_headers(port_number)
+
+    def build_headers(self, port_number):
+        """Prebuilds the port's transport header for every message type, call again after changing its Port_Config"""
+        config = self.port_config[port_number]
+        headers = {}
+        if config.proto in (PTP_PROTO.ETHERNET, PTP_PROTO.UDP_IPV4, PTP_PROTO.UDP_IPV6):
+            for messageType in PTP_MESG_TYPE:
+                headers[messageType] = self.build_header(config, messageType)
+        self.headers[port_number] = headers
+
+    @staticmethod
+    def build_header(config, messageType):
+        """Returns the transport header for a message, UDP lengths and checksums are filled in by write_frame"""
+        pdelay = messageType in PDELAY_MESSAGES
+        eth = Ethernet()
+        eth.src = config.src_mac
+        udp = UDP()
+        udp.src = udp.dst = IANA_PORT_PTP_EVENT if messageType < 0x8 else IANA_PORT_PTP_GENERAL # Event messages are 0-7, 13.3.2.2
+        udp.len = 0
+
+        if config.proto == PTP_PROTO.ETHERNET:
+            eth.dst = ETH_DST_PTP_PDELAY if pdelay else ETH_DST_PTP_PRIMARY # F.3
+            eth.type = ETH_P_1588
+            return eth.bytes()
+        elif config.proto == PTP_PROTO.UDP_IPV4:
+            ip = IPv4()
+            ip.len = 0
+            ip.ttl = config.ttl
+            ip.proto = IPPROTO_UDP
+            ip.src = config.src_ipv4
+            ip.dst = socket.inet_aton(IPV4_PTP_PDELAY if pdelay else IPV4_PTP_PRIMARY)
+            eth.dst = multicast_mac(ip.dst)
+            eth.type = ETH_P_IP
+            return eth.bytes() + ip.bytes() + udp.bytes()
         else:
+            ip = IPv6()
+            ip.payload_len = 0
+            ip.next_header = IPPROTO_UDP
+            ip.hop_limit = config.ttl
+            ip.src = config.src_ipv6
+            ip.dst = socket.inet_pton(socket.AF_INET6, IPV6_PTP_PDELAY if pdelay else IPV6_PTP_PRIMARY % (config.ipv6_scope))
+            eth.dst = multicast_mac(ip.dst)
+            eth.type = ETH_P_IPV6
+            return eth.bytes() + ip.bytes() + udp.bytes()
+
+    def transport_header(self, port_number, messageType):
+        """Returns the prebuilt transport header for a message, or None if the port's protocol is not implemented"""
+        header = self.headers[port_number].get(messageType)
+        if header is None:
             print("[ERROR] Protocol not Implemented")
+        return header
+
+    def write_frame(self, msg, port_number, buffer, offset=0):
+        """Writes the transport headers and message into buffer, returns the end offset or None"""
+        header = self.transport_header(port_number, msg.messageType)
+        if header is None:
+            return None
+
+        msg.transportSpecific = 0
+        # msg_length = hdr.parser.size + msg.parser.size
+        # pad = b'\x00' * (128 - msg_length) if msg_length < 128 else b''
+        start = offset + len(header)
+        buffer[offset:start] = header
+        end = msg.write_into(buffer, start)
+
+        proto = self.port_config[port_number].proto
+        if proto == PTP_PROTO.UDP_IPV4:
+            ip = IPv4(memoryview(buffer)[offset + Ethernet.parser.size:])
+            ip.len = end - offset - Ethernet.parser.size
+            ip.write_into(buffer, offset + Ethernet.parser.size)
+            self.write_udp(buffer, start, end, ip)
+        elif proto == PTP_PROTO.UDP_IPV6:
+            buffer[end:end + 2] = b'\x00\x00' # Checksum correction octets, E.3
+            end += 2
+            ip = IPv6(memoryview(buffer)[offset + Ethernet.parser.size:])
+            ip.payload_len = end - start + UDP.parser.size
+            ip.write_into(buffer, offset + Ethernet.parser.size)
+            self.write_udp(buffer, start, end, ip)
+        return end
+
+    @staticmethod
+    def write_udp(buffer, start, end, ip):
+        """Fills in the length and checksum of the UDP header preceding the message at buffer[start:end]"""
+        udp = start - UDP.parser.size
+        length = end - udp
+        struct.pack_into('!2H', buffer, udp + 4, length, 0)
+        value = checksum(memoryview(buffer)[udp:end], ip.pseudo_header_sum(length)) or 0xFFFF
+        struct.pack_into('!H', buffer, udp + 6, value)
+
+    def frame(self, msg, port_number):
+        """Returns a new frame for msg, transport headers included"""
+        buffer = bytearray(MAX_FRAME_SIZE)
+        length = self.write_frame(msg, port_number, buffer)
+        return buffer[:length] if length else None
+
+    def send_frame(self, frame, port_number, get_timestamp=False, length=None, sequenceId=None):
+        """Sends a frame built by frame() or write_frame(), without copying it
+
+        With get_timestamp set, returns a future resolving to the egress timestamp.
+        """
+        frame = frame if length is None else memoryview(frame)[:length]
+        return self.skt.send([frame], port_number, get_timestamp, sequenceId)
 
-        if hdr:
-            # msg_length = hdr.parser.size + msg.parser.size
-            # pad = b'\x00' * (128 - msg_length) if msg_length < 128 else b''
-            timestamp = self.skt.send(hdr.bytes() + msg.bytes(), port_number, get_timestamp)
-
-        return timestamp
+    def send_message(self, msg, port_number, get_timestamp=False):
+        """Sends msg, Ethernet frames go out as [header, message] without copying the message again"""
+        if self.port_config[port_number].proto != PTP_PROTO.ETHERNET:
+            length = self.write_frame(msg, port_number, self.frames[port_number])
+            if not length:
+                return None
+            return self.send_frame(self.frames[port_number], port_number, get_timestamp, length, msg.sequenceId)
+
+        header = self.transport_header(port_number, msg.messageType)
+        msg.transportSpecific = 0
+        body = self.frames[port_number]
+        length = msg.write_into(body)
+        return self.skt.send([header, memoryview(body)[:length]], port_number, get_timestamp, msg.sequenceId)
 
     def send_buffer(self, buffer, port_number, get_timestamp=False):
         # TODO: merge this with send_message
-        # TODO: update UDP checksum if needed
-        return self.skt.send(buffer, port_number, get_timestamp)
+        return self.skt.send([buffer], port_number, get_timestamp)
 
-    async def recv_message(self):
+    @staticmethod
+    def add_correction(buffer, msg_offset, correction):
+        """Adds correction (scaled ns) to the correctionField of a received frame, adjusting any UDP checksum"""
+        offset = msg_offset + 8 # correctionField, 13.3.1 Table 18
+        value = int.from_bytes(buffer[offset:offset + 8], 'big', signed=True) + correction
+        patch_frame(buffer, offset, value.to_bytes(8, 'big', signed=True), frame_offsets(buffer)[1])
+
+    def enable_queues(self, depth=RX_QUEUE_DEPTH, policy=QUEUE_DROP.HEAD):
+        """Creates a Port_Queue per port, to be filled by demux and read with recv_port"""
+        self.rx_queues = {port_number: Port_Queue(depth, policy, self.release) for port_number in self.port_config}
+
+    async def demux(self, accept=None):
+        """Moves received messages into the per-port queues until cancelled
+
+        Messages rejected by accept(message) are not queued. Queued frames stay in the receive
+        buffers, the consumer of recv_port hands each one back with release().
+        """
         while True:
-            port_number, timestamp, buffer = await self.skt.recv()
-            ethernet = Ethernet(buffer)
-            if ethernet.type == ETH_P_1588:
-                msg_offset = Ethernet.parser.size
+            buffer, msg_offset, port_number, timestamp = await self.recv_message()
+            message = memoryview(buffer)[msg_offset:]
+            queue = self.rx_queues.get(port_number)
+            if queue and message and (accept is None or accept(message)):
+                lane = Port_Queue.EVENT if message[0] & 0x08 == 0 else Port_Queue.GENERAL # Event messages are 0-7
+                queue.put((buffer, msg_offset, port_number, timestamp), lane)
+            else:
+                self.release(buffer)
+            if not self.rx_pending:
+                await asyncio.sleep(0) # Let the port workers drain the queues between receive batches
+
+    def drop_events(self):
+        """Drops the event messages received so far, returns how many
+
+        Called after the clock is stepped, their ingress timestamps are in the time base before the step.
+        """
+        dropped = sum(queue.flush(Port_Queue.EVENT) for queue in self.rx_queues.values())
+        pending = list(self.rx_pending)
+        self.rx_pending.clear()
+        for item in pending:
+            buffer = item[2]
+            msg_offset, _ = frame_offsets(buffer)
+            if msg_offset is not None and msg_offset < len(buffer) and buffer[msg_offset] & 0x08 == 0: # Event messages are 0-7
+                self.release(buffer)
+                dropped += 1
             else:
+                self.rx_pending.append(item)
+        return dropped
+
+    def release(self, buffer):
+        """Returns a received frame's buffer to the driver's pool once nothing refers to it"""
+        self.rx_source.release(buffer)
+
+    async def recv_port(self, port_number):
+        """Returns the next queued (buffer, msg_offset, port_number, timestamp) for port_number, event messages first"""
+        return await self.rx_queues[port_number].get()
+
+    async def recv_message(self):
+        """Returns the next received PTP message, its buffer is to be handed back with release()"""
+        while True:
+            if not self.rx_pending:
+                self.rx_pending.extend(await self.rx_source.recv_batch())
+                continue
+            port_number, timestamp, buffer = self.rx_pending.popleft()
+            msg_offset, _ = frame_offsets(buffer)
+            if msg_offset is None:
+                self.release(buffer)
                 continue
             return (buffer, msg_offset, port_number, timestamp)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-module-docstring
+
+# Round trip checks for the message codecs.
+#
+#   python3 -m unittest test_ptp
+
+import unittest
+import ptp
+from ptp import PTP_MESG_TYPE
+
+CLOCK_IDENTITY = bytes.fromhex('0090fafffe001122')
+PEER_IDENTITY = bytes.fromhex('3cfdfefffe334455')
+
+def announce():
+    msg = ptp.Announce()
+    msg.transportSpecific = 0
+    msg.messageType = PTP_MESG_TYPE.ANNOUNCE
+    msg.versionPTP = 2
+    msg.messageLength = ptp.Header.parser.size + msg.parser.size
+    msg.domainNumber = 0
+    msg.correctionField = 0
+    msg.sourcePortIdentity = ptp.PortIdentity(CLOCK_IDENTITY, 1)
+    msg.sequenceId = 1
+    msg.controlField = 0x05
+    msg.logMessageInterval = 1
+    msg.originTimestamp = ptp.TimeStamp(0)
+    msg.currentUtcOffset = 37
+    msg.grandmasterPriority1 = 128
+    msg.grandmasterClockQuality.clockClass = 248
+    msg.grandmasterClockQuality.clockAccuracy = 0xFE
+    msg.grandmasterClockQuality.offsetScaledLogVariance = 0xFFFF
+    msg.grandmasterPriority2 = 128
+    msg.grandmasterIdentity = CLOCK_IDENTITY
+    msg.stepsRemoved = 0
+    msg.timeSource = ptp.PTP_TIME_SRC.INTERNAL_OSCILLATOR
+    return msg
+
+class TLV_Round_Trip(unittest.TestCase):
+    def test_add_tlv(self):
+        msg = announce()
+        msg.add_tlv(ptp.Path_Trace_TLV((CLOCK_IDENTITY, PEER_IDENTITY)))
+        buffer = msg.bytes()
+        self.assertEqual(len(buffer), ptp.Announce.size + 4 + 16)
+        self.assertEqual(msg.messageLength, len(buffer))
+
+        parsed = ptp.Announce(buffer)
+        self.assertEqual(parsed.messageLength, len(buffer))
+        tlvs = list(parsed.tlvs(ptp.TLV_TYPE.PATH_TRACE))
+        self.assertEqual(len(tlvs), 1)
+        self.assertEqual(tlvs[0].pathSequence, (CLOCK_IDENTITY, PEER_IDENTITY))
+        self.assertEqual(parsed.bytes(), buffer)
+
+    def test_messageLength_set_after_add_tlv(self):
+        msg = announce()
+        msg.add_tlv(ptp.TLV(ptp.TLV_TYPE.REQUEST_UNICAST_TRANSMISSION, bytes(6)))
+        msg.messageLength = ptp.Header.parser.size + msg.parser.size
+        parsed = ptp.Announce(msg.bytes())
+        self.assertEqual([tlv.tlvType for tlv in parsed.tlvs()], [ptp.TLV_TYPE.REQUEST_UNICAST_TRANSMISSION])
+
+if __name__ == '__main__':
+    unittest.main()
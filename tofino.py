@@ -6,7 +6,14 @@
 
 import sys
 import socket
+import struct
 import asyncio
+import bisect
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append('./gen-py')
 
@@ -22,17 +29,138 @@ from thrift.protocol import TMultiplexedProtocol
 MAX_MSG_SIZE = 8192
 ETH_P_ALL = 3
 CPU_HDR_SIZE = 8
+RX_BATCH_SIZE = 64
+DEVICE_PORTS = 512 # device_port is 9 bits
+GLOBAL_TS_MASK = (1 << 48) - 1 # The global timestamp counter and its offset are 48 bits
+TX_TS_FIFO_DEPTH = 4 # Egress timestamps held per port by the hardware
+TX_TS_MAX_AGE = 0.05 # Seconds a request waits for its egress timestamp before expiring
+TX_TS_POLL_INTERVAL = 0.0002 # Seconds between rounds while requests are outstanding
 
-def thrift_connect():
-    transport = TSocket.TSocket('localhost', 9090)
-    transport = TTransport.TBufferedTransport(transport)
+THRIFT_HOST = 'localhost'
+THRIFT_PORT = 9090
+THRIFT_POOL_SIZE = 4 # Connections, and so concurrent RPCs
+THRIFT_TIMEOUT = 0.5 # Seconds allowed per RPC before the connection is dropped
+THRIFT_BACKOFF = (0.05, 5.0) # Initial and maximum seconds between reconnect attempts
+THRIFT_REPORT_INTERVAL = 60 # Seconds between latency reports
+THRIFT_LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000, 250000) # Upper bounds in us
+
+def thrift_connect(host=THRIFT_HOST, port=THRIFT_PORT, timeout=THRIFT_TIMEOUT):
+    """Returns an open (transport, client) pair for the ts service"""
+    skt = TSocket.TSocket(host, port)
+    skt.setTimeout(timeout * 1000)
+    transport = TTransport.TBufferedTransport(skt)
     transport.open()
 
     bProtocol = TBinaryProtocol.TBinaryProtocol(transport)
     protocol = TMultiplexedProtocol.TMultiplexedProtocol(bProtocol, 'ts')
-    return ts.Client(protocol) # TODO: This shouldn't work, ts is undefined
+    return (transport, ts.Client(protocol)) # TODO: This shouldn't work, ts is undefined
+
+class Latency_Histogram:
+    def __init__(self, buckets=THRIFT_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last bucket is overflow
+        self.errors = 0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds * 1e6)] += 1
+
+    def percentile(self, fraction):
+        """Returns the upper bound in us of the bucket holding the given fraction of calls"""
+        target = fraction * sum(self.counts)
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if count and total >= target:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return None
+
+    def __str__(self):
+        return "n=%d errors=%d p50<=%sus p99<=%sus" % (sum(self.counts), self.errors, self.percentile(0.5), self.percentile(0.99))
+
+class Thrift_Connection:
+    """One ts client, reopened with exponential backoff after a transport failure
+
+    A call that did not return leaves the connection unhealthy, its reply may still be in
+    flight, so it is reopened before the next call rather than trusted because the socket is open.
+    """
+    def __init__(self, host, port, timeout):
+        self.address = (host, port, timeout)
+        self.transport = None
+        self.client = None
+        self.backoff = THRIFT_BACKOFF[0]
+        self.retry_at = 0
+        self.last_call_ok = False
+
+    def healthy(self):
+        return self.transport is not None and self.transport.isOpen() and self.last_call_ok
+
+    def connect(self):
+        """Reopens the connection if needed, returns False while backing off"""
+        if self.healthy(): return True
+        if time.monotonic() < self.retry_at: return False
+        if self.transport:
+            print("[WARN] Thrift %s:%d reopened after a call that did not complete" % (self.address[0], self.address[1]))
+            self.transport.close()
+        try:
+            self.transport, self.client = thrift_connect(*self.address)
+        except (TTransport.TTransportException, OSError) as e:
+            self.failed(e)
+            return False
+        self.backoff = THRIFT_BACKOFF[0]
+        self.last_call_ok = True
+        return True
+
+    def failed(self, exception):
+        if self.transport: self.transport.close()
+        self.transport = None
+        self.client = None
+        self.retry_at = time.monotonic() + self.backoff
+        print("[WARN] Thrift %s:%d unavailable (%s), retrying in %0.2fs" % (self.address[0], self.address[1], exception, self.backoff))
+        self.backoff = min(2 * self.backoff, THRIFT_BACKOFF[1])
+
+class Thrift_Pool:
+    """Fixed set of ts connections shared between threads, with per-method latency histograms"""
+    def __init__(self, size=THRIFT_POOL_SIZE, host=THRIFT_HOST, port=THRIFT_PORT, timeout=THRIFT_TIMEOUT):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.histograms = collections.defaultdict(Latency_Histogram)
+        for _ in range(size):
+            connection = Thrift_Connection(host, port, timeout)
+            connection.connect()
+            self.idle.put(connection)
+
+    def call(self, method, *args):
+        """Calls method on an idle connection, blocking until one is free"""
+        connection = self.idle.get()
+        try:
+            if not connection.connect():
+                raise ConnectionError("Thrift connection unavailable")
+            start = time.perf_counter()
+            connection.last_call_ok = False
+            try:
+                result = getattr(connection.client, method)(*args)
+            except (TTransport.TTransportException, OSError) as e:
+                connection.failed(e)
+                with self.lock: self.histograms[method].errors += 1
+                raise
+            except Exception:
+                with self.lock: self.histograms[method].errors += 1
+                raise
+            connection.last_call_ok = True
+            with self.lock: self.histograms[method].record(time.perf_counter() - start)
+            return result
+        finally:
+            self.idle.put(connection)
+
+    def report(self):
+        with self.lock:
+            for method, histogram in self.histograms.items():
+                print("[INFO] Thrift %s: %s" % (method, histogram))
 
 class CPU_Header:
+    parser = struct.Struct('!H6s')
+
     def __init__(self, buffer=b''):
         self.device_port = None
         self.timestamp = None
@@ -42,52 +170,340 @@ class CPU_Header:
         self.device_port = int.from_bytes(buffer[:2], 'big') & 0x01FF
         self.timestamp = int.from_bytes(buffer[2:8], 'big')
 
+    def write_into(self, buffer, offset=0):
+        self.parser.pack_into(buffer, offset, self.device_port, b'\xFF' * 6)
+        # self.parser.pack_into(buffer, offset, self.device_port, self.timestamp.to_bytes(6, 'big'))
+        return offset + CPU_HDR_SIZE
+
     def bytes(self):
-        bytes = b''
-        bytes += self.device_port.to_bytes(2, 'big')
-        # bytes += self.timestamp.to_bytes(6, 'big')
-        bytes += b'\xFF' * 6
-        return bytes
+        buffer = bytearray(CPU_HDR_SIZE)
+        self.write_into(buffer)
+        return bytes(buffer)
+
+class TX_Timestamp_Tracker:
+    """Matches one device port's egress timestamp FIFO to the frames sent on it, in send order
+
+    The FIFO is only read while requests are outstanding, an entry for a frame whose request has
+    not been added yet stays in hardware until the next round. Requests beyond the hardware FIFO
+    depth fail as overflowed, those waiting longer than TX_TS_MAX_AGE fail as expired.
+
+    Matching is positional, so once a request is dropped without its entry (an expiry) or an entry
+    may have been consumed without reaching us (a failed read) the FIFO is resynchronised: the
+    outstanding requests fail, the FIFO is read until empty, and requests for frames sent before
+    it was found empty fail as they are added. Egress timestamping takes far less than the read
+    RPC, so entries for frames sent after that point are still in the FIFO.
+    """
+    def __init__(self, device_port):
+        self.device_port = device_port
+        self.outstanding = collections.deque() # (sequenceId, future, sent_at)
+        self.resync_needed = False
+        self.resynced_at = None # Requests for frames sent earlier may have had their entry flushed
+        self.matched = 0
+        self.overflowed = 0
+        self.expired = 0
+        self.resyncs = 0
+        self.flushed = 0 # Entries discarded while resynchronising
+
+    def add(self, sequenceId, future, sent_at):
+        """Returns an exception to fail the request with, or None once it is queued"""
+        if self.resync_needed or (self.resynced_at is not None and sent_at < self.resynced_at):
+            return RuntimeError("egress timestamp FIFO resynchronised")
+        if len(self.outstanding) >= TX_TS_FIFO_DEPTH:
+            self.overflowed += 1
+            return OverflowError("egress timestamp FIFO overflow")
+        self.outstanding.append((sequenceId, future, sent_at))
+        return None
+
+    def pending(self):
+        return bool(self.outstanding) or self.resync_needed
+
+    def resync(self, pool, failed):
+        """Fails the outstanding requests and empties the FIFO, returns False if it could not be emptied"""
+        while self.outstanding:
+            failed.append((self.outstanding.popleft(), RuntimeError("egress timestamp FIFO resynchronised")))
+        for _ in range(2 * TX_TS_FIFO_DEPTH):
+            started = time.monotonic()
+            try:
+                result = pool.call('ts_1588_timestamp_tx_get', 0, self.device_port)
+            except Exception: # pylint: disable=broad-except
+                return False
+            if not result.ts_valid:
+                self.resynced_at = started
+                self.resync_needed = False
+                self.resyncs += 1
+                return True
+            self.flushed += 1
+        return False # Still filling, try again next round
+
+    def drain(self, pool):
+        """Reads the FIFO until it or outstanding is empty, returns the ([(future, timestamp)], [(request, exception)]) to deliver"""
+        resolved = []
+        failed = []
+        if self.resync_needed and not self.resync(pool, failed):
+            return (resolved, failed)
+        while self.outstanding:
+            try:
+                result = pool.call('ts_1588_timestamp_tx_get', 0, self.device_port)
+            except Exception: # pylint: disable=broad-except
+                self.resync_needed = True # The entry may have been read with the reply lost
+                break
+            if not result.ts_valid:
+                break
+            resolved.append((self.outstanding.popleft()[1], result.ts))
+            self.matched += 1
+
+        now = time.monotonic()
+        while self.outstanding and now - self.outstanding[0][2] > TX_TS_MAX_AGE:
+            failed.append((self.outstanding.popleft(), TimeoutError("egress timestamp expired")))
+            self.expired += 1
+            self.resync_needed = True # Its entry may still arrive and would be matched to the next frame
+
+        return (resolved, failed)
+
+    def __str__(self):
+        return "matched=%d overflowed=%d expired=%d resyncs=%d flushed=%d" % (self.matched, self.overflowed, self.expired, self.resyncs, self.flushed)
+
+class TX_Timestamp_Reader(threading.Thread):
+    """Reads egress timestamps over Thrift on its own thread, keeping the RPCs off the event loop
+
+    Requests are tagged (device_port, sequenceId) and resolved through asyncio futures. Everything
+    queued since the last round is served together, the FIFOs of all ports with requests outstanding
+    are drained in parallel over the pool.
+    """
+    def __init__(self, pool):
+        super().__init__(name='tx-timestamps', daemon=True)
+        self.pool = pool
+        self.workers = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix='tx-timestamps')
+        self.requests = queue.SimpleQueue()
+        self.trackers = {} # device_port -> TX_Timestamp_Tracker
+        self.pending = set() # Trackers with requests outstanding or to resynchronise
+        self.rounds = 0
+        self.reported = {} # device_port -> counters at the last report
+
+    def request(self, device_port, sequenceId):
+        """Returns a future for the egress timestamp of the frame just sent on device_port"""
+        future = asyncio.get_event_loop().create_future()
+        self.requests.put((device_port, sequenceId, future, time.monotonic()))
+        return future
+
+    def run(self):
+        while True:
+            try:
+                if self.pending:
+                    item = self.requests.get(timeout=TX_TS_POLL_INTERVAL)
+                else:
+                    item = self.requests.get()
+                while True:
+                    self.add(*item)
+                    item = self.requests.get_nowait()
+            except queue.Empty:
+                pass
+            self.poll()
+
+    def add(self, device_port, sequenceId, future, sent_at):
+        tracker = self.trackers.get(device_port)
+        if tracker is None:
+            tracker = self.trackers[device_port] = TX_Timestamp_Tracker(device_port)
+        exception = tracker.add(sequenceId, future, sent_at)
+        if exception:
+            self.fail(device_port, (sequenceId, future, sent_at), exception)
+        else:
+            self.pending.add(tracker)
+
+    def poll(self):
+        self.rounds += 1
+        # Trackers are only touched by their own worker until the round completes
+        trackers = list(self.pending)
+        for tracker, (resolved, failed) in zip(trackers, self.workers.map(lambda t: t.drain(self.pool), trackers)):
+            for future, timestamp in resolved:
+                self.resolve(future, timestamp)
+            for request, exception in failed:
+                self.fail(tracker.device_port, request, exception)
+            if not tracker.pending():
+                self.pending.discard(tracker)
+
+    def report(self):
+        """Prints the counters of each device port that changed since the last report"""
+        for device_port, tracker in sorted(self.trackers.items()):
+            counters = str(tracker)
+            if self.reported.get(device_port) != counters:
+                print("[INFO] Egress timestamps (device port %d): %s" % (device_port, counters))
+                self.reported[device_port] = counters
+
+    @staticmethod
+    def fail(device_port, request, exception):
+        sequenceId, future, _ = request
+        print("[WARN] No egress timestamp for device port %d, sequenceId %s: %s" % (device_port, sequenceId, exception))
+        future.get_loop().call_soon_threadsafe(TX_Timestamp_Reader._set_exception, future, exception)
+
+    @staticmethod
+    def resolve(future, timestamp):
+        future.get_loop().call_soon_threadsafe(TX_Timestamp_Reader._set_result, future, timestamp)
+
+    @staticmethod
+    def _set_result(future, timestamp):
+        if not future.done(): future.set_result(timestamp)
+
+    @staticmethod
+    def _set_exception(future, exception):
+        if not future.done(): future.set_exception(exception)
+
+class Clock:
+    """Disciplines the global timestamp counter over Thrift, keeping the RPCs off the event loop
+
+    Steps move the counter's offset, frequency adjustments scale its per-tick increment from the
+    value read on first use. Adjustments are applied in order on a single thread, and the offset
+    is read back after a step since a step from another process between the read and the write
+    would be lost.
+    """
+    shared = True # One counter per switch, adjustments are seen by every process
+
+    def __init__(self, pool, dev_id=0):
+        self.pool = pool
+        self.dev_id = dev_id
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clock')
+        self.nominal_increment = None
+        self.frequency = 0.0 # ppb
+        self.on_step = None # Called on the event loop once a step has been applied
+
+    def step(self, offset):
+        """Moves the clock by offset ns"""
+        loop = asyncio.get_event_loop()
+        self.worker.submit(self._step, offset).add_done_callback(lambda future: self.stepped(future, loop))
+
+    def adjust_frequency(self, ppb):
+        self.worker.submit(self._adjust_frequency, ppb).add_done_callback(self.done)
+
+    def _step(self, offset):
+        current = self.pool.call('ts_global_ts_offset_get', self.dev_id)
+        value = current + offset
+        if value < 0:
+            raise ValueError("Stepping by %d ns would take the global timestamp offset (%d) negative" % (offset, current))
+        value &= GLOBAL_TS_MASK # The counter wraps, so does its offset
+        self.pool.call('ts_global_ts_offset_set', self.dev_id, value)
+        written = self.pool.call('ts_global_ts_offset_get', self.dev_id)
+        if written != value:
+            raise RuntimeError("Global timestamp offset is %d after writing %d, another writer stepped the clock" % (written, value))
+
+    def _adjust_frequency(self, ppb):
+        if self.nominal_increment is None:
+            self.nominal_increment = self.pool.call('ts_global_ts_inc_value_get', self.dev_id)
+        self.pool.call('ts_global_ts_inc_value_set', self.dev_id, round(self.nominal_increment * (1 + ppb * 1e-9)))
+        self.frequency = ppb
+
+    @staticmethod
+    def done(future):
+        if future.exception():
+            print("[ERROR] Clock adjustment failed: %s" % (future.exception()))
+
+    def stepped(self, future, loop):
+        self.done(future)
+        if not future.exception() and self.on_step:
+            loop.call_soon_threadsafe(self.on_step)
 
 class Socket:
-    def __init__(self, skt_name, port_list):
+    udp_timestamps = False # ptp_dp.p4 only punts and timestamps ETH_P_1588 frames
+
+    def __init__(self, skt_name, port_list, rx=True, clock_seed=None): # pylint: disable=unused-argument
         self.ports = {1:1}
-        self.skt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
-        self.skt.bind((skt_name, ETH_P_ALL))
+        protocol = ETH_P_ALL if rx else 0 # A socket bound to protocol 0 is only used for sending
+        self.skt = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(protocol))
+        self.skt.bind((skt_name, protocol))
         self.skt.setblocking(False)
-        self.tofino = thrift_connect()
+        self.thrift = Thrift_Pool()
+        self.thrift_reported_at = time.monotonic()
+        self.tx_timestamps = TX_Timestamp_Reader(self.thrift)
+        self.tx_timestamps.start()
+        self.clock = Clock(self.thrift)
         self.number_of_ports = 1
+        self.cpu_headers = {} # (port_number, get_timestamp) -> CPU header bytes
+        self.rx_free = [bytearray(MAX_MSG_SIZE) for _ in range(RX_BATCH_SIZE)] # Receive buffer pool
+        self.port_index = [None] * DEVICE_PORTS # device_port -> port_number
+        self.unmapped = collections.Counter() # device_port -> frames dropped
         self.map_ports(port_list)
 
     def map_ports(self, filename):
         if filename:
             f = open(filename)
             lines = f.readlines()
-            for i in range(len(lines)):
-                self.ports[i + 1] = int(lines[i])
             f.close()
+            for i in range(len(lines)):
+                device_port = int(lines[i]) if lines[i].strip().isdigit() else -1
+                if device_port >= DEVICE_PORTS or device_port < 0:
+                    raise ValueError("%s:%d: '%s' is not a device port (0-%d)" % (filename, i + 1, lines[i].strip(), DEVICE_PORTS - 1))
+                self.ports[i + 1] = device_port
             self.number_of_ports = len(lines)
+        self.cpu_headers = {}
+        self.port_index = [None] * DEVICE_PORTS
+        for port_number, device_port in self.ports.items():
+            self.port_index[device_port] = port_number
 
-    def send(self, msg, port_number, get_timestamp=False):
-        timestamp = None
-        cpu_hdr = CPU_Header()
-        cpu_hdr.device_port = self.ports[port_number]
-        cpu_hdr.timestamp = get_timestamp # Request Egress Timestamp
+    def report(self):
+        self.tx_timestamps.report()
+        now = time.monotonic()
+        if now - self.thrift_reported_at >= THRIFT_REPORT_INTERVAL:
+            self.thrift.report()
+            self.thrift_reported_at = now
 
-        self.skt.send(cpu_hdr.bytes() + msg)
-        if get_timestamp:
-            timestamp = self.tofino.ts_1588_timestamp_tx_get(0, cpu_hdr.device_port).ts
-            # timestamp = time.clock_gettime_ns(time.CLOCK_REALTIME) # TODO: get TS7 from tofino
+    def drop_unmapped(self, device_port):
+        if not self.unmapped[device_port]:
+            print("[WARN] Dropping frames from unmapped device port %d" % (device_port))
+        self.unmapped[device_port] += 1
+
+    def cpu_header(self, port_number, get_timestamp):
+        key = (port_number, bool(get_timestamp))
+        header = self.cpu_headers.get(key)
+        if header is None:
+            cpu_hdr = CPU_Header()
+            cpu_hdr.device_port = self.ports[port_number]
+            cpu_hdr.timestamp = bool(get_timestamp) # Request Egress Timestamp
+            header = self.cpu_headers[key] = cpu_hdr.bytes()
+        return header
 
+    def send(self, buffers, port_number, get_timestamp=False, sequenceId=None):
+        """Sends the frame made up of buffers, behind the port's cached CPU header, without copying it
+
+        With get_timestamp set, returns a future resolving to the egress timestamp.
+        """
+        timestamp = None
+        self.skt.sendmsg([self.cpu_header(port_number, get_timestamp)] + buffers)
+        if get_timestamp:
+            timestamp = self.tx_timestamps.request(self.ports[port_number], sequenceId)
         return timestamp
 
-    async def recv(self):
+    def rx_buffer(self):
+        return self.rx_free.pop() if self.rx_free else bytearray(MAX_MSG_SIZE)
+
+    def release(self, frame):
+        """Returns the buffer behind a frame from recv_batch to the pool, at most once per frame"""
+        self.rx_free.append(frame.obj)
+
+    async def recv_batch(self):
+        """Waits for a frame then drains those already queued, up to RX_BATCH_SIZE per wakeup
+
+        Returns a list of (port_number, timestamp, frame), frames are memoryviews into buffers
+        taken from a pool. Hand each frame back with release() once it has been parsed, a frame
+        that is not released is left to the garbage collector and its buffer reallocated.
+        """
         loop = asyncio.get_event_loop()
-        msg = await loop.sock_recv(self.skt, MAX_MSG_SIZE)
-        cpu_hdr = CPU_Header(msg)
-        port_list = [port for (port, d_p) in self.ports.items() if d_p == cpu_hdr.device_port]
-        # timestamp = time.clock_gettime_ns(time.CLOCK_REALTIME) # TODO: get TS1 from CPU header
-        if len(port_list) == 1:
-            return (port_list[0], cpu_hdr.timestamp, msg[CPU_HDR_SIZE:])
-        else:
-            return await self.recv()
+        frames = []
+        buffer = self.rx_buffer()
+        nbytes = await loop.sock_recv_into(self.skt, buffer)
+        for i in range(RX_BATCH_SIZE):
+            if i > 0:
+                buffer = self.rx_buffer()
+                try:
+                    nbytes = self.skt.recv_into(buffer)
+                except BlockingIOError:
+                    self.rx_free.append(buffer)
+                    break
+            msg = memoryview(buffer)[:nbytes]
+            cpu_hdr = CPU_Header(msg)
+            port_number = self.port_index[cpu_hdr.device_port] if cpu_hdr.device_port < DEVICE_PORTS else None
+            if port_number is None:
+                self.drop_unmapped(cpu_hdr.device_port)
+                self.rx_free.append(buffer)
+                continue
+            # timestamp = time.clock_gettime_ns(time.CLOCK_REALTIME) # TODO: get TS1 from CPU header
+            frames.append((port_number, cpu_hdr.timestamp, msg[CPU_HDR_SIZE:]))
+        return frames
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# pylint: disable=invalid-name
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=missing-module-docstring
+
+# Stand-in for the switch's 'ts' Thrift service, serving ts_1588_timestamp_tx_get from the
+# host clock so the tofino driver's egress timestamp path can be exercised without hardware.
+# The global timestamp offset and increment can be set, so the servo has a clock to discipline.
+#
+#   ./ts_stub.py -l 0.001 -m 0.2
+
+from optparse import OptionParser
+import random
+import sys
+import time
+
+sys.path.append('./gen-py')
+
+from ts_pd_rpc import ts
+from ts_pd_rpc.ttypes import ts_1588_timestamp_t
+
+from thrift.transport import TSocket
+from thrift.transport import TTransport
+from thrift.protocol import TBinaryProtocol
+from thrift.server import TServer
+from thrift.TMultiplexedProcessor import TMultiplexedProcessor
+
+TS_MASK = (1 << 48) - 1 # Tofino timestamps are 48 bits
+TS_INC_NOMINAL = 1 << 28 # Increment per tick that counts at the host clock's rate
+
+class TS_Handler:
+    def __init__(self, latency, miss_rate):
+        self.latency = latency
+        self.miss_rate = miss_rate
+        self.calls = 0
+        self.origin = time.clock_gettime_ns(time.CLOCK_REALTIME)
+        self.base = self.origin
+        self.offset = 0
+        self.increment = TS_INC_NOMINAL
+
+    def now(self):
+        host = time.clock_gettime_ns(time.CLOCK_REALTIME)
+        return self.base + (host - self.origin) * self.increment // TS_INC_NOMINAL + self.offset
+
+    def ts_1588_timestamp_tx_get(self, dev_id, dev_port): # pylint: disable=unused-argument
+        self.calls += 1
+        if self.latency: time.sleep(self.latency)
+        if random.random() < self.miss_rate:
+            return ts_1588_timestamp_t(ts=0, ts_valid=False, ts_id=0)
+        return ts_1588_timestamp_t(ts=self.now() & TS_MASK, ts_valid=True, ts_id=0)
+
+    def ts_global_ts_offset_get(self, dev_id): # pylint: disable=unused-argument
+        return self.offset
+
+    def ts_global_ts_offset_set(self, dev_id, global_ts_offset): # pylint: disable=unused-argument
+        self.offset = global_ts_offset
+
+    def ts_global_ts_inc_value_get(self, dev_id): # pylint: disable=unused-argument
+        return self.increment
+
+    def ts_global_ts_inc_value_set(self, dev_id, global_inc_ns): # pylint: disable=unused-argument
+        self.base = self.now() - self.offset
+        self.origin = time.clock_gettime_ns(time.CLOCK_REALTIME)
+        self.increment = global_inc_ns
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-p", "--port", type="int", dest="port", default=9090)
+    parser.add_option("-l", "--latency", type="float", dest="latency", default=0.0, help="seconds added to every RPC")
+    parser.add_option("-m", "--miss-rate", type="float", dest="miss_rate", default=0.0, help="fraction of reads returning an empty FIFO")
+    (options, _) = parser.parse_args()
+
+    processor = TMultiplexedProcessor()
+    processor.registerProcessor('ts', ts.Processor(TS_Handler(options.latency, options.miss_rate)))
+    server = TServer.TThreadedServer(
+        processor,
+        TSocket.TServerSocket('localhost', options.port),
+        TTransport.TBufferedTransportFactory(),
+        TBinaryProtocol.TBinaryProtocolFactory(),
+        daemon=True
+    )
+    print("[INFO] ts stub listening on localhost:%d" % (options.port))
+    server.serve()
+
+if __name__ == '__main__':
+    main()